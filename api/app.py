@@ -6,9 +6,11 @@ from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from libtrustbridge.errors import handlers
 
-from api import loggers
+from api import loggers, metrics
+from api.cache import TTLCache
 from api.conf import BaseConfig
 from api.docs import spec
+from api.http_client import create_http_session
 
 db = SQLAlchemy()
 ma = Marshmallow()
@@ -30,6 +32,12 @@ def create_app(config_object=None):
         sentry_sdk.init(SENTRY_DSN, integrations=[FlaskIntegration()])
 
     db.init_app(app)
+    metrics.init_app(app)
+    app.extensions['message_cache'] = TTLCache(app.config['MESSAGE_CACHE_SIZE'], app.config['MESSAGE_CACHE_TTL'])
+    # also used by the bulk subscriptions view verifying INTENT_VERIFICATION_MAX_CONCURRENCY topics at a time
+    app.extensions['http_session'] = create_http_session(
+        app.config, app.config['INTENT_VERIFICATION_MAX_CONCURRENCY']
+    )
 
     with app.app_context():
         from api import views
@@ -53,6 +61,9 @@ def create_app(config_object=None):
 
 def register_specs(app):
     for view in app.view_functions.values():
-        views = ('post_message', 'get_message', 'subscriptions_by_jurisdiction', 'subscriptions_by_id')
+        views = (
+            'post_message', 'post_messages_batch', 'list_messages', 'get_message', 'update_messages_status',
+            'subscriptions_by_jurisdiction', 'subscriptions_by_id', 'subscriptions_bulk',
+        )
         if view.__name__ in views:
             spec.path(view=view, app=app)
@@ -0,0 +1,62 @@
+import threading
+
+
+class IdleBackoff:
+    """
+    Sleep between polls which found no work, starting at min_seconds and
+    doubling up to max_seconds, reset() as soon as there is work again
+    """
+
+    def __init__(self, min_seconds=0.1, max_seconds=5, factor=2):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.factor = factor
+        self._delay = 0
+
+    def next_delay(self):
+        if self._delay:
+            self._delay = min(self._delay * self.factor, self.max_seconds)
+        else:
+            self._delay = min(self.min_seconds, self.max_seconds)
+        return self._delay
+
+    def reset(self):
+        self._delay = 0
+
+
+class ProcessorStats:
+    """
+    Time a processor loop spent working against time spent idle,
+    polls which found nothing and sleeps between them count as idle
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.working_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.busy_polls = 0
+        self.idle_polls = 0
+
+    def record_poll(self, seconds, busy):
+        with self._lock:
+            if busy:
+                self.working_seconds += seconds
+                self.busy_polls += 1
+            else:
+                self.idle_seconds += seconds
+                self.idle_polls += 1
+
+    def record_sleep(self, seconds):
+        with self._lock:
+            self.idle_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            total = self.working_seconds + self.idle_seconds
+            return {
+                'working_seconds': round(self.working_seconds, 3),
+                'idle_seconds': round(self.idle_seconds, 3),
+                'idle_ratio': round(self.idle_seconds / total, 3) if total else 0,
+                'busy_polls': self.busy_polls,
+                'idle_polls': self.idle_polls,
+            }
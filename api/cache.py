@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from libtrustbridge.websub.domain import Pattern
+from libtrustbridge.websub.repos import Subscription
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Thread-safe process-local LRU cache,
+    entries expire ttl seconds after they were set
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SubscriptionsCache:
+    """
+    Process-local cache of subscriptions by topic,
+    the subscriptions version marker is read at most once
+    per version_check_interval seconds and any change drops all entries
+    """
+
+    def __init__(self, subscriptions_repo, maxsize, ttl, version_check_interval):
+        self.subscriptions_repo = subscriptions_repo
+        self.version_check_interval = version_check_interval
+        self._items = TTLCache(maxsize, ttl)
+        self._version = None
+        self._version_checked_at = None
+
+    def get(self, topic):
+        self._check_version()
+        subscriptions = self._items.get(topic)
+        if subscriptions is None:
+            subscriptions = self.subscriptions_repo.get_subscriptions_by_pattern(Pattern(topic))
+            self._items.set(topic, subscriptions)
+        return subscriptions
+
+    def _check_version(self):
+        now = time.monotonic()
+        if self._version_checked_at is not None and now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        version = self.subscriptions_repo.get_version()
+        if version != self._version:
+            self._items.clear()
+            self._version = version
+
+
+class SubscriptionsIndex:
+    """
+    Process-local copy of the compiled subscriptions index, used like SubscriptionsCache
+
+    The snapshot is loaded with a single GET and reloaded every reload_interval seconds,
+    index deltas written since are listed and applied at most once per refresh_interval seconds.
+    Until the index is compiled subscriptions are read from the repo.
+    """
+
+    def __init__(self, subscriptions_repo, refresh_interval, reload_interval):
+        self.subscriptions_repo = subscriptions_repo
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self._topics = None
+        self._after = None
+        self._loaded_at = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def get(self, topic):
+        with self._lock:
+            self._refresh()
+            if self._topics is None:
+                return self.subscriptions_repo.get_subscriptions_by_pattern(Pattern(topic))
+            payloads = self._topics.get(Pattern(topic).to_key(), {})
+            return {Subscription(payload=payload, key=key) for key, payload in payloads.items()}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.reload_interval:
+            self._load()
+            self._loaded_at = now
+        elif now - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshed_at = now
+        if self._topics is not None:
+            self._apply_deltas()
+
+    def _load(self):
+        index = self.subscriptions_repo.get_index()
+        if index is None:
+            logger.warning("Subscriptions index is not compiled, reading subscriptions from the repo")
+            self._topics = None
+            return
+        self._topics = index['topics']
+        self._after = index['after']
+        logger.info("Loaded subscriptions index %s compiled at %s", index['version'], index['compiled_at'])
+
+    def _apply_deltas(self):
+        for key in self.subscriptions_repo.list_index_deltas(after=self._after):
+            delta = self.subscriptions_repo.get_index_delta(key)
+            for subscription_key, payload in delta.get('put', {}).items():
+                if payload is not None:
+                    self._topics.setdefault(self._get_topic_key(subscription_key), {})[subscription_key] = payload
+            for subscription_key in delta.get('delete', []):
+                self._topics.get(self._get_topic_key(subscription_key), {}).pop(subscription_key, None)
+            self._after = key
+
+    @staticmethod
+    def _get_topic_key(subscription_key):
+        return subscription_key.rsplit('/', 1)[0] + '/'
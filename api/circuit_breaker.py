@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# values of the circuit state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class HostCircuit:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker for callback delivery
+
+    After failure_threshold consecutive failures the host circuit opens
+    and allow() returns False for reset_seconds, then the circuit is
+    half-open and lets through up to half_open_probes requests at a time.
+    A successful probe closes the circuit, a failed one opens it again,
+    callers have to record an outcome for every allowed request,
+    otherwise the probe slot stays taken.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=60, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_probes = half_open_probes
+        self._circuits = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.short_circuited = 0
+
+    def allow(self, host):
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return True
+            if circuit.state == OPEN and time.monotonic() - circuit.opened_at >= self.reset_seconds:
+                self._set_state(host, circuit, HALF_OPEN)
+                circuit.probes = 0
+                logger.info("Circuit for %s is half-open", host)
+            if circuit.state == HALF_OPEN and circuit.probes < self.half_open_probes:
+                circuit.probes += 1
+                return True
+            self.short_circuited += 1
+            return False
+
+    def retry_after(self, host):
+        """
+        Seconds until the host circuit lets requests through again
+        """
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return 0
+            if circuit.state == HALF_OPEN:
+                # probes are in flight, their outcome decides
+                return self.reset_seconds
+            return max(self.reset_seconds - (time.monotonic() - circuit.opened_at), 0)
+
+    def record_success(self, host):
+        with self._lock:
+            circuit = self._circuits.pop(host, None)
+            if circuit is not None and circuit.state != CLOSED:
+                self._set_state(host, circuit, CLOSED)
+                logger.info("Circuit for %s is closed", host)
+
+    def record_failure(self, host):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, HostCircuit())
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or (
+                    circuit.state == CLOSED and circuit.failures >= self.failure_threshold):
+                self._set_state(host, circuit, OPEN)
+                circuit.opened_at = time.monotonic()
+                self.opened += 1
+                logger.warning("Circuit for %s is open after %s failures", host, circuit.failures)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'opened': self.opened,
+                'short_circuited': self.short_circuited,
+                'hosts': {host: circuit.state for host, circuit in self._circuits.items() if circuit.state != CLOSED},
+            }
+
+    @staticmethod
+    def _set_state(host, circuit, state):
+        circuit.state = state
+        metrics.CIRCUIT_STATE.labels(host).set(STATE_VALUES[state])
+        metrics.CIRCUIT_TRANSITIONS.labels(host, state).inc()
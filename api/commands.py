@@ -1,15 +1,28 @@
 import logging
+import signal
 import time
+from datetime import datetime
 
 from apispec.exceptions import OpenAPIError
 from apispec.utils import validate_spec
+from flask import current_app
 from flask_script import Command, Option
-from libtrustbridge.websub import repos
 from libtrustbridge.websub.processors import Processor
 
-from api import use_cases
+from api import metrics, use_cases
+from api.app import db
+from api.backoff import IdleBackoff, ProcessorStats
+from api.cache import SubscriptionsCache, SubscriptionsIndex
+from api.circuit_breaker import CircuitBreaker
+from api.http_client import create_http_session, http_stats
 from api.docs import spec
-from api.repos import ChannelRepo
+from api.listeners import MessageReceiverListener
+from api.models import is_postgresql
+from api.repos import (
+    ChannelRepo, DeadLetterRepo, DeliveryOutboxRepo, IntentVerificationRepo, NotificationsRepo,
+    create_subscriptions_repo
+)
+from api.supervisor import Supervisor
 
 logger = logging.getLogger(__name__)
 
@@ -42,72 +55,446 @@ class GenerateApiSpecCommand(Command):
 
 
 class RunProcessorCommand(Command):
+    """
+    Runs the processor loop, or several of them with --workers/--threads
+    under api.supervisor.Supervisor
+
+    When the use case finds no work the loop sleeps, backing off from
+    <CONFIG_PREFIX>_IDLE_MIN_SECONDS to <CONFIG_PREFIX>_IDLE_MAX_SECONDS,
+    unless the use case itself waited for work (long polling).
+    Time spent working and idle is logged every PROCESSOR_STATS_LOG_SECONDS.
+    Prometheus metrics are served on --metrics-port or PROCESSOR_METRICS_PORT,
+    worker N listens on that port + N.
+    """
+    # processors which must not run concurrently are pinned to a single worker
+    SINGLE_WORKER = False
+    CONFIG_PREFIX = None
 
     def __call__(self, app=None, *args, **kwargs):
         self.app = app
         return super().__call__(app, *args, **kwargs)
 
-    def run(self):
-        logger.info('Starting processor %s',self.__class__.__name__)
+    def get_options(self):
+        return (
+            Option('--workers', dest='workers', type=int, default=1,
+                   help='worker processes, crashed workers are restarted'),
+            Option('--threads', dest='threads', type=int, default=1,
+                   help='processor threads per worker process'),
+            Option('--metrics-port', dest='metrics_port', type=int, default=None,
+                   help='metrics listener port of the first worker (default PROCESSOR_METRICS_PORT)'),
+        )
+
+    def run(self, workers=1, threads=1, **options):
+        self.options = options
+        if (workers > 1 or threads > 1) and self.is_single_worker():
+            logger.warning('%s is pinned to a single worker, ignoring --workers/--threads', self.__class__.__name__)
+            workers = threads = 1
+
+        if workers == 1 and threads == 1:
+            signal.signal(signal.SIGTERM, self._handle_sigterm)
+            self.start_metrics_server()
+            self.run_processor()
+            return
+
+        # workers are forked, they must not share the database connections of this process
+        db.engine.dispose()
+        supervisor = Supervisor(
+            self.run_processor_in_context, workers=workers, threads=threads, name=self.__class__.__name__,
+            initializer=self.start_metrics_server,
+        )
+        supervisor.run()
+
+    def start_metrics_server(self, worker_index=0):
+        port = self.options.get('metrics_port') or self.app.config['PROCESSOR_METRICS_PORT']
+        if port:
+            metrics.start_metrics_server(int(port) + worker_index)
+
+    def is_single_worker(self):
+        return self.SINGLE_WORKER
+
+    def run_processor_in_context(self, stop_event):
+        with self.app.app_context():
+            self.run_processor(stop_event)
+
+    def run_processor(self, stop_event=None):
+        logger.info('Starting processor %s', self.__class__.__name__)
         processor = self.get_processor()
         logger.info('Run processor for use case "%s"', processor.use_case.__class__.__name__)
 
-        for result in processor:
-            if result is None:
-                time.sleep(1)
+        backoff = self.get_idle_backoff(processor)
+        stats = ProcessorStats()
+        stats_log_seconds = self.app.config['PROCESSOR_STATS_LOG_SECONDS']
+        logged_at = started = time.monotonic()
+        try:
+            for result in processor:
+                # like a request teardown, don't keep a transaction open between polls
+                db.session.remove()
+                now = time.monotonic()
+                stats.record_poll(now - started, busy=result is not None)
+                if stop_event is not None and stop_event.is_set():
+                    break
+                if backoff is None:
+                    pass
+                elif result is not None:
+                    backoff.reset()
+                else:
+                    delay = backoff.next_delay()
+                    if stop_event is not None:
+                        stop_event.wait(delay)
+                    else:
+                        time.sleep(delay)
+                    stats.record_sleep(delay)
+                if now - logged_at >= stats_log_seconds:
+                    logger.info('Processor %s time: %s', self.__class__.__name__, stats.snapshot())
+                    logged_at = now
+                started = time.monotonic()
+        finally:
+            logger.info('Processor %s time: %s', self.__class__.__name__, stats.snapshot())
+            self.on_shutdown(processor)
+
+    def get_idle_backoff(self, processor):
+        """
+        Backoff for polls which found no work, None if the use case waits for work itself
+        """
+        config = self.app.config
+        return IdleBackoff(
+            min_seconds=config[f'{self.CONFIG_PREFIX}_IDLE_MIN_SECONDS'],
+            max_seconds=config[f'{self.CONFIG_PREFIX}_IDLE_MAX_SECONDS'],
+        )
+
+    @staticmethod
+    def _handle_sigterm(signum, frame):
+        # let the processor loop unwind, so on_shutdown is called
+        raise SystemExit(0)
+
+    def on_shutdown(self, processor):
+        logger.info('Stopping processor %s', self.__class__.__name__)
 
     def get_processor(self):
         raise NotImplementedError
 
 
-class RunCallbackSpreaderProcessorCommand(RunProcessorCommand):
+class RunQueueProcessorCommand(RunProcessorCommand):
+    """
+    Processor reading an SQS queue, which is long-polled for
+    <CONFIG_PREFIX>_WAIT_SECONDS instead of sleeping when it is empty
+    """
+
+    def get_options(self):
+        return super().get_options() + (
+            Option('--wait-time', dest='wait_time', type=int, default=None,
+                   help='seconds to wait for jobs on each receive request, 0 disables long polling '
+                        f'(default {self.CONFIG_PREFIX}_WAIT_SECONDS)'),
+        )
+
+    def get_wait_seconds(self):
+        if self.options.get('wait_time') is not None:
+            return self.options['wait_time']
+        return self.app.config[f'{self.CONFIG_PREFIX}_WAIT_SECONDS']
+
+    def get_idle_backoff(self, processor):
+        if self.get_wait_seconds():
+            return None
+        return super().get_idle_backoff(processor)
+
+
+class RunCallbackSpreaderProcessorCommand(RunQueueProcessorCommand):
     """
     Convert each incoming message to set of messages containing (websub_url, message)
     so they may be sent and fail separately
     """
+    CONFIG_PREFIX = 'CALLBACK_SPREADER'
+
+    def get_options(self):
+        return super().get_options() + (
+            Option('--batch-size', dest='batch_size', type=int, default=None,
+                   help='notifications received per request, 1 disables batch mode '
+                        '(default CALLBACK_SPREADER_BATCH_SIZE)'),
+        )
 
     def get_processor(self):
         config = self.app.config
-        notifications_repo = repos.NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
-        delivery_outbox_repo = repos.DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
-        subscriptions_repo = repos.SubscriptionsRepo(config.get('SUBSCRIPTIONS_REPO_CONF'))
+        notifications_repo = NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
+        delivery_outbox_repo = DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
+        subscriptions_repo = create_subscriptions_repo(config)
+        if config['SUBSCRIPTIONS_INDEX_ENABLED'] and config['SUBSCRIPTIONS_REPO_BACKEND'] == 's3':
+            subscriptions_cache = SubscriptionsIndex(
+                subscriptions_repo,
+                refresh_interval=config['SUBSCRIPTIONS_INDEX_REFRESH_SECONDS'],
+                reload_interval=config['SUBSCRIPTIONS_INDEX_RELOAD_SECONDS'],
+            )
+        else:
+            subscriptions_cache = SubscriptionsCache(
+                subscriptions_repo,
+                maxsize=config['SUBSCRIPTIONS_CACHE_SIZE'],
+                ttl=config['SUBSCRIPTIONS_CACHE_TTL'],
+                version_check_interval=config['SUBSCRIPTIONS_CACHE_VERSION_CHECK_SECONDS'],
+            )
         use_case = use_cases.DispatchMessageToSubscribersUseCase(
             notifications_repo=notifications_repo,
             delivery_outbox_repo=delivery_outbox_repo,
             subscriptions_repo=subscriptions_repo,
+            subscriptions_cache=subscriptions_cache,
+            batch_size=self.options.get('batch_size') or config['CALLBACK_SPREADER_BATCH_SIZE'],
+            wait_seconds=self.get_wait_seconds(),
         )
         return Processor(use_case=use_case)
 
 
-class RunCallbackDeliveryProcessorCommand(RunProcessorCommand):
+class RunCallbackDeliveryProcessorCommand(RunQueueProcessorCommand):
     """
-    Iterate over the DeliverCallbackUseCase.
+    Iterate over the DeliverCallbackUseCase,
+    or AsyncDeliverCallbackUseCase in the async mode.
     """
+    MODES = ('sync', 'async')
+    CONFIG_PREFIX = 'CALLBACK_DELIVERY'
+
+    def get_options(self):
+        return super().get_options() + (
+            Option('--mode', dest='mode', choices=self.MODES, default=None,
+                   help='sync delivers one callback at a time, async delivers them concurrently '
+                        '(default CALLBACK_DELIVERY_MODE)'),
+        )
 
     def get_processor(self):
         config = self.app.config
-        delivery_outbox_repo = repos.DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
+        delivery_outbox_repo = DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
+        circuit_breaker = None
+        if config['CALLBACK_CIRCUIT_FAILURE_THRESHOLD']:
+            circuit_breaker = CircuitBreaker(
+                failure_threshold=config['CALLBACK_CIRCUIT_FAILURE_THRESHOLD'],
+                reset_seconds=config['CALLBACK_CIRCUIT_RESET_SECONDS'],
+                half_open_probes=config['CALLBACK_CIRCUIT_HALF_OPEN_PROBES'],
+            )
 
-        use_case = use_cases.DeliverCallbackUseCase(
-            delivery_outbox_repo=delivery_outbox_repo,
-            hub_url=config['HUB_URL'],
-        )
+        if (self.options.get('mode') or config['CALLBACK_DELIVERY_MODE']) == 'async':
+            use_case = use_cases.AsyncDeliverCallbackUseCase(
+                delivery_outbox_repo=delivery_outbox_repo,
+                hub_url=config['HUB_URL'],
+                max_concurrency=config['CALLBACK_DELIVERY_MAX_CONCURRENCY'],
+                max_per_host=config['CALLBACK_DELIVERY_MAX_PER_HOST'],
+                batch_size=config['CALLBACK_DELIVERY_BATCH_SIZE'],
+                wait_seconds=self.get_wait_seconds(),
+                connect_timeout=config['HTTP_CONNECT_TIMEOUT'],
+                read_timeout=config['HTTP_READ_TIMEOUT'],
+                circuit_breaker=circuit_breaker,
+                dead_letter_repo=DeadLetterRepo(),
+            )
+        else:
+            use_case = use_cases.DeliverCallbackUseCase(
+                delivery_outbox_repo=delivery_outbox_repo,
+                hub_url=config['HUB_URL'],
+                http_session=create_http_session(config),
+                circuit_breaker=circuit_breaker,
+                dead_letter_repo=DeadLetterRepo(),
+                wait_seconds=self.get_wait_seconds(),
+            )
         return Processor(use_case=use_case)
 
+    def on_shutdown(self, processor):
+        super().on_shutdown(processor)
+        if isinstance(processor.use_case, use_cases.AsyncDeliverCallbackUseCase):
+            processor.use_case.close()
+        logger.info('Callback HTTP requests: %s', http_stats.snapshot())
+        if processor.use_case.circuit_breaker is not None:
+            logger.info('Callback circuit breaker: %s', processor.use_case.circuit_breaker.snapshot())
+
 
 class RunNewMessagesObserverCommand(RunProcessorCommand):
     """
     Watch for new messages being sent to us and send notifications by jurisdiction
+
+    Concurrent observers would share the cursor and send notifications twice,
+    so it runs in a single worker unless MESSAGE_OBSERVER_SINGLE_WORKER is disabled.
     """
+    CONFIG_PREFIX = 'MESSAGE_OBSERVER'
+
+    def is_single_worker(self):
+        return self.app.config['MESSAGE_OBSERVER_SINGLE_WORKER']
 
     def get_processor(self):
         config = self.app.config
         channel_repo = ChannelRepo(config['CHANNEL_REPO_CONF'])
-        notifications_repo = repos.NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
+        notifications_repo = NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
+        listener = self.get_listener()
 
         use_case = use_cases.NewMessagesNotifyUseCase(
             receiver=config['JURISDICTION'],
             channel_repo=channel_repo,
             notifications_repo=notifications_repo,
+            chunk_size=config['MESSAGE_OBSERVER_CHUNK_SIZE'],
+            checkpoint_every=config['MESSAGE_OBSERVER_CHECKPOINT_EVERY'],
+            checkpoint_interval_ms=config['MESSAGE_OBSERVER_CHECKPOINT_INTERVAL_MS'],
+            listener=listener,
+            fallback_poll_seconds=config['MESSAGE_OBSERVER_FALLBACK_POLL_SECONDS'],
         )
         return Processor(use_case=use_case)
+
+    def get_idle_backoff(self, processor):
+        if processor.use_case.listener is not None:
+            # the use case waits for the listener
+            return None
+        return super().get_idle_backoff(processor)
+
+    def get_listener(self):
+        config = self.app.config
+        if not config['MESSAGE_OBSERVER_LISTEN']:
+            return
+        if not is_postgresql():
+            logger.warning('LISTEN/NOTIFY requires PostgreSQL, polling for new messages instead')
+            return
+        listener = MessageReceiverListener(config['JURISDICTION'], db.engine)
+        # start listening before the first query, so no notification is missed
+        listener.listen()
+        return listener
+
+    def on_shutdown(self, processor):
+        super().on_shutdown(processor)
+        processor.use_case.checkpoint()
+        if processor.use_case.listener is not None:
+            processor.use_case.listener.close()
+
+
+class RunNotificationsRelayCommand(RunProcessorCommand):
+    """
+    Move notifications from the database outbox to the notifications queue
+    """
+    CONFIG_PREFIX = 'NOTIFICATIONS_RELAY'
+
+    def get_processor(self):
+        config = self.app.config
+        notifications_repo = NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
+
+        use_case = use_cases.RelayNotificationsOutboxUseCase(
+            notifications_repo=notifications_repo,
+            batch_size=config['NOTIFICATIONS_RELAY_BATCH_SIZE'],
+        )
+        return Processor(use_case=use_case)
+
+
+class RunIntentVerificationCommand(RunQueueProcessorCommand):
+    """
+    Verify intent of queued subscription requests and subscribe or unsubscribe them
+    """
+    CONFIG_PREFIX = 'INTENT_VERIFICATION'
+
+    def get_processor(self):
+        config = self.app.config
+        use_case = use_cases.VerifyIntentUseCase(
+            verification_repo=IntentVerificationRepo(config['INTENT_VERIFICATION_REPO_CONF']),
+            subscriptions_repo=create_subscriptions_repo(config),
+            http_session=create_http_session(config, config['INTENT_VERIFICATION_MAX_CONCURRENCY']),
+            max_concurrency=config['INTENT_VERIFICATION_MAX_CONCURRENCY'],
+            batch_size=config['INTENT_VERIFICATION_BATCH_SIZE'],
+            wait_seconds=self.get_wait_seconds(),
+        )
+        return Processor(use_case=use_case)
+
+    def on_shutdown(self, processor):
+        super().on_shutdown(processor)
+        processor.use_case.close()
+
+
+def parse_datetime(value):
+    for datetime_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    raise ValueError(f'{value} is not a YYYY-MM-DD[THH:MM:SS] UTC datetime')
+
+
+class ReplayDeadLettersCommand(Command):
+    """
+    Send dead-lettered callbacks to the delivery outbox again
+    """
+
+    def get_options(self):
+        return (
+            Option('--callback-url', dest='callback_url', default=None,
+                   help='replay callbacks to this url only'),
+            Option('--since', dest='since', type=parse_datetime, default=None,
+                   help='replay callbacks failed at or after this UTC datetime, YYYY-MM-DD[THH:MM:SS]'),
+            Option('--until', dest='until', type=parse_datetime, default=None,
+                   help='replay callbacks failed before this UTC datetime, YYYY-MM-DD[THH:MM:SS]'),
+            Option('--batch-size', dest='batch_size', type=int, default=None,
+                   help='callbacks posted per batch (default DEAD_LETTER_REPLAY_BATCH_SIZE)'),
+            Option('--pause', dest='pause', type=float, default=None,
+                   help='seconds to wait between batches (default DEAD_LETTER_REPLAY_PAUSE_SECONDS)'),
+        )
+
+    def run(self, callback_url=None, since=None, until=None, batch_size=None, pause=None):
+        config = current_app.config
+        pause = config['DEAD_LETTER_REPLAY_PAUSE_SECONDS'] if pause is None else pause
+        use_case = use_cases.ReplayDeadLettersUseCase(
+            delivery_outbox_repo=DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF']),
+            callback_url=callback_url,
+            since=since,
+            until=until,
+            batch_size=batch_size or config['DEAD_LETTER_REPLAY_BATCH_SIZE'],
+        )
+        total = 0
+        replayed = use_case.execute()
+        while replayed:
+            total += replayed
+            time.sleep(pause)
+            replayed = use_case.execute()
+
+        print(f'Replayed {total} dead-lettered callbacks')
+
+
+class SweepSubscriptionsCommand(Command):
+    """
+    Delete subscriptions with expired leases from the subscriptions repo
+    """
+
+    def get_options(self):
+        return (
+            Option('--workers', dest='workers', type=int, default=None,
+                   help='subscriptions read in parallel (default SUBSCRIPTIONS_SWEEP_WORKERS)'),
+            Option('--dry-run', dest='dry_run', action='store_true', default=False,
+                   help='report expired subscriptions without deleting them'),
+        )
+
+    def run(self, workers=None, dry_run=False):
+        config = current_app.config
+        use_case = use_cases.SweepExpiredSubscriptionsUseCase(
+            subscriptions_repo=create_subscriptions_repo(config),
+            workers=workers or config['SUBSCRIPTIONS_SWEEP_WORKERS'],
+            dry_run=dry_run,
+        )
+        report = use_case.execute()
+        print(
+            f"Scanned {report['scanned']} subscriptions, {report['expired']} expired, "
+            f"{report['unreadable']} unreadable, {report['renewed']} renewed during the sweep; "
+            f"deleted {report['deleted']}, "
+            f"reclaimed {report['bytes_reclaimed']} bytes"
+        )
+
+
+class CompileSubscriptionsIndexCommand(Command):
+    """
+    Compile valid subscriptions into the index snapshot loaded by the callback spreader
+    """
+
+    def get_options(self):
+        return (
+            Option('--workers', dest='workers', type=int, default=None,
+                   help='subscriptions read in parallel (default SUBSCRIPTIONS_SWEEP_WORKERS)'),
+        )
+
+    def run(self, workers=None):
+        config = current_app.config
+        if config['SUBSCRIPTIONS_REPO_BACKEND'] != 's3':
+            print(f"Subscriptions index is not used with the {config['SUBSCRIPTIONS_REPO_BACKEND']} subscriptions repo")
+            return
+        use_case = use_cases.CompileSubscriptionsIndexUseCase(
+            subscriptions_repo=create_subscriptions_repo(config),
+            workers=workers or config['SUBSCRIPTIONS_SWEEP_WORKERS'],
+            delta_retention_seconds=config['SUBSCRIPTIONS_INDEX_DELTA_RETENTION_SECONDS'],
+        )
+        report = use_case.execute()
+        print(
+            f"Compiled {report['subscriptions']} of {report['scanned']} subscriptions "
+            f"to {report['topics']} topics, deleted {report['deltas_deleted']} index deltas"
+        )
@@ -4,6 +4,7 @@ from flask_env import MetaFlaskEnv
 from libtrustbridge.utils.conf import env_s3_config, env_queue_config
 
 from api.aws import string_or_b64kms
+from api.pool import get_engine_options
 
 
 class BaseConfig(metaclass=MetaFlaskEnv):
@@ -16,11 +17,117 @@ class BaseConfig(metaclass=MetaFlaskEnv):
     SQLALCHEMY_DATABASE_URI = environ.get('DATABASE_URI')
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # connection pool settings, see api.pool.get_engine_options
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    DB_STATEMENT_TIMEOUT_MS = 30000
+    # connect through PgBouncer in transaction pooling mode, connections are not pooled locally
+    # and there are no connection pool metrics; it can't be combined with MESSAGE_OBSERVER_LISTEN,
+    # LISTEN needs a session connection
+    DB_PGBOUNCER = False
+
     SENTRY_DSN = environ.get("SENTRY_DSN")
 
     # set it to https://shared.channel.gov.leg/ or whatever
     SERVICE_URL = environ.get("SERVICE_URL")
 
+    MESSAGES_BATCH_MAX_SIZE = 1000
+    # GET /messages page size, NDJSON responses are streamed in chunks of MESSAGES_STREAM_CHUNK_SIZE rows
+    MESSAGES_PAGE_SIZE = 100
+    MESSAGES_PAGE_MAX_SIZE = 1000
+    MESSAGES_STREAM_CHUNK_SIZE = 1000
+    # serialized messages cached by GET /messages/<id>, the cache is per process,
+    # a cached message is only served while its updated_at, read on every request, is unchanged
+    MESSAGE_CACHE_SIZE = 10000
+    MESSAGE_CACHE_TTL = 10
+    # rows fetched per page by the new messages observer
+    MESSAGE_OBSERVER_CHUNK_SIZE = 1000
+    # the observer cursor is saved every N notified messages or T milliseconds
+    MESSAGE_OBSERVER_CHECKPOINT_EVERY = 100
+    MESSAGE_OBSERVER_CHECKPOINT_INTERVAL_MS = 1000
+    # wait for PostgreSQL NOTIFY about new messages instead of polling every second,
+    # the database is still polled every MESSAGE_OBSERVER_FALLBACK_POLL_SECONDS
+    MESSAGE_OBSERVER_LISTEN = False
+    MESSAGE_OBSERVER_FALLBACK_POLL_SECONDS = 60
+    # --workers/--threads are ignored by run_message_observer, concurrent observers duplicate notifications
+    MESSAGE_OBSERVER_SINGLE_WORKER = True
+    # processors sleep between polls which found no work, from <PREFIX>_IDLE_MIN_SECONDS
+    # doubling up to <PREFIX>_IDLE_MAX_SECONDS, and poll again right after any work;
+    # queue processors long-poll for <PREFIX>_WAIT_SECONDS (at most 20) instead, 0 disables it.
+    # Time spent working and idle is logged every PROCESSOR_STATS_LOG_SECONDS
+    PROCESSOR_STATS_LOG_SECONDS = 300
+    # processor commands serve Prometheus metrics on this port, worker N of --workers on the port + N,
+    # unset disables the listener; the API serves them on /metrics
+    PROCESSOR_METRICS_PORT = None
+    MESSAGE_OBSERVER_IDLE_MIN_SECONDS = 0.05
+    MESSAGE_OBSERVER_IDLE_MAX_SECONDS = 2
+    NOTIFICATIONS_RELAY_IDLE_MIN_SECONDS = 0.05
+    NOTIFICATIONS_RELAY_IDLE_MAX_SECONDS = 2
+    CALLBACK_SPREADER_WAIT_SECONDS = 20
+    CALLBACK_SPREADER_IDLE_MIN_SECONDS = 0.1
+    CALLBACK_SPREADER_IDLE_MAX_SECONDS = 5
+    CALLBACK_DELIVERY_WAIT_SECONDS = 20
+    CALLBACK_DELIVERY_IDLE_MIN_SECONDS = 0.1
+    CALLBACK_DELIVERY_IDLE_MAX_SECONDS = 5
+    # notifications moved from the database outbox to the queue per transaction
+    NOTIFICATIONS_RELAY_BATCH_SIZE = 100
+    # where subscriptions are stored, "s3" (SUBSCRIPTIONS_REPO_CONF bucket) or "postgresql"
+    # (the subscription table of the service database, the compiled index isn't used then)
+    SUBSCRIPTIONS_REPO_BACKEND = 's3'
+    # subscriptions by topic cached by the callback spreader, entries are dropped after
+    # SUBSCRIPTIONS_CACHE_TTL seconds or when the subscriptions version marker changes
+    SUBSCRIPTIONS_CACHE_SIZE = 1000
+    SUBSCRIPTIONS_CACHE_TTL = 300
+    SUBSCRIPTIONS_CACHE_VERSION_CHECK_SECONDS = 5
+    # topics and jurisdictions accepted by POST /messages/subscriptions/bulk at once
+    SUBSCRIPTIONS_BATCH_MAX_SIZE = 1000
+    # subscriptions read in parallel by sweep_subscriptions and compile_subscriptions_index
+    SUBSCRIPTIONS_SWEEP_WORKERS = 8
+    # the callback spreader looks subscriptions up in the index compiled by compile_subscriptions_index
+    # instead of SUBSCRIPTIONS_CACHE; subscription changes are written as index deltas, applied every
+    # SUBSCRIPTIONS_INDEX_REFRESH_SECONDS, and kept for SUBSCRIPTIONS_INDEX_DELTA_RETENTION_SECONDS
+    # after the next compile, which must be longer than SUBSCRIPTIONS_INDEX_RELOAD_SECONDS
+    SUBSCRIPTIONS_INDEX_ENABLED = False
+    SUBSCRIPTIONS_INDEX_REFRESH_SECONDS = 5
+    SUBSCRIPTIONS_INDEX_RELOAD_SECONDS = 300
+    SUBSCRIPTIONS_INDEX_DELTA_RETENTION_SECONDS = 3600
+    # notifications received by the callback spreader per SQS request (at most 10, 1 disables batching)
+    CALLBACK_SPREADER_BATCH_SIZE = 10
+    # run_callback_delivery mode, "sync" or "async"; the async mode delivers
+    # up to CALLBACK_DELIVERY_MAX_CONCURRENCY callbacks at once, at most
+    # CALLBACK_DELIVERY_MAX_PER_HOST connections per callback host
+    CALLBACK_DELIVERY_MODE = 'sync'
+    CALLBACK_DELIVERY_MAX_CONCURRENCY = 100
+    CALLBACK_DELIVERY_MAX_PER_HOST = 10
+    CALLBACK_DELIVERY_BATCH_SIZE = 10
+    # outgoing HTTP requests to callbacks, keep-alive pools are kept for
+    # HTTP_POOL_CONNECTIONS hosts with up to HTTP_POOL_MAXSIZE connections each
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 30
+    HTTP_POOL_CONNECTIONS = 10
+    HTTP_POOL_MAXSIZE = 10
+    # callback host circuit opens after N consecutive connection errors, timeouts or 5xx responses
+    # (0 disables it), its jobs are parked for CALLBACK_CIRCUIT_RESET_SECONDS and then
+    # CALLBACK_CIRCUIT_HALF_OPEN_PROBES deliveries are let through to probe the host
+    CALLBACK_CIRCUIT_FAILURE_THRESHOLD = 5
+    CALLBACK_CIRCUIT_RESET_SECONDS = 60
+    CALLBACK_CIRCUIT_HALF_OPEN_PROBES = 1
+    # subscription requests are accepted right away and verified by run_intent_verification,
+    # up to INTENT_VERIFICATION_MAX_CONCURRENCY at a time; False verifies the intent before answering
+    INTENT_VERIFICATION_ASYNC = True
+    INTENT_VERIFICATION_MAX_CONCURRENCY = 10
+    INTENT_VERIFICATION_BATCH_SIZE = 10
+    INTENT_VERIFICATION_WAIT_SECONDS = 20
+    INTENT_VERIFICATION_IDLE_MIN_SECONDS = 0.1
+    INTENT_VERIFICATION_IDLE_MAX_SECONDS = 5
+    # replay_dead_letters posts N callbacks to the delivery outbox per batch, pausing between batches
+    DEAD_LETTER_REPLAY_BATCH_SIZE = 100
+    DEAD_LETTER_REPLAY_PAUSE_SECONDS = 1
+
     def __init__(self):
         if not hasattr(self, 'SUBSCRIPTIONS_REPO_CONF'):
             if not environ.get("IGL_SUBSCRIPTIONS_REPO_BUCKET") and environ.get('IGL_CHANNEL_REPO_BUCKET'):
@@ -33,8 +140,17 @@ class BaseConfig(metaclass=MetaFlaskEnv):
             self.NOTIFICATIONS_REPO_CONF = env_queue_config('NOTIFICATIONS_REPO')
         if not hasattr(self, 'DELIVERY_OUTBOX_REPO_CONF'):
             self.DELIVERY_OUTBOX_REPO_CONF = env_queue_config('DELIVERY_OUTBOX_REPO')
+        if not hasattr(self, 'INTENT_VERIFICATION_REPO_CONF'):
+            self.INTENT_VERIFICATION_REPO_CONF = env_queue_config('INTENT_VERIFICATION_REPO')
         if not hasattr(self, 'CHANNEL_REPO_CONF'):
             self.CHANNEL_REPO_CONF = env_s3_config('CHANNEL_REPO')
+        if not hasattr(self, 'SQLALCHEMY_ENGINE_OPTIONS'):
+            self.SQLALCHEMY_ENGINE_OPTIONS = get_engine_options(self)
+        if self.DB_PGBOUNCER and self.MESSAGE_OBSERVER_LISTEN:
+            raise ValueError(
+                'MESSAGE_OBSERVER_LISTEN requires session connections, '
+                'it does not work through PgBouncer in transaction pooling mode (DB_PGBOUNCER)'
+            )
 
 
 class ProductionConfig(BaseConfig):
@@ -59,6 +175,8 @@ class TestingConfig(BaseConfig):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     JURISDICTION = 'AU'
+    # the app is shared by tests, ids are reused after each test rollback
+    MESSAGE_CACHE_SIZE = 0
     SERVICE_URL = 'http://testing'
     test_minio = {
         'use_ssl': False,
@@ -87,3 +205,7 @@ class TestingConfig(BaseConfig):
 
     DELIVERY_OUTBOX_REPO_CONF = test_elastic.copy()
     DELIVERY_OUTBOX_REPO_CONF['queue_name'] = 'test-delivery-outbox'
+
+    INTENT_VERIFICATION_REPO_CONF = test_elastic.copy()
+    INTENT_VERIFICATION_REPO_CONF['queue_name'] = 'test-intent-verification'
+    INTENT_VERIFICATION_ASYNC = False
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HttpStats:
+    """
+    Outgoing HTTP counters of the process, also exported as Prometheus counters
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.timeouts = 0
+
+    def record_request(self):
+        metrics.HTTP_REQUESTS.inc()
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self):
+        metrics.HTTP_CONNECTIONS.inc()
+        with self._lock:
+            self.new_connections += 1
+
+    def record_timeout(self):
+        metrics.HTTP_TIMEOUTS.inc()
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': max(self.requests - self.new_connections, 0),
+                'timeouts': self.timeouts,
+            }
+
+
+http_stats = HttpStats()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        http_stats.record_new_connection()
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        http_stats.record_new_connection()
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    Keep-alive connection pools recording new connections into http_stats,
+    pool_maxsize connections are kept per host
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+class HttpSession(requests.Session):
+    """
+    requests session with keep-alive pools and (connect, read) timeouts
+    used unless the request passes its own timeout
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=30, pool_connections=10, pool_maxsize=10):
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        adapter = PooledHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        http_stats.record_request()
+        started = time.monotonic()
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.Timeout:
+            http_stats.record_timeout()
+            logger.warning("%s %s timed out", method, url)
+            raise
+        finally:
+            metrics.HTTP_REQUEST_SECONDS.observe(time.monotonic() - started)
+
+
+def create_http_session(config, max_concurrency=0):
+    """
+    Session for callbacks and intent verification configured by the HTTP_* settings,
+    it should be created once per process. Host pools keep at least max_concurrency
+    connections, so threads sharing the session don't run out of them
+    """
+    return HttpSession(
+        connect_timeout=config['HTTP_CONNECT_TIMEOUT'],
+        read_timeout=config['HTTP_READ_TIMEOUT'],
+        pool_connections=config['HTTP_POOL_CONNECTIONS'],
+        pool_maxsize=max(config['HTTP_POOL_MAXSIZE'], max_concurrency),
+    )
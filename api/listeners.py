@@ -0,0 +1,68 @@
+import logging
+import select
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageReceiverListener:
+    """
+    Wait for PostgreSQL notifications about new or updated messages.
+
+    The message table trigger (see migration 2b7e9f4c1a6d) sends
+    the message receiver as payload to the CHANNEL on every insert or update,
+    the listener only wakes up for notifications about its own receiver.
+    """
+    CHANNEL = 'message_receiver'
+
+    def __init__(self, receiver, engine):
+        self.receiver = receiver
+        self.engine = engine
+        self.connection = None
+
+    def listen(self):
+        if self.connection is not None:
+            return
+        pooled_connection = self.engine.raw_connection()
+        # dedicated connection, it is kept open and never returned to the pool
+        pooled_connection.detach()
+        connection = pooled_connection.connection
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.CHANNEL}')
+        self.connection = connection
+        logger.info('Listening to %s notifications for %s', self.CHANNEL, self.receiver)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def wait(self, timeout):
+        """
+        Block until the receiver is signalled or timeout seconds passed,
+        returns True if signalled.
+        Connection errors are reported as a signal, so the caller polls
+        and the connection is re-established by the next call.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            self.listen()
+            while not self._drain_notifies():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                select.select([self.connection], [], [], remaining)
+                self.connection.poll()
+        except self.engine.dialect.dbapi.Error as e:
+            logger.exception(e)
+            self.close()
+        return True
+
+    def _drain_notifies(self):
+        signalled = False
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            if notify.payload == self.receiver:
+                signalled = True
+        return signalled
@@ -0,0 +1,156 @@
+"""
+Prometheus metrics of the API and the processors
+
+The API serves them on /metrics, processor commands start a metrics
+HTTP listener on --metrics-port or PROCESSOR_METRICS_PORT,
+worker N of a supervised processor listens on that port + N.
+"""
+import logging
+import time
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest, start_http_server
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = Histogram(
+    'channel_request_seconds', 'API request latency by view', ['view', 'method', 'status']
+)
+DB_QUERY_SECONDS = Histogram(
+    'channel_db_query_seconds', 'Database query time by statement type', ['statement']
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'channel_db_pool_checked_out', 'Database connections checked out from the pool'
+)
+DB_POOL_OVERFLOW = Gauge(
+    'channel_db_pool_overflow', 'Database connections open above the pool size'
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    'channel_db_pool_wait_seconds', 'Time waited for a database connection from the pool'
+)
+DB_POOL_CHECKOUTS = Counter(
+    'channel_db_pool_checkouts_total', 'Database connections checked out from the pool'
+)
+DB_POOL_CONNECTIONS = Counter(
+    'channel_db_pool_connections_total', 'Database connections opened by the pool'
+)
+DB_POOL_TIMEOUTS = Counter(
+    'channel_db_pool_timeouts_total', 'Database connection checkouts timed out waiting for the pool'
+)
+QUEUE_REQUESTS = Counter(
+    'channel_queue_requests_total', 'Queue post and get calls, empty gets included', ['queue', 'operation']
+)
+QUEUE_JOBS = Counter(
+    'channel_queue_jobs_total', 'Jobs posted to and received from queues', ['queue', 'operation']
+)
+DISPATCH_FANOUT = Histogram(
+    'channel_dispatch_fanout', 'Callbacks a notification is dispatched to',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+DELIVERY_SECONDS = Histogram(
+    'channel_delivery_seconds', 'Callback delivery latency by callback host', ['host']
+)
+DELIVERIES = Counter(
+    'channel_deliveries_total', 'Callback deliveries by callback host and outcome', ['host', 'outcome']
+)
+DELIVERY_RETRIES = Counter(
+    'channel_delivery_retries_total', 'Callback delivery retries scheduled by callback host', ['host']
+)
+HTTP_REQUESTS = Counter(
+    'channel_http_requests_total', 'Outgoing HTTP requests of callback deliveries and intent verifications'
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'channel_http_request_seconds', 'Outgoing HTTP request latency of the sync HTTP session, timeouts included'
+)
+HTTP_CONNECTIONS = Counter(
+    'channel_http_connections_total', 'Outgoing HTTP connections opened, the other requests reused kept-alive ones'
+)
+HTTP_TIMEOUTS = Counter(
+    'channel_http_timeouts_total', 'Outgoing HTTP requests timed out'
+)
+CIRCUIT_STATE = Gauge(
+    'channel_circuit_state', 'Callback host circuit state, 0 closed, 1 half-open, 2 open', ['host']
+)
+CIRCUIT_TRANSITIONS = Counter(
+    'channel_circuit_transitions_total', 'Callback host circuit state changes by the new state', ['host', 'state']
+)
+OBSERVER_LAG_SECONDS = Gauge(
+    'channel_observer_lag_seconds', 'Now minus the new messages observer cursor, 0 when there are no new messages'
+)
+
+STATEMENT_TYPES = ('select', 'insert', 'update', 'delete')
+
+
+def init_app(app):
+    """
+    Time requests and database queries and serve /metrics
+    """
+    app.before_request(_start_request_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    if not event.contains(Engine, 'before_cursor_execute', _start_query_timer):
+        event.listen(Engine, 'before_cursor_execute', _start_query_timer)
+        event.listen(Engine, 'after_cursor_execute', _record_query)
+
+
+def metrics_view():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
+def _start_request_timer():
+    g.metrics_started = time.monotonic()
+
+
+def _record_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        REQUEST_SECONDS.labels(
+            request.endpoint or 'unmatched', request.method, response.status_code
+        ).observe(time.monotonic() - started)
+    return response
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_started'] = time.monotonic()
+
+
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_started', None)
+    if started is None:
+        return
+    words = statement.split(None, 1)
+    statement_type = words[0].lower() if words else 'other'
+    if statement_type not in STATEMENT_TYPES:
+        statement_type = 'other'
+    DB_QUERY_SECONDS.labels(statement_type).observe(time.monotonic() - started)
+
+
+def record_queue_post(queue, jobs):
+    QUEUE_REQUESTS.labels(queue, 'post').inc()
+    QUEUE_JOBS.labels(queue, 'post').inc(jobs)
+
+
+def record_queue_get(queue, jobs):
+    QUEUE_REQUESTS.labels(queue, 'get').inc()
+    QUEUE_JOBS.labels(queue, 'get').inc(jobs)
+
+
+def record_delivery(host, outcome, seconds=None):
+    DELIVERIES.labels(host, outcome).inc()
+    if seconds is not None:
+        DELIVERY_SECONDS.labels(host).observe(seconds)
+
+
+def start_metrics_server(port):
+    """
+    Serve metrics of this process from a daemon thread,
+    a port in use is logged and the process runs without the listener
+    """
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.warning("Can't start metrics listener on port %s: %s", port, e)
+        return
+    logger.info("Metrics listener started on port %s", port)
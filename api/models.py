@@ -1,6 +1,8 @@
 import enum
 from datetime import datetime
 
+from sqlalchemy import and_, or_
+
 from api.app import db
 
 
@@ -11,7 +13,24 @@ class MessageStatus(enum.Enum):
     UNDELIVERABLE = 'undeliverable'
 
 
+def payload_field_default(field):
+    """
+    Column default copying the field value out of the inserted payload,
+    on PostgreSQL the message_copy_participants trigger sets the column
+    for every writer of the table, the default covers other databases
+    """
+    def default(context):
+        payload = context.get_current_parameters().get('payload') or {}
+        return payload.get(field)
+    return default
+
+
 class Message(db.Model):
+    __table_args__ = (
+        # used by the new messages observer, see NewMessagesNotifyUseCase.get_new_messages
+        db.Index('ix_message_receiver_updated_at_id', 'receiver', 'updated_at', 'id'),
+    )
+
     created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.utcnow())
     updated_at = db.Column(
         db.DateTime, nullable=False, default=lambda: datetime.utcnow(), onupdate=lambda: datetime.utcnow()
@@ -21,6 +40,91 @@ class Message(db.Model):
         default=MessageStatus.CONFIRMED)
     id = db.Column(db.Integer, primary_key=True)
     payload = db.Column(db.JSON)
+    # denormalized from payload so they can be indexed, kept in sync by a trigger on PostgreSQL
+    sender = db.Column(db.String, default=payload_field_default('sender'), index=True)
+    receiver = db.Column(db.String, default=payload_field_default('receiver'))
 
     def __repr__(self):
         return f'<Message id:{self.id}>'
+
+    @classmethod
+    def after_cursor(cls, updated_at, id=None):
+        """
+        Filter messages following the (updated_at, id) cursor in cursor_order,
+        if id is not given all messages updated at updated_at are skipped
+        """
+        if id is None:
+            return cls.updated_at > updated_at
+        return or_(cls.updated_at > updated_at, and_(cls.updated_at == updated_at, cls.id > id))
+
+    @classmethod
+    def cursor_order(cls):
+        return cls.updated_at.asc(), cls.id.asc()
+
+
+class NotificationOutbox(db.Model):
+    """
+    Notification jobs written in the same transaction as the message change,
+    relayed to the notifications queue by RelayNotificationsOutboxUseCase
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.utcnow())
+    payload = db.Column(db.JSON, nullable=False)
+
+    def __repr__(self):
+        return f'<NotificationOutbox id:{self.id}>'
+
+
+class DeliveryDeadLetter(db.Model):
+    """
+    Callback jobs failed MAX_ATTEMPTS times,
+    sent again by ReplayDeadLettersUseCase
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.utcnow(), index=True)
+    callback_url = db.Column(db.String, nullable=False, index=True)
+    payload = db.Column(db.JSON, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<DeliveryDeadLetter id:{self.id} callback_url:{self.callback_url}>'
+
+
+class Subscription(db.Model):
+    """
+    WebSub subscription stored by api.repos.DbSubscriptionsRepo,
+    key is the libtrustbridge subscription key, topic the pattern key without the url hash
+    """
+    __table_args__ = (
+        # subscriptions of a topic with unexpired leases, see DbSubscriptionsRepo.get_subscriptions_by_pattern
+        db.Index('ix_subscription_topic_expires_at', 'topic', 'expires_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String, nullable=False, unique=True)
+    topic = db.Column(db.String, nullable=False)
+    callback_url = db.Column(db.String, nullable=False)
+    expires_at = db.Column(db.DateTime, index=True)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=lambda: datetime.utcnow(), onupdate=lambda: datetime.utcnow()
+    )
+
+    def __repr__(self):
+        return f'<Subscription id:{self.id} topic:{self.topic} callback_url:{self.callback_url}>'
+
+
+class SubscriptionsVersion(db.Model):
+    """
+    Single row version marker of DbSubscriptionsRepo, changed with every subscription change
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.String, nullable=False)
+
+
+def is_postgresql():
+    """
+    Multi-row RETURNING statements and locking clauses are only used on PostgreSQL,
+    other backends (sqlite in tests) fall back to plain ORM operations
+    """
+    return db.engine.dialect.name == 'postgresql'
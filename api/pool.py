@@ -0,0 +1,72 @@
+import logging
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool exporting checkout wait time, checked out and overflow connections
+    to api.metrics, waits longer than SLOW_CHECKOUT_SECONDS are logged
+    """
+    SLOW_CHECKOUT_SECONDS = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # a process has one pool, dispose() replaces it with a new instance
+        metrics.DB_POOL_CHECKED_OUT.set_function(self.checkedout)
+        metrics.DB_POOL_OVERFLOW.set_function(lambda: max(self.overflow(), 0))
+
+    def connect(self):
+        started_at = time.monotonic()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            metrics.DB_POOL_TIMEOUTS.inc()
+            logger.warning("Database connection pool timeout, %s", self.status())
+            raise
+        wait_seconds = time.monotonic() - started_at
+        metrics.DB_POOL_WAIT_SECONDS.observe(wait_seconds)
+        if wait_seconds >= self.SLOW_CHECKOUT_SECONDS:
+            logger.warning("Waited %.3fs for a database connection, %s", wait_seconds, self.status())
+        return connection
+
+
+@event.listens_for(InstrumentedQueuePool, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.DB_POOL_CHECKOUTS.inc()
+
+
+@event.listens_for(InstrumentedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    metrics.DB_POOL_CONNECTIONS.inc()
+
+
+def get_engine_options(config):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for the config DB_* settings, PostgreSQL only
+    """
+    if not (config.SQLALCHEMY_DATABASE_URI or '').startswith('postgresql'):
+        return {}
+    if config.DB_PGBOUNCER:
+        # PgBouncer pools the server connections, keeping idle client connections only wastes its slots.
+        # It rejects the "options" startup parameter, so statement timeout must be set for the database role.
+        # Connection pool metrics are not collected then, see PgBouncer SHOW POOLS instead
+        return {'poolclass': NullPool}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.DB_POOL_SIZE,
+        'max_overflow': config.DB_MAX_OVERFLOW,
+        'pool_timeout': config.DB_POOL_TIMEOUT,
+        'pool_recycle': config.DB_POOL_RECYCLE,
+        'pool_pre_ping': config.DB_POOL_PRE_PING,
+    }
+    if config.DB_STATEMENT_TIMEOUT_MS:
+        options['connect_args'] = {'options': f'-c statement_timeout={config.DB_STATEMENT_TIMEOUT_MS}'}
+    return options
@@ -1,5 +1,411 @@
+import concurrent.futures
+import gzip
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+
+from libtrustbridge.repos.elasticmqrepo import ElasticMQRepo
 from libtrustbridge.repos.miniorepo import MinioRepo
+from botocore.exceptions import ClientError
+from libtrustbridge.websub import repos
+from sqlalchemy import or_
+from sqlalchemy.dialects import postgresql
+
+from api import metrics, models
+from api.app import db
+
+logger = logging.getLogger(__name__)
 
 
 class ChannelRepo(MinioRepo):
     DEFAULT_BUCKET = 'channel'
+
+
+class BatchQueueMixin:
+    """
+    SQS batch operations for libtrustbridge queue repos,
+    each call handles up to MAX_BATCH_SIZE jobs in one round trip.
+
+    Posted and received jobs are counted in api.metrics.
+    """
+    MAX_BATCH_SIZE = 10
+
+    def post_job(self, payload, *args, **kwargs):
+        result = super().post_job(payload, *args, **kwargs)
+        metrics.record_queue_post(self._get_queue_name(), 1)
+        return result
+
+    def get_job(self):
+        job = super().get_job()
+        metrics.record_queue_get(self._get_queue_name(), 1 if job else 0)
+        return job
+
+    def post_jobs(self, payloads, delay_seconds=0):
+        payloads = list(payloads)
+        for start in range(0, len(payloads), self.MAX_BATCH_SIZE):
+            chunk = payloads[start:start + self.MAX_BATCH_SIZE]
+            entries = [
+                {'Id': str(i), 'MessageBody': json.dumps(payload), 'DelaySeconds': delay_seconds}
+                for i, payload in enumerate(chunk)
+            ]
+            response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed = response.get('Failed', [])
+            metrics.record_queue_post(self._get_queue_name(), len(chunk) - len(failed))
+            # entries rejected by the batch call are re-sent one by one
+            for entry in failed:
+                self.post_job(chunk[int(entry['Id'])], delay_seconds=delay_seconds)
+
+    def get_jobs(self, max_number=MAX_BATCH_SIZE, wait_seconds=0):
+        """
+        Receive up to max_number jobs in one call, waiting up to wait_seconds
+        for the first one, returns list of (id, payload) like get_job
+        """
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_number, self.MAX_BATCH_SIZE),
+            WaitTimeSeconds=wait_seconds,
+        )
+        jobs = [(msg['ReceiptHandle'], json.loads(msg['Body'])) for msg in response.get('Messages', [])]
+        metrics.record_queue_get(self._get_queue_name(), len(jobs))
+        return jobs
+
+    def delete_jobs(self, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), self.MAX_BATCH_SIZE):
+            chunk = ids[start:start + self.MAX_BATCH_SIZE]
+            entries = [{'Id': str(i), 'ReceiptHandle': id} for i, id in enumerate(chunk)]
+            response = self.sqs_client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            for failed in response.get('Failed', []):
+                self.delete(chunk[int(failed['Id'])])
+
+
+class NotificationsRepo(BatchQueueMixin, repos.NotificationsRepo):
+    pass
+
+
+class DeliveryOutboxRepo(BatchQueueMixin, repos.DeliveryOutboxRepo):
+    pass
+
+
+class IntentVerificationRepo(BatchQueueMixin, ElasticMQRepo):
+    """
+    Subscription requests waiting for the subscriber's intent verification
+    """
+
+    def _get_queue_name(self):
+        return 'intent-verification'
+
+
+class SubscriptionsRepo(repos.SubscriptionsRepo):
+    """
+    Every change of subscriptions writes a new version marker,
+    processes caching subscriptions compare it to drop stale entries.
+
+    With index_deltas every change also writes a delta object
+    {'put': {key: payload}} or {'delete': [keys]} applied by
+    api.cache.SubscriptionsIndex on top of the compiled index snapshot.
+    Delta keys start with the microseconds timestamp, so they are listed in order.
+    """
+    VERSION_KEY = '_meta/subscriptions_version'
+    INDEX_KEY = '_meta/subscriptions_index.json.gz'
+    INDEX_DELTAS_PREFIX = '_meta/subscriptions_index_deltas/'
+
+    def __init__(self, *args, index_deltas=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index_deltas = index_deltas
+
+    def subscribe_by_pattern(self, pattern, url, *args, **kwargs):
+        result = super().subscribe_by_pattern(pattern, url, *args, **kwargs)
+        self.bump_version()
+        if self.index_deltas:
+            key = pattern.to_key(url)
+            self.write_index_delta({'put': {key: self._read_payload(key)}})
+        return result
+
+    def bulk_delete(self, keys, *args, **kwargs):
+        keys = list(keys)
+        result = super().bulk_delete(keys, *args, **kwargs)
+        self.bump_version()
+        if self.index_deltas:
+            self.write_index_delta({'delete': keys})
+        return result
+
+    def bulk_subscribe(self, patterns, url, expiration_seconds=None, workers=8):
+        """
+        Subscribe url to all the patterns, objects are written by `workers` threads
+        as S3 has no batch write, the version marker is written once.
+        Only the written subscriptions bump the version and go to the index delta,
+        the first write error is raised after that
+        """
+        patterns = list(patterns)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._subscribe, pattern, url, expiration_seconds) for pattern in patterns]
+        written = dict(future.result() for future in futures if not future.exception())
+        if written:
+            self.bump_version()
+            if self.index_deltas:
+                self.write_index_delta({'put': written})
+        for future in futures:
+            if future.exception():
+                raise future.exception()
+
+    def _subscribe(self, pattern, url, expiration_seconds=None):
+        """
+        Write the subscription with libtrustbridge, returns (key, payload),
+        the payload is only read back for the index delta
+        """
+        super().subscribe_by_pattern(pattern, url, expiration_seconds)
+        key = pattern.to_key(url)
+        return key, self._read_payload(key) if self.index_deltas else None
+
+    def bump_version(self):
+        self.put_object(clean_path=self.VERSION_KEY, content_body=str(uuid.uuid4()))
+
+    def get_version(self):
+        try:
+            return self.get_object_content(self.VERSION_KEY).decode()
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def iter_subscription_payloads(self, workers=8):
+        """
+        Yield (key, size, payload) of all subscriptions page by page,
+        objects of a page are read by `workers` threads, payload is None if it can't be read
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for page in paginator.paginate(Bucket=self.bucket):
+                objects = [
+                    (obj['Key'], obj.get('Size', 0)) for obj in page.get('Contents', [])
+                    if obj['Key'].endswith('.json') and not obj['Key'].startswith('_meta/')
+                ]
+                payloads = executor.map(lambda obj: self._read_payload(obj[0]), objects)
+                for (key, size), payload in zip(objects, payloads):
+                    yield key, size, payload
+
+    def get_subscription_payloads(self, keys, workers=8):
+        """
+        {key: payload} of the subscriptions read by `workers` threads,
+        payload is None if it can't be read or the subscription is deleted
+        """
+        keys = list(keys)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(keys, executor.map(self._read_payload, keys)))
+
+    def _read_payload(self, key):
+        try:
+            return json.loads(self.get_object_content(key))
+        except Exception as e:
+            logger.warning("Can't read subscription %s: %s", key, e)
+
+    def put_index(self, index):
+        self.put_object(clean_path=self.INDEX_KEY, content_body=gzip.compress(json.dumps(index).encode()))
+
+    def get_index(self):
+        """
+        Compiled index snapshot, None if it was never compiled
+        """
+        try:
+            return json.loads(gzip.decompress(self.get_object_content(self.INDEX_KEY)))
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def write_index_delta(self, delta):
+        key = f'{self.INDEX_DELTAS_PREFIX}{int(time.time() * 1000000):020d}-{uuid.uuid4()}.json'
+        self.put_object(clean_path=key, content_body=json.dumps(delta))
+
+    def list_index_deltas(self, after=None):
+        """
+        Keys of the deltas written after the `after` delta key, in order
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket, Prefix=self.INDEX_DELTAS_PREFIX, StartAfter=after or '')
+        return [obj['Key'] for page in pages for obj in page.get('Contents', [])]
+
+    def get_index_delta(self, key):
+        return json.loads(self.get_object_content(key))
+
+    def delete_index_deltas(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]}
+            )
+
+    @classmethod
+    def get_index_delta_time(cls, key):
+        """
+        Unix time the delta was written at
+        """
+        return int(key[len(cls.INDEX_DELTAS_PREFIX):].split('-', 1)[0]) / 1000000
+
+
+class DbSubscriptionsRepo:
+    """
+    SubscriptionsRepo storing subscriptions in the database,
+    a topic lookup is a single query on the (topic, expires_at) index
+    returning subscriptions with unexpired leases only.
+    Keys and payloads are the same as the S3 repo ones.
+
+    Every change commits the current database session, reads leave
+    the transaction to the caller, processors end it after every poll.
+    """
+    PAGE_SIZE = 1000
+
+    def subscribe_by_pattern(self, pattern, url, expiration_seconds=None):
+        self._upsert([self._get_row(pattern, url, expiration_seconds)])
+        self.bump_version()
+        db.session.commit()
+
+    def bulk_subscribe(self, patterns, url, expiration_seconds=None, workers=None):
+        """
+        Subscribe url to all the patterns in one statement,
+        workers is accepted for compatibility with SubscriptionsRepo
+        """
+        rows = [self._get_row(pattern, url, expiration_seconds) for pattern in patterns]
+        if rows:
+            self._upsert(rows)
+        self.bump_version()
+        db.session.commit()
+
+    def get_subscriptions_by_pattern(self, pattern):
+        Subscription = models.Subscription
+        rows = db.session.query(Subscription.key, Subscription.callback_url, Subscription.expires_at).filter(
+            Subscription.topic == pattern.to_key(),
+            or_(Subscription.expires_at.is_(None), Subscription.expires_at > datetime.utcnow()),
+        ).all()
+        return {repos.Subscription(payload=self._get_payload(row), key=row.key) for row in rows}
+
+    def bulk_delete(self, keys):
+        Subscription = models.Subscription
+        keys = list(keys)
+        for start in range(0, len(keys), self.PAGE_SIZE):
+            db.session.query(Subscription).filter(
+                Subscription.key.in_(keys[start:start + self.PAGE_SIZE])
+            ).delete(synchronize_session=False)
+        self.bump_version()
+        db.session.commit()
+
+    def bump_version(self):
+        Version = models.SubscriptionsVersion
+        version = str(uuid.uuid4())
+        # the row is created by the migration, databases created by create_all start without it
+        if not db.session.query(Version).filter(Version.id == 1).update({'version': version}):
+            db.session.add(Version(id=1, version=version))
+
+    def get_version(self):
+        Version = models.SubscriptionsVersion
+        return db.session.query(Version.version).filter(Version.id == 1).scalar()
+
+    def iter_subscription_payloads(self, workers=None):
+        """
+        Yield (key, size, payload) of all subscriptions like SubscriptionsRepo,
+        pages of PAGE_SIZE rows are read in key order, size is always 0
+        """
+        Subscription = models.Subscription
+        after = ''
+        while True:
+            rows = db.session.query(Subscription.key, Subscription.callback_url, Subscription.expires_at).filter(
+                Subscription.key > after
+            ).order_by(Subscription.key.asc()).limit(self.PAGE_SIZE).all()
+            for row in rows:
+                yield row.key, 0, self._get_payload(row)
+            if len(rows) < self.PAGE_SIZE:
+                return
+            after = rows[-1].key
+
+    def get_subscription_payloads(self, keys, workers=None):
+        """
+        {key: payload} of the subscriptions like SubscriptionsRepo, None for deleted ones
+        """
+        Subscription = models.Subscription
+        keys = list(keys)
+        payloads = dict.fromkeys(keys)
+        for start in range(0, len(keys), self.PAGE_SIZE):
+            rows = db.session.query(Subscription.key, Subscription.callback_url, Subscription.expires_at).filter(
+                Subscription.key.in_(keys[start:start + self.PAGE_SIZE])
+            ).all()
+            payloads.update((row.key, self._get_payload(row)) for row in rows)
+        return payloads
+
+    def _upsert(self, rows):
+        Subscription = models.Subscription
+        # a statement can't insert or update the same key twice, the last row wins
+        rows = list({row['key']: row for row in rows}.values())
+        if models.is_postgresql():
+            statement = postgresql.insert(Subscription.__table__).values(rows)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=['key'],
+                set_={
+                    'expires_at': statement.excluded.expires_at,
+                    'updated_at': statement.excluded.updated_at,
+                },
+            ))
+            return
+        db.session.query(Subscription).filter(
+            Subscription.key.in_([row['key'] for row in rows])
+        ).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Subscription, rows)
+
+    @staticmethod
+    def _get_row(pattern, url, expiration_seconds):
+        return {
+            'key': pattern.to_key(url),
+            'topic': pattern.to_key(),
+            'callback_url': url,
+            'expires_at': datetime.utcfromtimestamp(time.time() + expiration_seconds) if expiration_seconds else None,
+            'updated_at': datetime.utcnow(),
+        }
+
+    @staticmethod
+    def _get_payload(row):
+        expires_at = row.expires_at
+        return {
+            'c': row.callback_url,
+            'e': int((expires_at - datetime(1970, 1, 1)).total_seconds()) if expires_at else None,
+        }
+
+
+def create_subscriptions_repo(config):
+    """
+    Subscriptions repo of the SUBSCRIPTIONS_REPO_BACKEND,
+    the S3 one writes index deltas if SUBSCRIPTIONS_INDEX_ENABLED
+    """
+    if config.get('SUBSCRIPTIONS_REPO_BACKEND') == 'postgresql':
+        return DbSubscriptionsRepo()
+    return SubscriptionsRepo(
+        config.get('SUBSCRIPTIONS_REPO_CONF'), index_deltas=config.get('SUBSCRIPTIONS_INDEX_ENABLED', False)
+    )
+
+
+class NotificationsOutboxRepo:
+    """
+    NotificationsRepo replacement for the API: jobs are added to the current
+    database session and committed together with the message change,
+    RelayNotificationsOutboxUseCase moves them to the notifications queue
+    """
+
+    def post_job(self, payload):
+        db.session.add(models.NotificationOutbox(payload=payload))
+
+    def post_jobs(self, payloads):
+        db.session.bulk_insert_mappings(models.NotificationOutbox, [{'payload': payload} for payload in payloads])
+
+
+class DeadLetterRepo:
+    """
+    Callback jobs failed all delivery attempts are stored in the database
+    to be replayed after the subscriber is back
+    """
+
+    def save(self, job, attempts, reason):
+        db.session.add(models.DeliveryDeadLetter(
+            callback_url=job['s'], payload=job['payload'], attempts=attempts, reason=reason
+        ))
+        db.session.commit()
@@ -1,4 +1,8 @@
-from marshmallow import fields, post_load
+import base64
+import json
+from datetime import datetime
+
+from marshmallow import ValidationError, fields, post_load, validate, validates_schema
 from marshmallow_enum import EnumField
 
 from api import models
@@ -14,6 +18,28 @@ def dump_only_fields(data: dict, fields: list):
     return {k: v for k, v in data.items() if k in fields}
 
 
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(updated_at: datetime, id: int):
+    """
+    Opaque pagination cursor pointing at the (updated_at, id) of the last returned message
+    """
+    data = json.dumps([updated_at.strftime(CURSOR_TIMESTAMP_FORMAT), id])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Returns (updated_at, id) tuple, raises ValueError if the cursor is malformed
+    """
+    try:
+        updated_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.strptime(updated_at, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
 class MessagePayloadSchema(ma.Schema):
     sender = fields.String(required=True)
     receiver = fields.String(required=True)
@@ -48,3 +74,21 @@ class StatusUpdateSchema(ma.SQLAlchemySchema):
     def make_message(self, data, **kwargs):
         self.instance.status = data['status']
         return self.instance
+
+
+class BulkStatusUpdateSchema(ma.Schema):
+    id = fields.Integer(required=True)
+    status = EnumField(models.MessageStatus, by_value=True, required=True)
+
+
+class BulkSubscriptionSchema(ma.Schema):
+    callback = fields.Url(required=True)
+    mode = fields.String(required=True, validate=validate.OneOf(['subscribe', 'unsubscribe']))
+    topics = fields.List(fields.String(validate=validate.Length(min=1)), missing=list)
+    jurisdictions = fields.List(fields.String(validate=validate.Length(min=1)), missing=list)
+    lease_seconds = fields.Integer(missing=432000, validate=validate.Range(min=1))
+
+    @validates_schema
+    def validate_topics(self, data, **kwargs):
+        if not data.get('topics') and not data.get('jurisdictions'):
+            raise ValidationError('At least one topic or jurisdiction is required.', 'topics')
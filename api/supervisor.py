@@ -0,0 +1,149 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Runs target(stop_event) in `threads` threads of each of `workers` processes
+
+    Worker processes are forked, so they share nothing opened after the fork.
+    A worker exits when any of its threads crashes and the supervisor starts
+    a new one, waiting longer after each crash in a row.
+    SIGTERM or SIGINT sets stop_event in all workers, targets should return soon after it,
+    workers still running after shutdown_timeout seconds are killed.
+    initializer(index) is called in each worker process before its threads start.
+    """
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    SHUTDOWN_TIMEOUT = 30
+
+    def __init__(
+            self, target, workers=1, threads=1, name='worker', shutdown_timeout=SHUTDOWN_TIMEOUT, initializer=None):
+        self.target = target
+        self.initializer = initializer
+        self.workers = workers
+        self.threads = threads
+        self.name = name
+        self.shutdown_timeout = shutdown_timeout
+        self._processes = {}
+        self._crashes = {}
+        self._stopping = False
+        # serializes restarts with _stop_all, so no worker is started after the last one was stopped
+        self._lock = threading.Lock()
+        self._restart_timers = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        logger.info('Starting %s %s worker(s) with %s thread(s)', self.workers, self.name, self.threads)
+        for index in range(self.workers):
+            self._start(index)
+        try:
+            while not self._stopping:
+                for index, process in list(self._processes.items()):
+                    if process is not None and not process.is_alive():
+                        self._on_exit(index, process)
+                time.sleep(0.5)
+        finally:
+            self._stop_all()
+
+    def _start(self, index):
+        process = multiprocessing.Process(
+            target=self._worker_main, name=f'{self.name}-{index}', args=(index,), daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info('Started %s (pid %s)', process.name, process.pid)
+
+    def _on_exit(self, index, process):
+        crashes = self._crashes.get(index, 0) + 1
+        self._crashes[index] = crashes
+        delay = min(self.RESTART_DELAY * 2 ** (crashes - 1), self.MAX_RESTART_DELAY)
+        logger.error('%s (pid %s) exited with code %s, restarting in %ss',
+                     process.name, process.pid, process.exitcode, delay)
+        self._processes[index] = None
+        restart = threading.Timer(delay, self._restart, args=(index,))
+        restart.daemon = True
+        with self._lock:
+            if self._stopping:
+                return
+            self._restart_timers[index] = restart
+            restart.start()
+
+    def _restart(self, index):
+        with self._lock:
+            self._restart_timers.pop(index, None)
+            if self._stopping:
+                return
+            self._start(index)
+            started = self._processes[index]
+        # a worker running for a while is healthy again
+        reset = threading.Timer(self.MAX_RESTART_DELAY, self._reset_crashes, args=(index, started))
+        reset.daemon = True
+        reset.start()
+
+    def _reset_crashes(self, index, process):
+        if process.is_alive():
+            self._crashes[index] = 0
+
+    def _handle_stop(self, signum, frame):
+        if not self._stopping:
+            logger.info('Stopping %s workers', self.name)
+        self._stopping = True
+
+    def _stop_all(self):
+        with self._lock:
+            self._stopping = True
+            for restart in self._restart_timers.values():
+                restart.cancel()
+            self._restart_timers.clear()
+            processes = [process for process in self._processes.values() if process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning('%s (pid %s) did not stop in time, killing it', process.name, process.pid)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+    def _worker_main(self, index):
+        stop_event = threading.Event()
+        # the supervisor stops workers with SIGTERM, also on Ctrl-C sent to the whole process group
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.initializer is not None:
+            self.initializer(index)
+        crashed = threading.Event()
+
+        def run_thread():
+            try:
+                self.target(stop_event)
+            except Exception:
+                logger.exception('%s thread crashed', threading.current_thread().name)
+                crashed.set()
+                stop_event.set()
+
+        threads = [
+            threading.Thread(target=run_thread, name=f'{self.name}-{index}-{thread_index}', daemon=True)
+            for thread_index in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            # a short timeout keeps the main thread responsive to signals
+            stop_event.wait(0.5)
+            if stop_event.is_set():
+                break
+        deadline = time.monotonic() + self.shutdown_timeout
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        os._exit(1 if crashed.is_set() else 0)
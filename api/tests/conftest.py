@@ -6,7 +6,7 @@ from libtrustbridge.websub.repos import SubscriptionsRepo, NotificationsRepo
 from api.app import create_app, db
 from api.conf import TestingConfig
 from api.models import Message
-from api.repos import ChannelRepo
+from api.repos import ChannelRepo, IntentVerificationRepo
 
 
 @pytest.fixture(scope='session')
@@ -61,6 +61,16 @@ def clean_channel_repo(app, request):
     repo._unsafe_method__clear()
 
 
+@pytest.fixture
+def clean_intent_verification_repo(app, request):
+    repo = IntentVerificationRepo(app.config['INTENT_VERIFICATION_REPO_CONF'])
+    repo._unsafe_method__clear()
+    if request.cls is not None:
+        request.cls.intent_verification_repo = repo
+    yield repo
+    repo._unsafe_method__clear()
+
+
 @pytest.fixture
 def mocked_responses(request):
     with responses.RequestsMock() as rsps:
@@ -0,0 +1,31 @@
+from api.backoff import IdleBackoff, ProcessorStats
+
+
+def test_idle_backoff__should_double_delay_up_to_max():
+    backoff = IdleBackoff(min_seconds=0.5, max_seconds=3)
+
+    assert [backoff.next_delay() for _ in range(5)] == [0.5, 1, 2, 3, 3]
+
+
+def test_idle_backoff__after_reset__should_start_from_min():
+    backoff = IdleBackoff(min_seconds=0.5, max_seconds=3)
+    backoff.next_delay()
+    backoff.next_delay()
+    backoff.reset()
+
+    assert backoff.next_delay() == 0.5
+
+
+def test_processor_stats__should_split_working_and_idle_time():
+    stats = ProcessorStats()
+    stats.record_poll(3, busy=True)
+    stats.record_poll(0.5, busy=False)
+    stats.record_sleep(0.5)
+
+    assert stats.snapshot() == {
+        'working_seconds': 3,
+        'idle_seconds': 1,
+        'idle_ratio': 0.25,
+        'busy_polls': 1,
+        'idle_polls': 1,
+    }
@@ -0,0 +1,77 @@
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from api.circuit_breaker import CircuitBreaker
+
+
+def test_circuit__after_consecutive_failures__should_open():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=100):
+        breaker.record_failure('callback.url')
+        assert breaker.allow('callback.url')
+        breaker.record_failure('callback.url')
+
+        assert not breaker.allow('callback.url')
+        assert breaker.allow('other.url')
+        assert breaker.retry_after('callback.url') == 60
+
+    assert breaker.snapshot() == {'opened': 1, 'short_circuited': 1, 'hosts': {'callback.url': 'open'}}
+
+
+def test_circuit__success__should_reset_failures():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure('callback.url')
+    breaker.record_success('callback.url')
+    breaker.record_failure('callback.url')
+
+    assert breaker.allow('callback.url')
+
+
+def test_circuit__when_reset_time_passed__should_let_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60, half_open_probes=1)
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=100):
+        breaker.record_failure('callback.url')
+
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=160):
+        assert breaker.allow('callback.url')
+        assert not breaker.allow('callback.url')
+        assert breaker.snapshot()['hosts'] == {'callback.url': 'half_open'}
+
+        breaker.record_success('callback.url')
+        assert breaker.allow('callback.url')
+        assert breaker.snapshot()['hosts'] == {}
+
+
+def test_circuit__when_probe_fails__should_open_again():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=100):
+        breaker.record_failure('callback.url')
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=160):
+        assert breaker.allow('callback.url')
+        breaker.record_failure('callback.url')
+
+        assert not breaker.allow('callback.url')
+        assert breaker.snapshot()['opened'] == 2
+
+
+def test_circuit__should_export_state_and_transitions():
+    def get_transitions(state):
+        return REGISTRY.get_sample_value(
+            'channel_circuit_transitions_total', {'host': 'metrics.url', 'state': state}
+        ) or 0
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+    before = {state: get_transitions(state) for state in ('open', 'half_open', 'closed')}
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=100):
+        breaker.record_failure('metrics.url')
+        assert REGISTRY.get_sample_value('channel_circuit_state', {'host': 'metrics.url'}) == 2
+    with mock.patch('api.circuit_breaker.time.monotonic', return_value=160):
+        breaker.allow('metrics.url')
+        assert REGISTRY.get_sample_value('channel_circuit_state', {'host': 'metrics.url'}) == 1
+        breaker.record_success('metrics.url')
+
+    assert REGISTRY.get_sample_value('channel_circuit_state', {'host': 'metrics.url'}) == 0
+    assert {state: get_transitions(state) - before[state] for state in before} == {
+        'open': 1, 'half_open': 1, 'closed': 1,
+    }
@@ -0,0 +1,90 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+
+from api.http_client import HttpSession, HttpStats, create_http_session
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(0.5)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = HTTPServer(('127.0.0.1', 0), CallbackHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stats():
+    stats = HttpStats()
+    with mock.patch('api.http_client.http_stats', stats):
+        yield stats
+
+
+def test_session__should_reuse_connections(server_url, stats):
+    session = HttpSession()
+    for _ in range(3):
+        assert session.get(f'{server_url}/').text == 'ok'
+
+    assert stats.snapshot() == {'requests': 3, 'new_connections': 1, 'reused_connections': 2, 'timeouts': 0}
+
+
+def test_session__should_export_prometheus_metrics(server_url, stats):
+    names = (
+        'channel_http_requests_total', 'channel_http_connections_total',
+        'channel_http_timeouts_total', 'channel_http_request_seconds_count',
+    )
+    before = [REGISTRY.get_sample_value(name) for name in names]
+    session = HttpSession(read_timeout=0.1)
+    session.get(f'{server_url}/')
+    with pytest.raises(requests.Timeout):
+        session.get(f'{server_url}/slow')
+
+    after = [REGISTRY.get_sample_value(name) for name in names]
+    assert [value - before_value for value, before_value in zip(after, before)] == [2, 1, 1, 2]
+
+
+def test_session__when_read_timeout__should_raise_and_count_it(server_url, stats):
+    session = HttpSession(read_timeout=0.1)
+    with pytest.raises(requests.Timeout):
+        session.get(f'{server_url}/slow')
+
+    assert stats.snapshot()['timeouts'] == 1
+
+
+def test_session__should_use_default_timeouts():
+    session = HttpSession(connect_timeout=2, read_timeout=7)
+    with mock.patch('requests.Session.request') as request:
+        session.post('http://callback.url/1', json={})
+        session.get('http://callback.url/1', timeout=1)
+
+    assert request.call_args_list[0][1]['timeout'] == (2, 7)
+    assert request.call_args_list[1][1]['timeout'] == 1
+
+
+def test_create_http_session__should_keep_pool_for_max_concurrency(app):
+    config = dict(app.config, HTTP_POOL_MAXSIZE=10)
+
+    assert create_http_session(config).get_adapter('http://callback.url')._pool_maxsize == 10
+    assert create_http_session(config, 25).get_adapter('http://callback.url')._pool_maxsize == 25
@@ -0,0 +1,83 @@
+from unittest import mock
+
+import pytest
+import responses
+from flask import url_for
+from libtrustbridge.websub.repos import DeliveryOutboxRepo, NotificationsRepo, SubscriptionsRepo
+from prometheus_client import REGISTRY
+
+from api.use_cases import DeliverCallbackUseCase, DispatchMessageToSubscribersUseCase
+
+
+def get_sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.usefixtures("db_session", "client_class")
+class TestMetricsView:
+    def test_get__should_return_request_and_query_metrics(self):
+        labels = {'view': 'views.get_message', 'method': 'GET', 'status': '404'}
+        requests_before = get_sample('channel_request_seconds_count', **labels)
+        selects_before = get_sample('channel_db_query_seconds_count', statement='select')
+
+        self.client.get(url_for('views.get_message', id=404))
+        response = self.client.get(url_for('metrics'))
+
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        assert b'channel_request_seconds_bucket' in response.data
+        assert get_sample('channel_request_seconds_count', **labels) == requests_before + 1
+        assert get_sample('channel_db_query_seconds_count', statement='select') > selects_before
+
+
+def test_queue_repo__should_count_posted_and_received_jobs(clean_intent_verification_repo):
+    queue = 'intent-verification'
+    posted_before = get_sample('channel_queue_jobs_total', queue=queue, operation='post')
+    received_before = get_sample('channel_queue_jobs_total', queue=queue, operation='get')
+    gets_before = get_sample('channel_queue_requests_total', queue=queue, operation='get')
+
+    clean_intent_verification_repo.post_jobs([{'id': 1}, {'id': 2}])
+    clean_intent_verification_repo.post_job({'id': 3})
+    jobs = clean_intent_verification_repo.get_jobs(10)
+    assert clean_intent_verification_repo.get_jobs(10) == []
+
+    assert len(jobs) == 3
+    assert get_sample('channel_queue_jobs_total', queue=queue, operation='post') == posted_before + 3
+    assert get_sample('channel_queue_jobs_total', queue=queue, operation='get') == received_before + 3
+    assert get_sample('channel_queue_requests_total', queue=queue, operation='get') == gets_before + 2
+
+
+def test_dispatch__should_observe_fanout():
+    notifications_repo = mock.create_autospec(NotificationsRepo).return_value
+    notifications_repo.get_job.return_value = ('msg_id', {'topic': 'AU', 'content': {'id': 24}})
+    subscriptions_repo = mock.create_autospec(SubscriptionsRepo).return_value
+    subscriptions_repo.get_subscriptions_by_pattern.return_value = {
+        mock.Mock(callback_url='http://callback.url/1'), mock.Mock(callback_url='http://callback.url/2')
+    }
+    use_case = DispatchMessageToSubscribersUseCase(
+        notifications_repo, mock.create_autospec(DeliveryOutboxRepo).return_value, subscriptions_repo
+    )
+    count_before = get_sample('channel_dispatch_fanout_count')
+    sum_before = get_sample('channel_dispatch_fanout_sum')
+
+    use_case.execute()
+
+    assert get_sample('channel_dispatch_fanout_count') == count_before + 1
+    assert get_sample('channel_dispatch_fanout_sum') == sum_before + 2
+
+
+@responses.activate
+def test_deliver__should_count_outcome_latency_and_retries_per_host():
+    responses.add(responses.POST, 'http://metrics.callback.url/1', status=503)
+    responses.add(responses.POST, 'http://metrics.callback.url/1', status=202)
+    delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+    use_case = DeliverCallbackUseCase(delivery_outbox_repo, 'https://channel.url/hub')
+    host = 'metrics.callback.url'
+
+    use_case.process('queue_id', {'s': 'http://metrics.callback.url/1', 'payload': {'id': 55}})
+    use_case.process('queue_id', {'s': 'http://metrics.callback.url/1', 'payload': {'id': 55}, 'retry': 2})
+
+    assert get_sample('channel_deliveries_total', host=host, outcome='unavailable') == 1
+    assert get_sample('channel_deliveries_total', host=host, outcome='delivered') == 1
+    assert get_sample('channel_delivery_seconds_count', host=host) == 2
+    assert get_sample('channel_delivery_retries_total', host=host) == 1
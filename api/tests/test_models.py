@@ -10,3 +10,12 @@ def test_message__can_be_created(db_session, message):
     assert created.payload == message.payload
     assert created.created_at == datetime(2020, 4, 7, 14, 21, 22, 123456)
 
+
+def test_message__when_created__should_copy_sender_and_receiver_from_payload(db_session):
+    message = Message(payload={"sender": "AU", "receiver": "SG"})
+    db_session.add(message)
+    db_session.commit()
+
+    created = db_session.query(Message).get(message.id)
+    assert created.sender == 'AU'
+    assert created.receiver == 'SG'
@@ -0,0 +1,155 @@
+from datetime import datetime
+from unittest import mock
+
+import pytest
+from freezegun import freeze_time
+from libtrustbridge.websub.domain import Pattern
+
+from api.app import db
+from api.models import Subscription
+from api.repos import DbSubscriptionsRepo, SubscriptionsRepo, create_subscriptions_repo
+
+
+def get_callbacks(subscriptions):
+    return {subscription.callback_url for subscription in subscriptions}
+
+
+@freeze_time('2020-04-07 14:21:22')
+def test_db_subscriptions_repo__should_return_unexpired_subscriptions_of_topic(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.subscribe_by_pattern(Pattern('aa.bb'), 'http://callback.url/1', 3600)
+    repo.subscribe_by_pattern(Pattern('aa.bb'), 'http://callback.url/2')
+    repo.subscribe_by_pattern(Pattern('aa'), 'http://callback.url/3', 3600)
+    db_session.add(Subscription(
+        key=Pattern('aa.bb').to_key('http://callback.url/4'), topic=Pattern('aa.bb').to_key(),
+        callback_url='http://callback.url/4', expires_at=datetime(2020, 4, 7, 14, 21, 21),
+    ))
+
+    subscriptions = repo.get_subscriptions_by_pattern(Pattern('aa.bb'))
+
+    assert get_callbacks(subscriptions) == {'http://callback.url/1', 'http://callback.url/2'}
+    assert {subscription.key: subscription.payload for subscription in subscriptions} == {
+        Pattern('aa.bb').to_key('http://callback.url/1'): {'c': 'http://callback.url/1', 'e': 1586272882},
+        Pattern('aa.bb').to_key('http://callback.url/2'): {'c': 'http://callback.url/2', 'e': None},
+    }
+    assert all(subscription.is_valid for subscription in subscriptions)
+
+
+def test_db_subscriptions_repo__subscribe_again__should_renew_lease(db_session):
+    repo = DbSubscriptionsRepo()
+    with freeze_time('2020-04-07 14:21:22'):
+        repo.subscribe_by_pattern(Pattern('aa'), 'http://callback.url/1', 60)
+    with freeze_time('2020-04-07 15:21:22'):
+        repo.bulk_subscribe([Pattern('aa'), Pattern('bb')], 'http://callback.url/1', 60)
+
+        assert len(repo.get_subscriptions_by_pattern(Pattern('aa'))) == 1
+        assert len(repo.get_subscriptions_by_pattern(Pattern('bb'))) == 1
+    assert db_session.query(Subscription).count() == 2
+
+
+def test_db_subscriptions_repo__reads__should_not_commit(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.subscribe_by_pattern(Pattern('aa'), 'http://callback.url/1')
+
+    with mock.patch.object(db.session, 'commit') as commit:
+        repo.get_subscriptions_by_pattern(Pattern('aa'))
+        repo.get_version()
+        list(repo.iter_subscription_payloads())
+        repo.get_subscription_payloads([Pattern('aa').to_key('http://callback.url/1')])
+
+    assert not commit.called
+
+
+def test_db_subscriptions_repo__bulk_subscribe__when_patterns_repeat__should_subscribe_once(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.bulk_subscribe([Pattern('aa'), Pattern('bb'), Pattern('aa')], 'http://callback.url/1')
+
+    assert db_session.query(Subscription).count() == 2
+    assert len(repo.get_subscriptions_by_pattern(Pattern('aa'))) == 1
+
+
+def test_db_subscriptions_repo__bulk_delete__should_delete_subscriptions_and_bump_version(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.bulk_subscribe([Pattern('aa'), Pattern('bb')], 'http://callback.url/1')
+    version = repo.get_version()
+
+    repo.bulk_delete([Pattern('aa').to_key('http://callback.url/1')])
+
+    assert not repo.get_subscriptions_by_pattern(Pattern('aa'))
+    assert len(repo.get_subscriptions_by_pattern(Pattern('bb'))) == 1
+    assert repo.get_version() not in (None, version)
+
+
+def test_db_subscriptions_repo__iter_subscription_payloads__should_read_all_pages(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.PAGE_SIZE = 2
+    repo.bulk_subscribe([Pattern('aa'), Pattern('bb'), Pattern('cc')], 'http://callback.url/1')
+
+    payloads = list(repo.iter_subscription_payloads())
+
+    assert sorted(key for key, size, payload in payloads) == sorted(
+        Pattern(topic).to_key('http://callback.url/1') for topic in ('aa', 'bb', 'cc')
+    )
+    assert all(payload == {'c': 'http://callback.url/1', 'e': None} for key, size, payload in payloads)
+
+
+def test_db_subscriptions_repo__get_subscription_payloads__should_return_none_for_deleted(db_session):
+    repo = DbSubscriptionsRepo()
+    repo.subscribe_by_pattern(Pattern('aa'), 'http://callback.url/1')
+    keys = [Pattern(topic).to_key('http://callback.url/1') for topic in ('aa', 'bb')]
+
+    assert repo.get_subscription_payloads(keys) == {
+        keys[0]: {'c': 'http://callback.url/1', 'e': None},
+        keys[1]: None,
+    }
+
+
+def test_subscriptions_repo__bulk_subscribe__should_write_delta_of_written_subscriptions_only(
+        app, clean_subscriptions_repo):
+    repo = SubscriptionsRepo(app.config['SUBSCRIPTIONS_REPO_CONF'], index_deltas=True)
+    put_object = repo.put_object
+    failing_key = Pattern('bb').to_key('http://callback.url/1')
+
+    def put_or_fail(clean_path, **kwargs):
+        if clean_path == failing_key:
+            raise ConnectionError('write failed')
+        return put_object(clean_path=clean_path, **kwargs)
+
+    with mock.patch.object(repo, 'put_object', put_or_fail), pytest.raises(ConnectionError):
+        repo.bulk_subscribe([Pattern('aa'), Pattern('bb')], 'http://callback.url/1')
+
+    deltas = [repo.get_index_delta(key) for key in repo.list_index_deltas()]
+    assert deltas == [{'put': {Pattern('aa').to_key('http://callback.url/1'): {
+        'c': 'http://callback.url/1', 'e': None,
+    }}}]
+    assert repo.get_version() is not None
+
+
+def test_subscriptions_repo__bulk_subscribe__when_all_writes_fail__should_not_bump_version(
+        app, clean_subscriptions_repo):
+    repo = SubscriptionsRepo(app.config['SUBSCRIPTIONS_REPO_CONF'], index_deltas=True)
+
+    put_object = mock.patch.object(repo, 'put_object', side_effect=ConnectionError('write failed'))
+    with put_object, pytest.raises(ConnectionError):
+        repo.bulk_subscribe([Pattern('aa')], 'http://callback.url/1')
+
+    assert repo.get_version() is None
+    assert repo.list_index_deltas() == []
+
+
+def test_subscriptions_repo__bulk_delete__given_iterator__should_write_delta_of_all_keys(
+        app, clean_subscriptions_repo):
+    repo = SubscriptionsRepo(app.config['SUBSCRIPTIONS_REPO_CONF'], index_deltas=True)
+    keys = [Pattern(topic).to_key('http://callback.url/1') for topic in ('aa', 'bb')]
+
+    repo.bulk_delete(iter(keys))
+
+    assert [repo.get_index_delta(key) for key in repo.list_index_deltas()] == [{'delete': keys}]
+
+
+def test_create_subscriptions_repo__should_select_backend(app):
+    config = dict(app.config)
+    assert isinstance(create_subscriptions_repo(config), SubscriptionsRepo)
+
+    config['SUBSCRIPTIONS_REPO_BACKEND'] = 'postgresql'
+    assert isinstance(create_subscriptions_repo(config), DbSubscriptionsRepo)
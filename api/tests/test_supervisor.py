@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from api.supervisor import Supervisor
+
+
+@pytest.fixture(autouse=True)
+def restore_signal_handlers():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def run_supervisor(supervisor, stop_when):
+    """
+    Run the supervisor in the main thread until stop_when() is true
+    """
+    def stop():
+        wait_for(stop_when)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop, daemon=True).start()
+    supervisor.run()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_supervisor__should_run_target_in_each_worker_thread():
+    started = multiprocessing.Queue()
+    stopped = multiprocessing.Queue()
+
+    def target(stop_event):
+        started.put(os.getpid())
+        stop_event.wait()
+        stopped.put(os.getpid())
+
+    supervisor = Supervisor(target, workers=2, threads=2, shutdown_timeout=5)
+    run_supervisor(supervisor, lambda: started.qsize() == 4)
+
+    assert wait_for(lambda: stopped.qsize() == 4)
+    assert len({started.get() for _ in range(4)}) == 2
+    assert [process.exitcode for process in supervisor._processes.values()] == [0, 0]
+
+
+def test_supervisor__when_worker_crashes__should_restart_it():
+    started = multiprocessing.Queue()
+
+    def target(stop_event):
+        started.put(os.getpid())
+        if started.qsize() == 1:
+            raise RuntimeError('crash')
+        stop_event.wait()
+
+    supervisor = Supervisor(target, workers=1, shutdown_timeout=5)
+    supervisor.RESTART_DELAY = 0.1
+    run_supervisor(supervisor, lambda: started.qsize() == 2)
+
+    assert started.get() != started.get()
+    assert supervisor._crashes == {0: 1}
+    assert supervisor._processes[0].exitcode == 0
+
+
+def test_supervisor__when_thread_does_not_stop__should_exit_after_shutdown_timeout():
+    started = multiprocessing.Queue()
+
+    def target(stop_event):
+        started.put(os.getpid())
+        while True:
+            time.sleep(0.1)
+
+    supervisor = Supervisor(target, workers=1, shutdown_timeout=0.5)
+    run_supervisor(supervisor, lambda: started.qsize() == 1)
+
+    assert supervisor._processes[0].exitcode == 0
+
+
+def test_supervisor__should_call_initializer_in_each_worker():
+    initialized = multiprocessing.Queue()
+
+    def target(stop_event):
+        stop_event.wait()
+
+    supervisor = Supervisor(target, workers=2, shutdown_timeout=5, initializer=initialized.put)
+    run_supervisor(supervisor, lambda: initialized.qsize() == 2)
+
+    assert sorted(initialized.get() for _ in range(2)) == [0, 1]
+
+
+def test_supervisor__when_stopped__should_cancel_pending_restarts():
+    def target(stop_event):
+        raise RuntimeError('crash')
+
+    supervisor = Supervisor(target, workers=1, shutdown_timeout=5)
+    supervisor._start(0)
+    process = supervisor._processes[0]
+    process.join(5)
+    supervisor._on_exit(0, process)
+    restart = supervisor._restart_timers[0]
+
+    supervisor._stop_all()
+    supervisor._restart(0)
+
+    restart.join(1)
+    assert restart.finished.is_set() and not restart.is_alive()
+    assert supervisor._processes == {0: None}
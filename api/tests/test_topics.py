@@ -0,0 +1,14 @@
+from api.topics import get_matching_patterns, is_valid_pattern
+
+
+def test_get_matching_patterns__should_return_topic_and_wildcard_per_prefix():
+    assert get_matching_patterns('jurisdiction.AU') == ['jurisdiction.AU', 'jurisdiction.*', '*']
+    assert get_matching_patterns('123') == ['123', '*']
+
+
+def test_is_valid_pattern__should_allow_wildcard_as_last_segment_only():
+    assert is_valid_pattern('jurisdiction.AU')
+    assert is_valid_pattern('jurisdiction.*')
+    assert is_valid_pattern('*')
+    assert not is_valid_pattern('*.AU')
+    assert not is_valid_pattern('jurisdiction.A*')
@@ -1,15 +1,25 @@
 import random
+import threading
+import time
 from datetime import datetime
 from unittest import mock, TestCase
 
 import pytest
 import responses
 from freezegun import freeze_time
+from libtrustbridge.websub.domain import Pattern
 from libtrustbridge.websub.repos import NotificationsRepo, DeliveryOutboxRepo, SubscriptionsRepo
+from prometheus_client import REGISTRY
 
-from api.models import Message, MessageStatus
+from api import repos
+from api.app import db
+from api.cache import SubscriptionsCache, SubscriptionsIndex
+from api.circuit_breaker import CircuitBreaker
+from api.models import DeliveryDeadLetter, Message, MessageStatus, NotificationOutbox
 from api.use_cases import (
-    PublishStatusChangeUseCase, DispatchMessageToSubscribersUseCase, DeliverCallbackUseCase, NewMessagesNotifyUseCase
+    PublishStatusChangeUseCase, DispatchMessageToSubscribersUseCase, DeliverCallbackUseCase, NewMessagesNotifyUseCase,
+    RelayNotificationsOutboxUseCase, AsyncDeliverCallbackUseCase, InvalidCallbackResponse, ReplayDeadLettersUseCase,
+    VerifyIntentUseCase, SweepExpiredSubscriptionsUseCase, CompileSubscriptionsIndexUseCase
 )
 
 
@@ -52,12 +62,45 @@ class TestGetNewMessagesUseCase:
         assert messages[0].updated_at >= now
         assert messages[0].id == self.message1.id
 
+    def test_execute__should_set_observer_lag(self):
+        self.use_case.cursor = (datetime(2020, 6, 17, 12, 4, 0), None)
+        with freeze_time('2020-06-17 12:04:13.111111'):
+            assert self.use_case.execute()
+        assert REGISTRY.get_sample_value('channel_observer_lag_seconds') == 10
+
+        assert self.use_case.execute() is None
+        assert REGISTRY.get_sample_value('channel_observer_lag_seconds') == 0
+
+    def test_iter_new_messages__when_more_than_chunk__should_return_all_pages(self):
+        self.use_case.chunk_size = 1
+        since = datetime(2020, 6, 17, 12, 4, 0)
+        messages = list(self.use_case.iter_new_messages(receiver='AU', since=since))
+        assert [m.id for m in messages] == [self.message2.id, self.message1.id]
+        assert messages[0]._asdict() == {
+            'id': self.message2.id,
+            'receiver': 'AU',
+            'updated_at': datetime(2020, 6, 17, 12, 4, 1, 111111),
+        }
+
+    def test_iter_new_messages__when_cursor_id_given__should_skip_messages_up_to_it(self):
+        messages = list(self.use_case.iter_new_messages(
+            receiver='AU', since=self.message2.updated_at, since_id=self.message2.id
+        ))
+        assert [m.id for m in messages] == [self.message1.id]
+
     def test_set_last_updated__should_set_timestamp_into_channel_repo(self):
         updated_at = datetime(2020, 6, 17, 11, 34, 56, 123456)
         self.use_case.set_last_updated_at(updated_at)
         assert self.use_case.get_last_updated_at() == updated_at
         assert self.channel_repo.get_object_content('updated_at') == b'2020-06-17T11:34:56.123456'
 
+    def test_get_cursor__when_saved_with_id__should_return_timestamp_and_id(self):
+        updated_at = datetime(2020, 6, 17, 11, 34, 56, 123456)
+        self.use_case.set_last_updated_at(updated_at, 42)
+        assert self.channel_repo.get_object_content('updated_at') == b'2020-06-17T11:34:56.123456 42'
+        assert self.use_case.get_cursor() == (updated_at, 42)
+        assert self.use_case.get_last_updated_at() == updated_at
+
     def test_get_last_updated_at__when_not_available__should_return_none(self):
         assert self.use_case.get_last_updated_at() is None
 
@@ -69,6 +112,49 @@ class TestGetNewMessagesUseCase:
         assert notification and notification[1] == {'content': {'id': self.message1.id}, 'topic': 'jurisdiction.AU'}
         assert not self.notifications_repo.get_job()
 
+    def test_execute__when_checkpoint_due__should_save_cursor_of_last_message(self):
+        self.use_case.checkpoint_every = 1
+        self.use_case.set_last_updated_at(datetime(2020, 6, 17, 12, 4, 0))
+        self.use_case.execute()
+        assert self.use_case.get_cursor() == (self.message1.updated_at, self.message1.id)
+
+    def test_execute__when_checkpoint_not_due__should_keep_cursor_in_memory(self):
+        self.use_case.checkpoint_interval_ms = 60 * 1000
+        since = datetime(2020, 6, 17, 12, 4, 0)
+        self.use_case.set_last_updated_at(since)
+        self.use_case.execute()
+        assert self.use_case.cursor == (self.message1.updated_at, self.message1.id)
+        assert self.use_case.get_cursor() == (since, None)
+
+        self.use_case.checkpoint()
+        assert self.use_case.get_cursor() == (self.message1.updated_at, self.message1.id)
+
+    def test_execute__when_cursor_loaded__should_not_read_it_again(self):
+        self.use_case.set_last_updated_at(datetime(2020, 6, 17, 12, 4, 0))
+        self.use_case.execute()
+        with mock.patch.object(self.channel_repo, 'get_object_content') as get_object_content:
+            self.use_case.execute()
+        assert not get_object_content.called
+        self.notifications_repo.get_job()
+        self.notifications_repo.get_job()
+        assert not self.notifications_repo.get_job()
+
+    def test_execute__when_listener_given__should_wait_for_it_after_publishing(self):
+        listener = mock.Mock()
+        listener.wait.return_value = True
+        self.use_case.listener = listener
+        self.use_case.fallback_poll_seconds = 30
+        self.use_case.set_last_updated_at(datetime(2020, 6, 17, 12, 4, 0))
+
+        assert self.use_case.execute() is True
+        listener.wait.assert_called_once_with(30)
+        assert self.use_case.get_cursor() == (self.message1.updated_at, self.message1.id)
+
+    def test_execute__should_return_whether_messages_were_notified(self):
+        self.use_case.set_last_updated_at(datetime(2020, 6, 17, 12, 4, 0))
+        assert self.use_case.execute() is True
+        assert self.use_case.execute() is None
+
     def test_execute__when_no_last_updated_at__should_use_now(self):
         with mock.patch('api.use_cases.datetime') as mocked_datetime:
             mocked_datetime.utcnow.return_value = datetime(2020, 6, 17, 12, 1, 1, 222222)
@@ -94,6 +180,78 @@ class TestPublishStatusChangeUseCase:
             }
         })
 
+    def test_publish_many__should_send_messages_in_batch(self):
+        notifications_repo = mock.create_autospec(repos.NotificationsRepo).return_value
+
+        messages = [Message(id=24, payload={'sender': 'CN'}), Message(id=25, payload={'sender': 'CN'})]
+        PublishStatusChangeUseCase(notifications_repo).publish_many(messages)
+
+        notifications_repo.post_jobs.assert_called_once_with([
+            {'topic': '24', 'content': {'id': 24}},
+            {'topic': '25', 'content': {'id': 25}},
+        ])
+        assert not notifications_repo.post_job.called
+
+
+class TestRelayNotificationsOutboxUseCase:
+    @pytest.fixture(autouse=True)
+    def outbox(self, app, db_session, clean_notifications_repo):
+        self.db_session = db_session
+        self.notifications_repo = clean_notifications_repo
+        for message_id in (1, 2, 3):
+            db_session.add(NotificationOutbox(payload={'topic': str(message_id), 'content': {'id': message_id}}))
+        db_session.commit()
+        notifications_repo = repos.NotificationsRepo(app.config['NOTIFICATIONS_REPO_CONF'])
+        self.use_case = RelayNotificationsOutboxUseCase(notifications_repo, batch_size=2)
+
+    def test_execute__should_move_batch_of_notifications_to_queue(self):
+        assert self.use_case.execute() == 2
+        assert self.db_session.query(NotificationOutbox).count() == 1
+
+        jobs = [self.notifications_repo.get_job()[1] for _ in range(2)]
+        assert {job['topic'] for job in jobs} == {'1', '2'}
+
+    def test_execute__when_outbox_empty__should_return_none(self):
+        self.use_case.execute()
+        self.use_case.execute()
+        assert self.use_case.execute() is None
+        assert self.db_session.query(NotificationOutbox).count() == 0
+
+
+class TestReplayDeadLettersUseCase:
+    @pytest.fixture(autouse=True)
+    def dead_letters(self, db_session):
+        self.db_session = db_session
+        repo = repos.DeadLetterRepo()
+        with freeze_time('2020-06-17 12:00:00'):
+            repo.save({'s': 'http://callback.url/1', 'payload': {'id': 1}}, 3, 'returns 500')
+            repo.save({'s': 'http://callback.url/2', 'payload': {'id': 2}}, 3, 'returns 500')
+        with freeze_time('2020-06-18 12:00:00'):
+            repo.save({'s': 'http://callback.url/1', 'payload': {'id': 3}}, 3, 'returns 500')
+        self.delivery_outbox_repo = mock.create_autospec(repos.DeliveryOutboxRepo).return_value
+
+    def replay_all(self, **kwargs):
+        use_case = ReplayDeadLettersUseCase(self.delivery_outbox_repo, batch_size=2, **kwargs)
+        replayed = []
+        while use_case.execute():
+            replayed.extend(self.delivery_outbox_repo.post_jobs.call_args[0][0])
+        return replayed
+
+    def test_execute__should_post_jobs_in_batches_and_delete_them(self):
+        assert self.replay_all() == [
+            {'s': 'http://callback.url/1', 'payload': {'id': 1}},
+            {'s': 'http://callback.url/2', 'payload': {'id': 2}},
+            {'s': 'http://callback.url/1', 'payload': {'id': 3}},
+        ]
+        assert self.delivery_outbox_repo.post_jobs.call_count == 2
+        assert self.db_session.query(DeliveryDeadLetter).count() == 0
+
+    def test_execute__when_filtered__should_replay_only_matching(self):
+        replayed = self.replay_all(callback_url='http://callback.url/1', since=datetime(2020, 6, 18))
+
+        assert replayed == [{'s': 'http://callback.url/1', 'payload': {'id': 3}}]
+        assert self.db_session.query(DeliveryDeadLetter).count() == 2
+
 
 class TestDispatchMessageToSubscribersUseCase(TestCase):
     def setUp(self):
@@ -136,10 +294,126 @@ class TestDispatchMessageToSubscribersUseCase(TestCase):
 
         assert not self.delivery_outbox_repo.called
 
+    def test_use_case__when_wait_seconds__should_long_poll_notifications(self):
+        self.use_case.wait_seconds = 20
+        self.notifications_repo.get_jobs = mock.Mock(return_value=[])
+
+        assert self.use_case.execute() is None
+        self.notifications_repo.get_jobs.assert_called_once_with(1, 20)
+        assert not self.notifications_repo.get_job.called
+
     def test_use_case_when_subscription_not_valid__should_not_post_it(self):
         self.subscription1.is_valid = False
         self.use_case.execute()
-        self.delivery_outbox_repo.post_job.assert_called_once_with({'s': 'http://callback.url/2', 'payload': {'id': 24}})
+        self.delivery_outbox_repo.post_job.assert_called_once_with(
+            {'s': 'http://callback.url/2', 'payload': {'id': 24}}
+        )
+
+    def test_use_case__should_notify_wildcard_subscribers_once(self):
+        wildcard_subscription = mock.Mock(callback_url='http://callback.url/1', is_valid=True)
+        self.subscription1.is_valid = False
+        subscriptions = {
+            'MESSAGE/24/STATUS/': {self.subscription1, self.subscription2},
+            'MESSAGE/*/': {wildcard_subscription},
+            '*/': {mock.Mock(callback_url='http://callback.url/2')},
+        }
+        self.subscriptions_repo.get_subscriptions_by_pattern.side_effect = (
+            lambda pattern: subscriptions.get(pattern.to_key(), set())
+        )
+
+        self.use_case.execute()
+
+        assert [
+            call[0][0].to_key() for call in self.subscriptions_repo.get_subscriptions_by_pattern.call_args_list
+        ] == ['MESSAGE/24/STATUS/', 'MESSAGE/24/*/', 'MESSAGE/*/', '*/']
+        assert sorted(
+            call[0][0]['s'] for call in self.delivery_outbox_repo.post_job.call_args_list
+        ) == ['http://callback.url/1', 'http://callback.url/2']
+
+
+class TestDispatchMessageToSubscribersUseCaseBatch(TestCase):
+    def setUp(self):
+        self.notifications_repo = mock.create_autospec(repos.NotificationsRepo).return_value
+        self.notifications_repo.get_jobs.return_value = [
+            ('msg_1', {'topic': 'AU', 'content': {'id': 1}}),
+            ('msg_2', {'topic': 'SG', 'content': {'id': 2}}),
+            ('msg_3', {'topic': 'AU', 'content': {'id': 3}}),
+        ]
+        self.subscriptions_repo = mock.create_autospec(SubscriptionsRepo).return_value
+        self.subscriptions_repo.get_subscriptions_by_pattern.return_value = [
+            mock.Mock(callback_url='http://callback.url/1'),
+        ]
+        self.delivery_outbox_repo = mock.create_autospec(repos.DeliveryOutboxRepo).return_value
+
+        self.use_case = DispatchMessageToSubscribersUseCase(
+            self.notifications_repo, self.delivery_outbox_repo, self.subscriptions_repo,
+            batch_size=10, wait_seconds=2
+        )
+
+    def test_use_case__given_notifications__should_resolve_subscribers_once_per_topic(self):
+        assert self.use_case.execute()
+
+        self.notifications_repo.get_jobs.assert_called_once_with(10, 2)
+        assert [
+            call[0][0].to_key() for call in self.subscriptions_repo.get_subscriptions_by_pattern.call_args_list
+        ] == ['AU/', '*/', 'SG/', '*/']
+        self.delivery_outbox_repo.post_jobs.assert_called_once_with([
+            {'s': 'http://callback.url/1', 'payload': {'id': 1}},
+            {'s': 'http://callback.url/1', 'payload': {'id': 3}},
+            {'s': 'http://callback.url/1', 'payload': {'id': 2}},
+        ])
+        self.notifications_repo.delete_jobs.assert_called_once_with(['msg_1', 'msg_2', 'msg_3'])
+        assert not self.delivery_outbox_repo.post_job.called
+
+    def test_use_case__when_no_notifications__should_return_none(self):
+        self.notifications_repo.get_jobs.return_value = []
+
+        assert self.use_case.execute() is None
+        assert not self.delivery_outbox_repo.post_jobs.called
+
+
+class TestSubscriptionsCache(TestCase):
+    def setUp(self):
+        self.subscriptions_repo = mock.create_autospec(repos.SubscriptionsRepo).return_value
+        self.subscriptions_repo.get_version.return_value = 'v1'
+        self.subscriptions_repo.get_subscriptions_by_pattern.return_value = [mock.Mock()]
+        self.cache = SubscriptionsCache(self.subscriptions_repo, maxsize=10, ttl=60, version_check_interval=5)
+
+    def test_get__when_cached__should_not_read_repo(self):
+        with mock.patch('api.cache.time.monotonic', return_value=100):
+            assert self.cache.get('AU') == self.cache.get('AU')
+        with mock.patch('api.cache.time.monotonic', return_value=101):
+            self.cache.get('AU')
+
+        self.subscriptions_repo.get_subscriptions_by_pattern.assert_called_once()
+        self.subscriptions_repo.get_version.assert_called_once()
+
+    def test_get__when_version_changed__should_reload_subscriptions(self):
+        with mock.patch('api.cache.time.monotonic', return_value=100):
+            self.cache.get('AU')
+            self.subscriptions_repo.get_version.return_value = 'v2'
+            self.cache.get('AU')
+        assert self.subscriptions_repo.get_subscriptions_by_pattern.call_count == 1
+
+        with mock.patch('api.cache.time.monotonic', return_value=105):
+            self.cache.get('AU')
+
+        assert self.subscriptions_repo.get_subscriptions_by_pattern.call_count == 2
+
+    def test_dispatch__with_cache__should_use_cached_subscriptions(self):
+        notifications_repo = mock.create_autospec(NotificationsRepo).return_value
+        notifications_repo.get_job.return_value = ('msg_id', {'topic': 'AU', 'content': {'id': 24}})
+        delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+        use_case = DispatchMessageToSubscribersUseCase(
+            notifications_repo, delivery_outbox_repo, self.subscriptions_repo, subscriptions_cache=self.cache
+        )
+
+        use_case.execute()
+        use_case.execute()
+
+        # once for the topic and once for the * wildcard
+        assert self.subscriptions_repo.get_subscriptions_by_pattern.call_count == 2
+        assert delivery_outbox_repo.post_job.call_count == 2
 
 
 class TestDeliverCallbackUseCase(TestCase):
@@ -165,6 +439,16 @@ class TestDeliverCallbackUseCase(TestCase):
         assert not self.delivery_outbox_repo.post_job.called
         self.delivery_outbox_repo.delete.assert_called_once_with('queue_id')
 
+    @responses.activate
+    def test_use_case__when_wait_seconds__should_long_poll_deliverables(self):
+        responses.add(responses.POST, 'http://callback.url/1', status=202)
+        self.use_case.wait_seconds = 20
+        self.delivery_outbox_repo.get_jobs = mock.Mock(return_value=[('queue_id', self.job)])
+
+        assert self.use_case.execute() is True
+        self.delivery_outbox_repo.get_jobs.assert_called_once_with(1, 20)
+        self.delivery_outbox_repo.delete.assert_called_once_with('queue_id')
+
     @responses.activate
     def test_use_case__when_callback_not_valid__should_retry(self):
         responses.add(responses.POST, 'http://callback.url/1', status=400)
@@ -182,3 +466,374 @@ class TestDeliverCallbackUseCase(TestCase):
         self.use_case.execute()
         self.delivery_outbox_repo.delete.assert_called_once_with('queue_id')
         assert not self.delivery_outbox_repo.post_job.called
+
+    @responses.activate
+    def test_use_case__when_max_retry_attempts_reached__should_save_dead_letter(self):
+        self.use_case.dead_letter_repo = mock.create_autospec(repos.DeadLetterRepo).return_value
+        self.job['retry'] = 3
+        responses.add(responses.POST, 'http://callback.url/1', status=400)
+
+        self.use_case.execute()
+        self.use_case.dead_letter_repo.save.assert_called_once_with(
+            self.job, 3, 'Subscription url http://callback.url/1 seems to be invalid, returns 400'
+        )
+        assert not self.delivery_outbox_repo.post_job.called
+
+    @responses.activate
+    def test_use_case__when_host_fails__should_open_circuit_and_park_jobs(self):
+        self.use_case.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+        responses.add(responses.POST, 'http://callback.url/1', status=503)
+
+        self.use_case.execute()
+        self.use_case.execute()
+
+        assert len(responses.calls) == 1
+        assert self.delivery_outbox_repo.post_job.call_args_list == [
+            mock.call({'payload': {'id': 55}, 's': 'http://callback.url/1', 'retry': 2}, delay_seconds=12),
+            mock.call(self.job, delay_seconds=60),
+        ]
+        assert self.delivery_outbox_repo.delete.call_count == 2
+
+    def test_use_case__when_probe_raises_unexpected_error__should_release_half_open_circuit(self):
+        self.use_case.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+        with mock.patch('api.circuit_breaker.time.monotonic', return_value=100):
+            self.use_case.circuit_breaker.record_failure('callback.url')
+
+        with mock.patch('api.circuit_breaker.time.monotonic', return_value=160), \
+                mock.patch.object(self.use_case, '_deliver_notification', side_effect=ValueError):
+            with pytest.raises(ValueError):
+                self.use_case.execute()
+
+            assert self.use_case.circuit_breaker.snapshot()['hosts'] == {'callback.url': 'open'}
+            assert self.use_case.circuit_breaker.retry_after('callback.url') == 60
+
+    @responses.activate
+    def test_use_case__when_callback_rejects_notification__should_keep_circuit_closed(self):
+        self.use_case.circuit_breaker = CircuitBreaker(failure_threshold=1)
+        responses.add(responses.POST, 'http://callback.url/1', status=400)
+
+        self.use_case.execute()
+        self.use_case.execute()
+
+        assert len(responses.calls) == 2
+
+
+class TestAsyncDeliverCallbackUseCase(TestCase):
+    def setUp(self):
+        self.delivery_outbox_repo = mock.create_autospec(repos.DeliveryOutboxRepo).return_value
+        self.delivery_outbox_repo.get_jobs.return_value = [
+            ('queue_id_1', {'s': 'http://callback.url/1', 'payload': {'id': 1}}),
+            ('queue_id_2', {'s': 'http://invalid.url/2', 'payload': {'id': 2}}),
+        ]
+        self.delivered = []
+
+        async def deliver_notification(url, payload):
+            self.delivered.append(url)
+            if 'invalid' in url:
+                raise InvalidCallbackResponse()
+
+        self.use_case = AsyncDeliverCallbackUseCase(self.delivery_outbox_repo, 'https://channel.url/hub')
+        self.use_case._deliver_notification_async = deliver_notification
+        random.seed(300)
+
+    def tearDown(self):
+        self.use_case.close()
+
+    def test_use_case__given_deliverables__should_deliver_and_delete_them(self):
+        self.delivery_outbox_repo.get_jobs.return_value = self.delivery_outbox_repo.get_jobs.return_value[:1]
+
+        assert self.use_case.execute()
+
+        assert self.delivered == ['http://callback.url/1']
+        self.delivery_outbox_repo.delete_jobs.assert_called_once_with(['queue_id_1'])
+        assert not self.delivery_outbox_repo.post_job.called
+
+    def test_use_case__when_callback_not_valid__should_retry(self):
+        self.use_case.execute()
+        self.use_case.close()
+
+        deleted = [id for call in self.delivery_outbox_repo.delete_jobs.call_args_list for id in call[0][0]]
+        assert sorted(deleted) == ['queue_id_1', 'queue_id_2']
+        new_job = {'payload': {'id': 2}, 's': 'http://invalid.url/2', 'retry': 2}
+        self.delivery_outbox_repo.post_job.assert_called_once_with(new_job, delay_seconds=12)
+
+    def test_use_case__when_no_free_slots__should_not_receive_jobs(self):
+        self.use_case.max_concurrency = 0
+
+        assert self.use_case.execute() is None
+        assert not self.delivery_outbox_repo.get_jobs.called
+
+    def test_close__should_finish_deliveries_in_flight(self):
+        self.use_case.max_concurrency = 2
+        self.use_case._start_delivery('queue_id_3', {'s': 'http://callback.url/3', 'payload': {'id': 3}})
+
+        self.use_case.close()
+
+        assert self.delivered == ['http://callback.url/3']
+        self.delivery_outbox_repo.delete_jobs.assert_called_once_with(['queue_id_3'])
+
+    def test_use_case__when_delivery_raises_unexpected_error__should_retry(self):
+        async def deliver_notification(url, payload):
+            raise ValueError(url)
+
+        self.use_case._deliver_notification_async = deliver_notification
+        self.use_case.circuit_breaker = CircuitBreaker(failure_threshold=1)
+        self.delivery_outbox_repo.get_jobs.return_value = self.delivery_outbox_repo.get_jobs.return_value[:1]
+
+        self.use_case.execute()
+        self.use_case.close()
+
+        self.delivery_outbox_repo.delete_jobs.assert_called_once_with(['queue_id_1'])
+        self.delivery_outbox_repo.post_job.assert_called_once_with(
+            {'payload': {'id': 1}, 's': 'http://callback.url/1', 'retry': 2}, delay_seconds=12
+        )
+        assert self.use_case.circuit_breaker.snapshot()['hosts'] == {'callback.url': 'open'}
+
+    def test_close__when_delivery_cancelled__should_retry(self):
+        self.use_case._start_delivery('queue_id_3', {'s': 'http://callback.url/3', 'payload': {'id': 3}})
+        for task in self.use_case.in_flight:
+            task.cancel()
+
+        self.use_case.close()
+
+        self.delivery_outbox_repo.delete_jobs.assert_called_once_with(['queue_id_3'])
+        self.delivery_outbox_repo.post_job.assert_called_once_with(
+            {'payload': {'id': 3}, 's': 'http://callback.url/3', 'retry': 2}, delay_seconds=12
+        )
+
+    def test_use_case__should_not_create_sync_http_session(self):
+        assert self.use_case.http_session is None
+
+
+class TestVerifyIntentUseCase(TestCase):
+    def setUp(self):
+        self.verification_repo = mock.create_autospec(repos.IntentVerificationRepo).return_value
+        self.verification_repo.get_jobs.return_value = [
+            ('queue_id', {
+                'callback': 'http://callback.url/1', 'mode': 'subscribe', 'topic': 'AU', 'lease_seconds': 3600
+            }),
+        ]
+        self.subscriptions_repo = mock.create_autospec(repos.SubscriptionsRepo).return_value
+        self.use_case = VerifyIntentUseCase(
+            self.verification_repo, self.subscriptions_repo, max_concurrency=2, batch_size=10, wait_seconds=20
+        )
+
+    def tearDown(self):
+        self.use_case.close()
+
+    def run_until_finished(self):
+        self.use_case.execute()
+        while self.use_case.in_flight:
+            self.use_case.execute()
+
+    @responses.activate
+    @mock.patch('uuid.uuid4', return_value='UUID')
+    def test_execute__when_intent_verified__should_subscribe(self, uuid4):
+        responses.add(responses.GET, 'http://callback.url/1', body='UUID')
+
+        self.run_until_finished()
+
+        self.verification_repo.get_jobs.assert_called_with(2, 20)
+        assert 'hub.challenge=UUID' in responses.calls[0].request.url
+        pattern, url, expiration = self.subscriptions_repo.subscribe_by_pattern.call_args[0]
+        assert (pattern.to_key(url), expiration) == (Pattern('AU').to_key('http://callback.url/1'), 3600)
+        self.verification_repo.delete_jobs.assert_called_once_with(['queue_id'])
+
+    @responses.activate
+    def test_execute__when_intent_not_verified__should_drop_request(self):
+        responses.add(responses.GET, 'http://callback.url/1', body='WRONG')
+
+        self.run_until_finished()
+
+        assert not self.subscriptions_repo.subscribe_by_pattern.called
+        self.verification_repo.delete_jobs.assert_called_once_with(['queue_id'])
+
+    @responses.activate
+    @mock.patch('uuid.uuid4', return_value='UUID')
+    def test_execute__when_unexpected_error__should_leave_job_in_queue(self, uuid4):
+        responses.add(responses.GET, 'http://callback.url/1', body='UUID')
+        self.subscriptions_repo.subscribe_by_pattern.side_effect = Exception('storage error')
+
+        self.run_until_finished()
+
+        assert not self.verification_repo.delete_jobs.called
+
+    def test_execute__when_no_requests__should_return_none(self):
+        self.verification_repo.get_jobs.return_value = []
+
+        assert self.use_case.execute() is None
+
+    @responses.activate
+    @mock.patch('uuid.uuid4', return_value='UUID')
+    def test_execute__given_bulk_request__should_verify_each_topic(self, uuid4):
+        responses.add(responses.GET, 'http://callback.url/1', body='UUID')
+        self.verification_repo.get_jobs.return_value = [
+            ('queue_id', {
+                'callback': 'http://callback.url/1', 'mode': 'subscribe', 'topics': ['1', '2'], 'lease_seconds': 60
+            }),
+        ]
+
+        self.run_until_finished()
+
+        assert len(responses.calls) == 2
+        patterns, url, expiration = self.subscriptions_repo.bulk_subscribe.call_args[0]
+        assert [pattern.to_key(url) for pattern in patterns] == [
+            Pattern(topic).to_key('http://callback.url/1') for topic in ('1', '2')
+        ]
+        self.verification_repo.delete_jobs.assert_called_once_with(['queue_id'])
+
+    def test_execute__given_bulk_requests__should_limit_verifications_in_flight(self):
+        self.verification_repo.get_jobs.side_effect = [[
+            (f'queue_id_{i}', {
+                'callback': f'http://callback.url/{i}', 'mode': 'subscribe',
+                'topics': ['1', '2', '3', '4'], 'lease_seconds': 60,
+            }) for i in range(2)
+        ]] + [[]] * 100
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def verify_intent(*args):
+            with lock:
+                in_flight.append(args)
+                peak.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.pop()
+
+        with mock.patch('api.use_cases.verify_intent', side_effect=verify_intent):
+            self.run_until_finished()
+
+        assert len(peak) == 8
+        assert max(peak) <= 2
+
+
+@responses.activate
+@mock.patch('uuid.uuid4', return_value='UUID')
+def test_verify_intent_use_case__should_write_db_subscriptions_in_calling_thread(uuid4, db_session):
+    responses.add(responses.GET, 'http://callback.url/1', body='UUID')
+    verification_repo = mock.create_autospec(repos.IntentVerificationRepo).return_value
+    verification_repo.get_jobs.side_effect = [[
+        ('queue_id_1', {
+            'callback': 'http://callback.url/1', 'mode': 'subscribe', 'topic': 'AU', 'lease_seconds': 3600
+        }),
+        ('queue_id_2', {
+            'callback': 'http://callback.url/1', 'mode': 'subscribe', 'topics': ['CN', 'SG'], 'lease_seconds': 3600
+        }),
+    ]] + [[]] * 100
+    subscriptions_repo = repos.DbSubscriptionsRepo()
+    use_case = VerifyIntentUseCase(verification_repo, subscriptions_repo, max_concurrency=2)
+
+    # pool threads have no application context, the session is only usable through db.app in tests
+    with mock.patch.object(db, 'app', None):
+        use_case.execute()
+        while use_case.in_flight:
+            use_case.execute()
+        use_case.close()
+
+    deleted = [id for call in verification_repo.delete_jobs.call_args_list for id in call[0][0]]
+    assert sorted(deleted) == ['queue_id_1', 'queue_id_2']
+    assert all(subscriptions_repo.get_subscriptions_by_pattern(Pattern(topic)) for topic in ('AU', 'CN', 'SG'))
+
+
+class TestSweepExpiredSubscriptionsUseCase:
+    @pytest.fixture(autouse=True)
+    def subscriptions(self, app, clean_subscriptions_repo):
+        self.repo = repos.SubscriptionsRepo(app.config['SUBSCRIPTIONS_REPO_CONF'])
+        with freeze_time('2020-06-17 12:00:00'):
+            self.repo.subscribe_by_pattern(Pattern('1'), 'http://callback.url/1', 60)
+            self.repo.subscribe_by_pattern(Pattern('2'), 'http://callback.url/1', 60)
+            self.repo.subscribe_by_pattern(Pattern('jurisdiction.AU'), 'http://callback.url/2', 3600)
+
+    def sweep(self, **kwargs):
+        with freeze_time('2020-06-17 12:30:00'):
+            return SweepExpiredSubscriptionsUseCase(self.repo, workers=2, **kwargs).execute()
+
+    def test_execute__should_delete_expired_subscriptions(self):
+        report = self.sweep()
+
+        assert {key: report[key] for key in ('scanned', 'expired', 'unreadable', 'deleted')} == {
+            'scanned': 3, 'expired': 2, 'unreadable': 0, 'deleted': 2,
+        }
+        assert not self.repo.get_subscriptions_by_pattern(Pattern('1'))
+        assert not self.repo.get_subscriptions_by_pattern(Pattern('2'))
+        assert self.repo.get_subscriptions_by_pattern(Pattern('jurisdiction.AU'))
+
+    def test_execute__when_renewed_during_sweep__should_keep_subscription(self):
+        iter_subscription_payloads = self.repo.iter_subscription_payloads
+
+        def iter_and_renew(workers):
+            yield from iter_subscription_payloads(workers)
+            self.repo.subscribe_by_pattern(Pattern('1'), 'http://callback.url/1', 60)
+
+        with mock.patch.object(self.repo, 'iter_subscription_payloads', iter_and_renew):
+            report = self.sweep()
+
+        assert {key: report[key] for key in ('expired', 'renewed', 'deleted')} == {
+            'expired': 2, 'renewed': 1, 'deleted': 1,
+        }
+        assert self.repo.get_subscriptions_by_pattern(Pattern('1'))
+        assert not self.repo.get_subscriptions_by_pattern(Pattern('2'))
+
+    def test_execute__when_dry_run__should_not_delete(self):
+        report = self.sweep(dry_run=True)
+
+        assert (report['expired'], report['deleted']) == (2, 0)
+        assert self.repo.get_subscriptions_by_pattern(Pattern('1'))
+
+
+class TestCompileSubscriptionsIndexUseCase:
+    @pytest.fixture(autouse=True)
+    def subscriptions(self, app, clean_subscriptions_repo):
+        self.repo = repos.SubscriptionsRepo(app.config['SUBSCRIPTIONS_REPO_CONF'], index_deltas=True)
+        with freeze_time('2020-06-17 12:00:00'):
+            self.repo.subscribe_by_pattern(Pattern('1'), 'http://callback.url/1', 60)
+            self.repo.subscribe_by_pattern(Pattern('jurisdiction.AU'), 'http://callback.url/1', 3600)
+            self.repo.subscribe_by_pattern(Pattern('jurisdiction.AU'), 'http://callback.url/2', 3600)
+
+    def compile(self, time='2020-06-17 12:30:00', **kwargs):
+        with freeze_time(time):
+            return CompileSubscriptionsIndexUseCase(self.repo, workers=2, **kwargs).execute()
+
+    def get_index(self, now='2020-06-17 12:30:00'):
+        index = SubscriptionsIndex(self.repo, refresh_interval=5, reload_interval=300)
+        with freeze_time(now), mock.patch('api.cache.time.monotonic', return_value=1000):
+            return {
+                topic: sorted(subscription.callback_url for subscription in index.get(topic))
+                for topic in ('1', 'jurisdiction.AU', '2')
+            }
+
+    def test_execute__should_compile_valid_subscriptions_by_topic(self):
+        report = self.compile()
+
+        assert report == {'scanned': 3, 'subscriptions': 2, 'topics': 1, 'deltas_deleted': 0}
+        index = self.repo.get_index()
+        assert index['after'] == self.repo.list_index_deltas()[-1]
+        assert list(index['topics']) == [Pattern('jurisdiction.AU').to_key()]
+
+    def test_execute__should_delete_deltas_older_than_retention(self):
+        report = self.compile(time='2020-06-17 14:00:00', delta_retention_seconds=3600)
+
+        assert report['deltas_deleted'] == 3
+        assert self.repo.list_index_deltas() == []
+
+    def test_index__should_apply_deltas_written_after_compile(self):
+        self.compile()
+        with freeze_time('2020-06-17 12:31:00'):
+            self.repo.subscribe_by_pattern(Pattern('2'), 'http://callback.url/3', 3600)
+            self.repo.bulk_delete([Pattern('jurisdiction.AU').to_key('http://callback.url/1')])
+
+        with mock.patch.object(self.repo, 'get_subscriptions_by_pattern') as get_subscriptions_by_pattern:
+            assert self.get_index() == {
+                '1': [],
+                'jurisdiction.AU': ['http://callback.url/2'],
+                '2': ['http://callback.url/3'],
+            }
+        assert not get_subscriptions_by_pattern.called
+
+    def test_index__when_not_compiled__should_read_repo(self):
+        assert self.get_index(now='2020-06-17 12:00:30') == {
+            '1': ['http://callback.url/1'],
+            'jurisdiction.AU': ['http://callback.url/1', 'http://callback.url/2'],
+            '2': [],
+        }
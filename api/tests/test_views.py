@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from unittest.mock import patch
 from urllib.parse import urlencode
@@ -8,7 +9,8 @@ from flask import url_for
 from freezegun import freeze_time
 from libtrustbridge.websub.domain import Pattern
 
-from api.models import Message, MessageStatus
+from api.cache import TTLCache
+from api.models import Message, MessageStatus, NotificationOutbox
 
 
 def test_index_view(client):
@@ -17,7 +19,7 @@ def test_index_view(client):
     assert response.json == {'service': 'shared-db-channel'}
 
 
-@pytest.mark.usefixtures("db_session", "client_class", "clean_notifications_repo")
+@pytest.mark.usefixtures("db_session", "client_class")
 class TestPostMessage:
     message_data = {
         "sender": "AU",
@@ -56,13 +58,116 @@ class TestPostMessage:
         assert response.headers['Link'] == ('<http://testing/messages/subscriptions/by_id>; rel="hub", '
                                             f'<{message_id}>; rel="self"')
 
-    def test_message__when_posted__should_publish_notification(self):
+    def test_message__when_posted__should_add_notification_to_outbox(self):
         response = self.client.post(url_for('views.post_message'), json=self.message_data)
         message_id = response.json['id']
-        message_update_notification = self.notifications_repo.get_job()
+        notification = NotificationOutbox.query.one()
+
+        assert notification.payload == {'content': {'id': message_id}, 'topic': str(message_id)}
+
+
+@pytest.mark.usefixtures("db_session", "client_class")
+class TestPostMessagesBatch:
+    message_data = TestPostMessage.message_data
+
+    def test_post_batch__when_all_valid__should_create_messages(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=[self.message_data, self.message_data])
+        assert response.status_code == 201, response.json
+        assert response.json == {'messages': [{'id': 1}, {'id': 2}]}
+        assert response.headers['Link'] == '<http://testing/messages/subscriptions/by_id>; rel="hub"'
+
+        messages = Message.query.order_by(Message.id).all()
+        assert [m.payload for m in messages] == [self.message_data, self.message_data]
+        assert all(m.status == MessageStatus.CONFIRMED for m in messages)
+
+    def test_post_batch__when_some_invalid__should_create_valid_and_return_errors(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=[{'sender': 'AU'}, self.message_data])
+        assert response.status_code == 207, response.json
+        assert response.json == {'messages': [
+            {'errors': {
+                'obj': ['Missing data for required field.'],
+                'predicate': ['Missing data for required field.'],
+                'receiver': ['Missing data for required field.'],
+                'subject': ['Missing data for required field.'],
+            }},
+            {'id': 1},
+        ]}
+        assert Message.query.count() == 1
+
+    def test_post_batch__should_add_notification_to_outbox_for_each_created_message(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=[self.message_data, {}])
+        message_id = response.json['messages'][0]['id']
+
+        notifications = NotificationOutbox.query.all()
+        assert [n.payload for n in notifications] == [{'content': {'id': message_id}, 'topic': str(message_id)}]
+
+    def test_post_batch__when_not_a_list__should_return_400(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=self.message_data)
+        assert response.status_code == 400
+        assert response.json == {'_schema': ['Expected a list of messages.']}
+
+    def test_post_batch__when_too_large__should_return_400(self, app):
+        with patch.dict(app.config, {'MESSAGES_BATCH_MAX_SIZE': 1}):
+            response = self.client.post(
+                url_for('views.post_messages_batch'), json=[self.message_data, self.message_data]
+            )
+        assert response.status_code == 400
+        assert response.json == {'_schema': ['Batch may contain at most 1 messages.']}
+        assert Message.query.count() == 0
+
+
+@pytest.mark.usefixtures("client_class")
+class TestListMessages:
+    @pytest.fixture(autouse=True)
+    def messages(self, db_session):
+        self.db_session = db_session
+        with freeze_time('2020-06-17 12:04:01.111111'):
+            self.messages = [
+                Message(payload={"sender": "AU", "receiver": "CN"}),
+                Message(payload={"sender": "AU", "receiver": "SG"}),
+                Message(payload={"sender": "SG", "receiver": "CN"}),
+            ]
+            db_session.add_all(self.messages)
+            db_session.commit()
+
+    def test_list__should_return_messages_in_cursor_order(self):
+        response = self.client.get(url_for('views.list_messages'))
+        assert response.status_code == 200
+        assert [m['id'] for m in response.json['messages']] == [m.id for m in self.messages]
+        assert response.json['next_cursor'] is None
+
+    def test_list__when_filtered__should_return_only_matching_messages(self):
+        response = self.client.get(url_for('views.list_messages', receiver='CN', sender='SG', fields='id'))
+        assert response.status_code == 200
+        assert response.json['messages'] == [{'id': self.messages[2].id}]
+
+    def test_list__when_more_than_limit__should_return_next_page_by_cursor(self):
+        response = self.client.get(url_for('views.list_messages', limit=2))
+        assert [m['id'] for m in response.json['messages']] == [self.messages[0].id, self.messages[1].id]
+        next_cursor = response.json['next_cursor']
+        assert next_cursor
 
-        assert message_update_notification
-        assert message_update_notification[1] == {'content': {'id': message_id}, 'topic': str(message_id)}
+        response = self.client.get(url_for('views.list_messages', limit=2, cursor=next_cursor))
+        assert [m['id'] for m in response.json['messages']] == [self.messages[2].id]
+        assert response.json['next_cursor'] is None
+
+    def test_list__when_invalid_cursor__should_return_400(self):
+        response = self.client.get(url_for('views.list_messages', cursor='invalid'))
+        assert response.status_code == 400
+        assert response.json == {'cursor': ['Invalid cursor.']}
+
+    def test_list__when_ndjson_accepted__should_stream_message_per_line(self):
+        response = self.client.get(
+            url_for('views.list_messages', receiver='CN', fields='id,status'),
+            headers={'Accept': 'application/x-ndjson'}
+        )
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == [
+            {'id': self.messages[0].id, 'status': 'confirmed'},
+            {'id': self.messages[2].id, 'status': 'confirmed'},
+        ]
 
 
 @pytest.mark.usefixtures("db_session", "client_class")
@@ -94,7 +199,76 @@ class TestGetMessage:
         }
 
 
-@pytest.mark.usefixtures("client_class", 'clean_notifications_repo')
+@pytest.mark.usefixtures("db_session", "client_class")
+class TestMessageCache:
+    @pytest.fixture(autouse=True)
+    def message_cache(self, app):
+        self.message_cache = TTLCache(maxsize=10, ttl=60)
+        with patch.dict(app.extensions, {'message_cache': self.message_cache}):
+            yield
+
+    def test_get_message__should_return_etag_derived_from_updated_at(self, message):
+        response = self.client.get(url_for('views.get_message', id=message.id))
+        assert response.status_code == 200
+        assert response.headers['ETag'] == 'W/"42-20200407142122123456"'
+
+    def test_get_message__when_etag_matches__should_return_304(self, message):
+        url = url_for('views.get_message', id=message.id)
+        etag = self.client.get(url).headers['ETag']
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert not response.data
+
+    def test_get_message__when_cached__should_serve_cached_body(self, message):
+        url = url_for('views.get_message', id=message.id)
+        self.client.get(url)
+        data, etag = self.message_cache.get(str(message.id))
+        self.message_cache.set(str(message.id), (dict(data, status='cached'), etag))
+
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert response.json['status'] == 'cached'
+
+    def test_get_message__when_updated_by_other_process__should_not_serve_stale_cache(self, message, db_session):
+        url = url_for('views.get_message', id=message.id)
+        etag = self.client.get(url).headers['ETag']
+        message.status = MessageStatus.REVOKED
+        message.updated_at = datetime(2020, 4, 7, 14, 22, 0)
+        db_session.commit()
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json['status'] == 'revoked'
+        assert response.headers['ETag'] != etag
+
+    def test_get_message__when_deleted__should_return_404(self, message, db_session):
+        url = url_for('views.get_message', id=message.id)
+        self.client.get(url)
+        db_session.delete(message)
+        db_session.commit()
+
+        assert self.client.get(url).status_code == 404
+
+    def test_post_message__should_warm_cache(self):
+        response = self.client.post(url_for('views.post_message'), json=TestPostMessage.message_data)
+        data, etag = self.message_cache.get(str(response.json['id']))
+        assert data == {'id': response.json['id'], 'status': 'confirmed', 'message': TestPostMessage.message_data}
+
+    def test_update_message_status__should_invalidate_cache(self, message):
+        url = url_for('views.get_message', id=message.id)
+        self.client.get(url)
+
+        self.client.put(
+            url_for('views.update_message_status', id=message.id),
+            mimetype='application/x-www-form-urlencoded',
+            data=urlencode({'status': 'revoked'})
+        )
+        assert self.message_cache.get(str(message.id)) is None
+        assert self.client.get(url).json['status'] == 'revoked'
+
+
+@pytest.mark.usefixtures("client_class")
 class TestUpdateMessageStatus:
     @pytest.fixture(autouse=True)
     def message(self, request, db_session):
@@ -114,7 +288,7 @@ class TestUpdateMessageStatus:
 
         self.db_session.refresh(self.message)
         assert self.message.status == MessageStatus.REVOKED
-        assert self.notifications_repo.get_job()[1] == {
+        assert NotificationOutbox.query.one().payload == {
             'content': {'id': self.message.id}, 'topic': str(self.message.id)
         }
 
@@ -136,6 +310,65 @@ class TestUpdateMessageStatus:
         assert response.status_code == 404, response.json
 
 
+@pytest.mark.usefixtures("client_class")
+class TestUpdateMessagesStatus:
+    @pytest.fixture(autouse=True)
+    def messages(self, request, db_session):
+        self.db_session = db_session
+        self.messages = [Message(payload={"sender": "AU"}), Message(payload={"sender": "SG"})]
+        self.db_session.add_all(self.messages)
+        self.db_session.commit()
+
+    def test_put__with_new_statuses__should_update_all_and_send_notifications(self):
+        first, second = self.messages
+        response = self.client.put(url_for('views.update_messages_status'), json=[
+            {'id': first.id, 'status': 'revoked'},
+            {'id': second.id, 'status': 'received'},
+        ])
+        assert response.status_code == 200, response.json
+        assert response.json == {'messages': [
+            {'id': first.id, 'status': 'revoked'},
+            {'id': second.id, 'status': 'received'},
+        ]}
+
+        self.db_session.refresh(first)
+        self.db_session.refresh(second)
+        assert first.status == MessageStatus.REVOKED
+        assert second.status == MessageStatus.RECEIVED
+        assert sorted(outbox.payload['topic'] for outbox in NotificationOutbox.query) == sorted(
+            [str(first.id), str(second.id)]
+        )
+
+    def test_put__with_invalid_and_missing_items__should_update_valid_and_return_errors(self):
+        first, second = self.messages
+        response = self.client.put(url_for('views.update_messages_status'), json=[
+            {'id': first.id, 'status': 'WRONG-STATUS'},
+            {'id': 444, 'status': 'revoked'},
+            {'id': second.id, 'status': 'revoked'},
+        ])
+        assert response.status_code == 207, response.json
+        assert response.json == {'messages': [
+            {'errors': {'status': ['Invalid enum value WRONG-STATUS']}},
+            {'errors': {'id': ['Message not found.']}},
+            {'id': second.id, 'status': 'revoked'},
+        ]}
+
+        self.db_session.refresh(first)
+        assert first.status == MessageStatus.CONFIRMED
+        assert NotificationOutbox.query.one().payload['topic'] == str(second.id)
+
+    def test_put__when_not_a_list__should_return_400(self):
+        response = self.client.put(url_for('views.update_messages_status'), json={'id': 1, 'status': 'revoked'})
+        assert response.status_code == 400, response.json
+
+    def test_put__when_batch_too_large__should_return_400(self, app):
+        with patch.dict(app.config, {'MESSAGES_BATCH_MAX_SIZE': 1}):
+            response = self.client.put(url_for('views.update_messages_status'), json=[
+                {'id': message.id, 'status': 'revoked'} for message in self.messages
+            ])
+        assert response.status_code == 400, response.json
+
+
 @pytest.mark.usefixtures("client_class", "clean_subscriptions_repo", "mocked_responses")
 class TestSubscriptions:
     MOCKED_UUID_VALUE = 'UUID'
@@ -264,3 +497,179 @@ class TestSubscriptions:
         )
         assert response.status_code == 202, response.json
         assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('jurisdiction.AU'))
+
+    @patch('uuid.uuid4', return_value=MOCKED_UUID_VALUE)
+    def test_post__with_wildcard__should_subscribe_to_any_jurisdiction(self, mocked_uuid):
+        self.mocked_responses.add(
+            responses.GET,
+            'https://callback.url/1?hub.mode=subscribe&hub.topic=jurisdiction.%2A'
+            '&hub.challenge=UUID&hub.lease_seconds=432000',
+            body=self.MOCKED_UUID_VALUE
+        )
+        params = {
+            'hub.mode': 'subscribe',
+            'hub.callback': 'https://callback.url/1',
+            'hub.topic': '*',
+        }
+        response = self.client.post(
+            url_for('views.subscriptions_by_jurisdiction'),
+            mimetype='application/x-www-form-urlencoded',
+            data=urlencode(params)
+        )
+        assert response.status_code == 202, response.json
+        assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('jurisdiction.*'))
+
+    def test_post__with_wildcard_not_last__should_return_error(self):
+        params = {
+            'hub.mode': 'subscribe',
+            'hub.callback': 'https://callback.url/1',
+            'hub.topic': '*.status',
+        }
+        response = self.do_subscribe_by_id_request(params)
+        assert response.status_code == 400
+        assert response.json == {'topic': ['The * wildcard is only allowed as the last topic segment.']}
+        assert not self.mocked_responses.calls
+
+
+@pytest.mark.usefixtures(
+    "client_class", "clean_subscriptions_repo", "clean_intent_verification_repo", "mocked_responses"
+)
+class TestSubscriptionsAsyncVerification:
+    @pytest.fixture(autouse=True)
+    def async_verification(self, app):
+        with patch.dict(app.config, {'INTENT_VERIFICATION_ASYNC': True}):
+            yield
+
+    def do_request(self, params):
+        return self.client.post(
+            url_for('views.subscriptions_by_jurisdiction'),
+            mimetype='application/x-www-form-urlencoded',
+            data=urlencode(params)
+        )
+
+    def test_post__should_queue_verification_without_calling_callback(self):
+        response = self.do_request({
+            'hub.mode': 'subscribe',
+            'hub.callback': 'https://callback.url/1',
+            'hub.topic': 'AU',
+        })
+
+        assert response.status_code == 202, response.json
+        assert not self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('jurisdiction.AU'))
+        queue_msg_id, job = self.intent_verification_repo.get_job()
+        assert job == {
+            'callback': 'https://callback.url/1',
+            'mode': 'subscribe',
+            'topic': 'jurisdiction.AU',
+            'lease_seconds': 432000,
+        }
+
+    def test_post__when_unsubscribing_not_subscribed__should_not_queue_verification(self):
+        response = self.do_request({
+            'hub.mode': 'unsubscribe',
+            'hub.callback': 'https://callback.url/1',
+            'hub.topic': 'AU',
+        })
+
+        assert response.status_code == 404, response.json
+        assert not self.intent_verification_repo.get_job()
+
+
+@pytest.mark.usefixtures(
+    "client_class", "clean_subscriptions_repo", "clean_intent_verification_repo", "mocked_responses"
+)
+class TestSubscriptionsBulk:
+    MOCKED_UUID_VALUE = 'UUID'
+
+    @patch('uuid.uuid4', return_value=MOCKED_UUID_VALUE)
+    def do_request(self, data, uuid_mock):
+        return self.client.post(url_for('views.subscriptions_bulk'), json=data)
+
+    def add_callback_response(self, mode, topic, body=MOCKED_UUID_VALUE):
+        self.mocked_responses.add(
+            responses.GET,
+            f'https://callback.url/1?hub.mode={mode}&hub.topic={topic}&hub.challenge=UUID&hub.lease_seconds=3600',
+            body=body
+        )
+
+    def test_post__should_verify_and_subscribe_each_topic(self):
+        self.add_callback_response('subscribe', '1')
+        self.add_callback_response('subscribe', 'jurisdiction.AU')
+        response = self.do_request({
+            'callback': 'https://callback.url/1',
+            'mode': 'subscribe',
+            'topics': ['1'],
+            'jurisdictions': ['AU'],
+            'lease_seconds': 3600,
+        })
+
+        assert response.status_code == 200, response.json
+        assert response.json == {'topics': [
+            {'topic': '1', 'verified': True},
+            {'topic': 'jurisdiction.AU', 'verified': True},
+        ]}
+        assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('1'))
+        assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('jurisdiction.AU'))
+
+    def test_post__when_verification_failed_for_some_topics__should_subscribe_the_rest(self):
+        self.add_callback_response('subscribe', '1')
+        self.add_callback_response('subscribe', '2', body='WRONG')
+        response = self.do_request({
+            'callback': 'https://callback.url/1',
+            'mode': 'subscribe',
+            'topics': ['1', '2'],
+            'lease_seconds': 3600,
+        })
+
+        assert response.status_code == 207, response.json
+        assert response.json['topics'][1] == {'topic': '2', 'verified': False}
+        assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('1'))
+        assert not self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('2'))
+
+    def test_post__with_unsubscribe_mode__should_unsubscribe_verified_topics(self):
+        self.subscriptions_repo.subscribe_by_pattern(Pattern('1'), 'https://callback.url/1', 30)
+        self.subscriptions_repo.subscribe_by_pattern(Pattern('2'), 'https://callback.url/1', 30)
+        self.add_callback_response('unsubscribe', '1')
+        response = self.do_request({
+            'callback': 'https://callback.url/1',
+            'mode': 'unsubscribe',
+            'topics': ['1'],
+            'lease_seconds': 3600,
+        })
+
+        assert response.status_code == 200, response.json
+        assert not self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('1'))
+        assert self.subscriptions_repo.get_subscriptions_by_pattern(Pattern('2'))
+
+    def test_post__when_async_verification__should_queue_one_job(self, app):
+        with patch.dict(app.config, {'INTENT_VERIFICATION_ASYNC': True}):
+            response = self.do_request({
+                'callback': 'https://callback.url/1',
+                'mode': 'subscribe',
+                'topics': ['1', '2'],
+            })
+
+        assert response.status_code == 202, response.json
+        queue_msg_id, job = self.intent_verification_repo.get_job()
+        assert job == {
+            'callback': 'https://callback.url/1',
+            'mode': 'subscribe',
+            'topics': ['1', '2'],
+            'lease_seconds': 432000,
+        }
+
+    def test_post__without_topics__should_return_error(self):
+        response = self.do_request({'callback': 'https://callback.url/1', 'mode': 'subscribe'})
+
+        assert response.status_code == 400
+        assert response.json == {'topics': ['At least one topic or jurisdiction is required.']}
+
+    def test_post__when_too_many_topics__should_return_error(self, app):
+        with patch.dict(app.config, {'SUBSCRIPTIONS_BATCH_MAX_SIZE': 1}):
+            response = self.do_request({
+                'callback': 'https://callback.url/1',
+                'mode': 'subscribe',
+                'topics': ['1', '2'],
+            })
+
+        assert response.status_code == 400, response.json
@@ -0,0 +1,30 @@
+"""
+Topics are dot separated, a subscription topic may end with the `*` wildcard
+segment matching any non-empty rest of the topic: `jurisdiction.*` matches
+`jurisdiction.AU` and `*` matches every topic.
+
+Subscriptions stay indexed by their topic pattern, so the subscriptions of a
+published topic are looked up with one index lookup per topic segment,
+see get_matching_patterns, regardless of the number of subscriptions.
+"""
+SEPARATOR = '.'
+WILDCARD = '*'
+
+
+def is_valid_pattern(topic):
+    """
+    The wildcard is only allowed as the whole last segment
+    """
+    *prefix, last = topic.split(SEPARATOR)
+    return all(WILDCARD not in segment for segment in prefix) and (last == WILDCARD or WILDCARD not in last)
+
+
+def get_matching_patterns(topic):
+    """
+    Subscription topics matching the published topic, most specific first:
+    'jurisdiction.AU' -> ['jurisdiction.AU', 'jurisdiction.*', '*']
+    """
+    segments = topic.split(SEPARATOR)
+    return [topic] + [
+        SEPARATOR.join(segments[:depth] + [WILDCARD]) for depth in range(len(segments) - 1, -1, -1)
+    ]
@@ -1,15 +1,28 @@
+import asyncio
+import concurrent.futures
 import logging
+import math
 import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime
+from urllib.parse import urlparse
 
+import aiohttp
 import requests
 from libtrustbridge.repos.miniorepo import MinioRepo
 from libtrustbridge.websub import repos
+from libtrustbridge.websub.constants import MODE_ATTR_SUBSCRIBE_VALUE
 from libtrustbridge.websub.domain import Pattern
 from botocore.exceptions import ClientError
 
-from api import models
+from api import metrics, models
 from api.app import db
+from api.circuit_breaker import CircuitBreaker
+from api.http_client import HttpSession, http_stats
+from api.topics import get_matching_patterns
 
 logger = logging.getLogger(__name__)
 
@@ -18,54 +31,144 @@ class NewMessagesNotifyUseCase:
     """
     Query shared database in order to receive new messages directed
     to the endpoint and send notification for each message.
+
+    The (updated_at, id) cursor of the last notified message is kept in memory,
+    it is read from the channel repo once and checkpointed back
+    every checkpoint_every messages or checkpoint_interval_ms milliseconds
+    and on shutdown. Messages notified after the last checkpoint
+    are notified again if the observer crashes.
+
+    If listener is given, execute blocks until the listener is signalled
+    about new messages for the receiver, or fallback_poll_seconds passed.
+    execute returns True if any message was notified and None otherwise.
     """
     TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+    CHUNK_SIZE = 1000
+    CHECKPOINT_EVERY = 100
+    CHECKPOINT_INTERVAL_MS = 1000
+    FALLBACK_POLL_SECONDS = 60
 
-    def __init__(self, receiver, channel_repo: MinioRepo, notifications_repo: repos.NotificationsRepo):
+    def __init__(
+            self, receiver, channel_repo: MinioRepo, notifications_repo: repos.NotificationsRepo,
+            chunk_size=CHUNK_SIZE, checkpoint_every=CHECKPOINT_EVERY, checkpoint_interval_ms=CHECKPOINT_INTERVAL_MS,
+            listener=None, fallback_poll_seconds=FALLBACK_POLL_SECONDS):
         self.channel_repo = channel_repo
         self.notifications_repo = notifications_repo
         self.receiver = receiver
+        self.chunk_size = chunk_size
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval_ms = checkpoint_interval_ms
+        self.listener = listener
+        self.fallback_poll_seconds = fallback_poll_seconds
+        self.cursor = None
+        self._not_checkpointed = 0
+        self._checkpointed_at = time.monotonic()
 
     def execute(self):
-        since = self.get_last_updated_at()
-        if not since:
+        if self.cursor is None:
+            self.cursor = self.get_cursor()
+        if self.cursor is None:
             logger.warning("No last updated_at, using now")
-            since = datetime.utcnow()
-            self.set_last_updated_at(since)
+            self.cursor = (datetime.utcnow(), None)
+            self.checkpoint()
 
-        messages = self.get_new_messages(receiver=self.receiver, since=since)
+        since, since_id = self.cursor
         use_case = PublishNewMessageUseCase(self.notifications_repo)
-        if messages:
-            logger.info(
-                "There are %s new messages to be notified since %sZ",
-                len(messages), since
-            )
-        for message in messages:
+        count = 0
+        for message in self.iter_new_messages(receiver=self.receiver, since=since, since_id=since_id):
             logger.debug('processing message: %s', message.id)
             # TODO error handling to be implemented
             use_case.publish(message)
-            self.set_last_updated_at(message.updated_at)
+            self.cursor = (message.updated_at, message.id)
+            metrics.OBSERVER_LAG_SECONDS.set((datetime.utcnow() - message.updated_at).total_seconds())
+            self._not_checkpointed += 1
+            self._checkpoint_if_due()
+            count += 1
+        self._checkpoint_if_due()
+        if count:
+            logger.info("Notified about %s new messages since %sZ", count, since)
+        else:
+            metrics.OBSERVER_LAG_SECONDS.set(0)
+
+        if self.listener is not None:
+            # nothing else to do while waiting, save the cursor now
+            if self._not_checkpointed:
+                self.checkpoint()
+            if not self.listener.wait(self.fallback_poll_seconds):
+                logger.debug("No notifications for %s, fallback poll", self.receiver)
+        if count:
+            return True
+
+    def _checkpoint_if_due(self):
+        if not self._not_checkpointed:
+            return
+        elapsed_ms = (time.monotonic() - self._checkpointed_at) * 1000
+        if self._not_checkpointed >= self.checkpoint_every or elapsed_ms >= self.checkpoint_interval_ms:
+            self.checkpoint()
 
-    def set_last_updated_at(self, updated_at: datetime):
-        updated_at_str = updated_at.strftime(self.TIMESTAMP_FORMAT)
-        self.channel_repo.put_object(clean_path='updated_at', content_body=updated_at_str)
+    def checkpoint(self):
+        """
+        Save the in-memory cursor into the channel repo
+        """
+        if self.cursor is None:
+            return
+        self.set_last_updated_at(*self.cursor)
+        self._not_checkpointed = 0
+        self._checkpointed_at = time.monotonic()
 
-    def get_new_messages(self, receiver: str, since: datetime):
-        messages = db.session.query(models.Message).filter(
-            models.Message.payload['receiver'].as_string() == receiver,
-            models.Message.updated_at > since
-        ).order_by(models.Message.updated_at.asc()).all()
-        return messages
+    def set_last_updated_at(self, updated_at: datetime, message_id: int = None):
+        cursor_str = updated_at.strftime(self.TIMESTAMP_FORMAT)
+        if message_id is not None:
+            cursor_str = f'{cursor_str} {message_id}'
+        self.channel_repo.put_object(clean_path='updated_at', content_body=cursor_str)
+
+    def get_new_messages(self, receiver: str, since: datetime, since_id: int = None):
+        return list(self.iter_new_messages(receiver, since, since_id))
+
+    def iter_new_messages(self, receiver: str, since: datetime, since_id: int = None):
+        """
+        Yield (id, receiver, updated_at) rows of messages changed after the given cursor.
+
+        Rows are read in pages of chunk_size using keyset pagination on (updated_at, id),
+        each page is streamed through a server-side cursor,
+        so memory usage doesn't depend on the size of the backlog.
+        """
+        Message = models.Message
+        while True:
+            query = db.session.query(Message.id, Message.receiver, Message.updated_at).filter(
+                Message.receiver == receiver,
+                Message.after_cursor(since, since_id)
+            ).order_by(*Message.cursor_order()).limit(self.chunk_size)
+
+            count = 0
+            # yield_per enables stream_results, ie. server-side cursor
+            for row in query.yield_per(self.chunk_size):
+                count += 1
+                since, since_id = row.updated_at, row.id
+                yield row
+            if count < self.chunk_size:
+                return
 
     def get_last_updated_at(self):
+        cursor = self.get_cursor()
+        if cursor:
+            return cursor[0]
+
+    def get_cursor(self):
+        """
+        Return (updated_at, id) cursor saved in the channel repo,
+        id is None for cursors saved as a plain timestamp
+        """
         try:
-            updated_at_str = self.channel_repo.get_object_content('updated_at').decode()
-            return datetime.strptime(updated_at_str, self.TIMESTAMP_FORMAT)
+            cursor_str = self.channel_repo.get_object_content('updated_at').decode()
         except ClientError as ex:
             if ex.response['Error']['Code'] == 'NoSuchKey':
                 logger.warning('updated_at not found')
-            else:
-                raise
+                return
+            raise
+        updated_at_str, _, message_id = cursor_str.partition(' ')
+        updated_at = datetime.strptime(updated_at_str, self.TIMESTAMP_FORMAT)
+        return updated_at, int(message_id) if message_id else None
 
 
 class SubscriptionRegisterUseCase:
@@ -100,13 +203,324 @@ class SubscriptionDeregisterUseCase:
     def __init__(self, subscriptions_repo: repos.SubscriptionsRepo):
         self.subscriptions_repo = subscriptions_repo
 
+    def is_subscribed(self, url, topic):
+        subscriptions = self.subscriptions_repo.get_subscriptions_by_pattern(Pattern(topic))
+        return any(s.callback_url == url for s in subscriptions)
+
     def execute(self, url, topic):
-        pattern = Pattern(topic)
-        subscriptions = self.subscriptions_repo.get_subscriptions_by_pattern(pattern)
-        subscriptions_by_url = [s for s in subscriptions if s.callback_url == url]
-        if not subscriptions_by_url:
+        if not self.is_subscribed(url, topic):
             raise SubscriptionNotFound()
-        self.subscriptions_repo.bulk_delete([pattern.to_key(url)])
+        self.subscriptions_repo.bulk_delete([Pattern(topic).to_key(url)])
+
+
+class IntentVerificationFailure(Exception):
+    pass
+
+
+def verify_intent(http_session, callback_url, mode, topic, lease_seconds):
+    """
+    Ask the subscriber to echo a challenge back, as WebSub intent verification requires,
+    raises IntentVerificationFailure unless it does
+
+    https://www.w3.org/TR/websub/#hub-verifies-intent
+    """
+    challenge = str(uuid.uuid4())
+    params = {
+        'hub.mode': mode,
+        'hub.topic': topic,
+        'hub.challenge': challenge,
+        'hub.lease_seconds': lease_seconds
+    }
+    try:
+        response = http_session.get(callback_url, params=params)
+    except requests.RequestException:
+        raise IntentVerificationFailure()
+    if response.status_code == 200 and response.text == challenge:
+        return
+
+    raise IntentVerificationFailure()
+
+
+class VerifyIntentUseCase:
+    """
+    Used by the intent verification worker.
+
+    Reads subscription requests accepted by the API from the verification queue
+    as {'callback', 'mode', 'topic', 'lease_seconds'} jobs, or bulk requests
+    with 'topics' handled by BulkSubscriptionUseCase, verifies
+    the subscriber's intent and then subscribes or unsubscribes it.
+    Requests which fail the verification are dropped.
+
+    Up to max_concurrency jobs are verified at a time on a thread pool,
+    every execute call receives more jobs while there are free slots
+    and then waits until any of them completes. Verification requests of all
+    the jobs, bulk ones included, share a semaphore of max_concurrency slots.
+    Pool threads only make the HTTP requests, subscriptions are written
+    by the calling thread, which has the application context the repos need.
+    Jobs failed with an unexpected error are left in the queue to be received again.
+    """
+
+    WAIT_INTERVAL = 1
+
+    def __init__(
+            self, verification_repo, subscriptions_repo: repos.SubscriptionsRepo, http_session=None,
+            max_concurrency=10, batch_size=10, wait_seconds=0):
+        self.verification_repo = verification_repo
+        self.subscriptions_repo = subscriptions_repo
+        # requests sessions are shared by the pool threads, keep pool_maxsize >= max_concurrency
+        self.http_session = http_session or HttpSession(pool_maxsize=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        self.verifications = threading.BoundedSemaphore(max_concurrency)
+        self.in_flight = {}
+
+    def execute(self):
+        free_slots = self.max_concurrency - len(self.in_flight)
+        if free_slots > 0:
+            # don't block on receive while there are verifications to wait for
+            wait_seconds = 0 if self.in_flight else self.wait_seconds
+            jobs = self.verification_repo.get_jobs(min(self.batch_size, free_slots), wait_seconds)
+            for queue_msg_id, job in jobs:
+                self.in_flight[self.executor.submit(self.verify, job)] = (queue_msg_id, job)
+
+        if not self.in_flight:
+            return
+        done, _ = concurrent.futures.wait(
+            self.in_flight, timeout=self.WAIT_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        self._finish(done)
+        return True
+
+    def close(self):
+        """
+        Wait for verifications in flight and stop the thread pool
+        """
+        if self.in_flight:
+            done, _ = concurrent.futures.wait(self.in_flight)
+            self._finish(done)
+        self.executor.shutdown()
+
+    def _finish(self, done):
+        finished_ids = []
+        for future in done:
+            queue_msg_id, job = self.in_flight.pop(future)
+            try:
+                self.write(job, future.result())
+            except Exception as e:
+                logger.error("[%s] intent verification failed with an error", queue_msg_id, exc_info=e)
+                continue
+            finished_ids.append(queue_msg_id)
+        if finished_ids:
+            self.verification_repo.delete_jobs(finished_ids)
+
+    def _get_bulk_use_case(self):
+        return BulkSubscriptionUseCase(
+            self.subscriptions_repo, self.http_session, self.max_concurrency, verifications=self.verifications
+        )
+
+    def verify(self, job):
+        """
+        Verify the intent on a pool thread, returns {topic: True if verified}
+        """
+        if 'topics' in job:
+            return self._get_bulk_use_case().verify(job['callback'], job['mode'], job['topics'], job['lease_seconds'])
+        callback, mode, topic = job['callback'], job['mode'], job['topic']
+        try:
+            with self.verifications:
+                verify_intent(self.http_session, callback, mode, topic, job['lease_seconds'])
+        except IntentVerificationFailure:
+            logger.info("Intent verification failed for %s, %s to %s ignored", callback, mode, topic)
+            return {topic: False}
+        return {topic: True}
+
+    def write(self, job, verified):
+        """
+        Subscribe or unsubscribe the verified topics of the job
+        """
+        if 'topics' in job:
+            self._get_bulk_use_case().write(job['callback'], job['mode'], verified, job['lease_seconds'])
+            return
+        callback, mode, topic = job['callback'], job['mode'], job['topic']
+        if not verified[topic]:
+            return
+        if mode == MODE_ATTR_SUBSCRIBE_VALUE:
+            SubscriptionRegisterUseCase(self.subscriptions_repo).execute(callback, topic, job['lease_seconds'])
+            logger.info("Subscribed %s to %s", callback, topic)
+            return
+        try:
+            SubscriptionDeregisterUseCase(self.subscriptions_repo).execute(callback, topic)
+        except SubscriptionNotFound:
+            logger.info("%s is not subscribed to %s anymore", callback, topic)
+        else:
+            logger.info("Unsubscribed %s from %s", callback, topic)
+
+
+class BulkSubscriptionUseCase:
+    """
+    Used by the bulk subscriptions API and the intent verification worker.
+
+    Subscribes or unsubscribes one callback to many topics. WebSub verifies
+    the intent per topic, so the topics are verified concurrently,
+    up to max_concurrency at a time, and the verified ones are written
+    with a single bulk_subscribe or bulk_delete call.
+    The verifications semaphore limits verification requests in flight,
+    callers running several use cases at once pass a shared one.
+    Returns {topic: True if verified}.
+    """
+
+    def __init__(
+            self, subscriptions_repo: repos.SubscriptionsRepo, http_session, max_concurrency=10, verifications=None):
+        self.subscriptions_repo = subscriptions_repo
+        self.http_session = http_session
+        self.max_concurrency = max_concurrency
+        self.verifications = verifications or threading.BoundedSemaphore(max_concurrency)
+
+    def execute(self, callback, mode, topics, lease_seconds):
+        verified = self.verify(callback, mode, topics, lease_seconds)
+        self.write(callback, mode, verified, lease_seconds)
+        return verified
+
+    def verify(self, callback, mode, topics, lease_seconds):
+        """
+        Verify the topics on pool threads, which must not touch the repo, returns {topic: True if verified}
+        """
+        topics = list(OrderedDict.fromkeys(topics))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return dict(zip(topics, executor.map(
+                lambda topic: self._verify(callback, mode, topic, lease_seconds), topics
+            )))
+
+    def write(self, callback, mode, verified, lease_seconds):
+        """
+        Subscribe or unsubscribe the verified topics of {topic: True if verified}
+        """
+        verified_topics = [topic for topic, is_verified in verified.items() if is_verified]
+        if verified_topics and mode == MODE_ATTR_SUBSCRIBE_VALUE:
+            self.subscriptions_repo.bulk_subscribe(
+                [Pattern(topic) for topic in verified_topics], callback, lease_seconds
+            )
+        elif verified_topics:
+            self.subscriptions_repo.bulk_delete([Pattern(topic).to_key(callback) for topic in verified_topics])
+        logger.info(
+            "%s %s to %s of %s topics", mode.capitalize(), callback, len(verified_topics), len(verified)
+        )
+
+    def _verify(self, callback, mode, topic, lease_seconds):
+        try:
+            with self.verifications:
+                verify_intent(self.http_session, callback, mode, topic, lease_seconds)
+        except IntentVerificationFailure:
+            logger.info("Intent verification failed for %s, %s to %s ignored", callback, mode, topic)
+            return False
+        return True
+
+
+class SweepExpiredSubscriptionsUseCase:
+    """
+    Used by the sweep_subscriptions command.
+
+    Reads all subscriptions, a page at a time on a pool of `workers` threads,
+    and deletes those with expired leases in bulk_delete calls
+    of up to DELETE_BATCH_SIZE keys.
+    Subscriptions of a batch are read again right before the delete,
+    those renewed since the scan read them are kept.
+    """
+    DELETE_BATCH_SIZE = 1000
+    WORKERS = 8
+
+    def __init__(self, subscriptions_repo: repos.SubscriptionsRepo, workers=WORKERS, dry_run=False):
+        self.subscriptions_repo = subscriptions_repo
+        self.workers = workers
+        self.dry_run = dry_run
+
+    def execute(self):
+        """
+        Returns a report of scanned, expired, renewed and deleted subscriptions and bytes reclaimed
+        """
+        report = {'scanned': 0, 'expired': 0, 'unreadable': 0, 'renewed': 0, 'deleted': 0, 'bytes_reclaimed': 0}
+        expired = {}
+        for key, size, payload in self.subscriptions_repo.iter_subscription_payloads(self.workers):
+            report['scanned'] += 1
+            if payload is None:
+                report['unreadable'] += 1
+            elif not repos.Subscription(payload=payload, key=key).is_valid:
+                report['expired'] += 1
+                expired[key] = size
+            if len(expired) >= self.DELETE_BATCH_SIZE:
+                self._delete(expired, report)
+                expired = {}
+        self._delete(expired, report)
+        logger.info("Subscriptions sweep: %s", report)
+        return report
+
+    def _delete(self, expired, report):
+        """
+        Delete {key: size} subscriptions that are still expired
+        """
+        if not expired or self.dry_run:
+            return
+        payloads = self.subscriptions_repo.get_subscription_payloads(list(expired), self.workers)
+        keys = [
+            key for key, payload in payloads.items()
+            if payload is not None and not repos.Subscription(payload=payload, key=key).is_valid
+        ]
+        report['renewed'] += len(expired) - len(keys)
+        if not keys:
+            return
+        self.subscriptions_repo.bulk_delete(keys)
+        report['deleted'] += len(keys)
+        report['bytes_reclaimed'] += sum(expired[key] for key in keys)
+
+
+class CompileSubscriptionsIndexUseCase:
+    """
+    Used by the compile_subscriptions_index command.
+
+    Compiles valid subscriptions into the index snapshot
+    {'version', 'compiled_at', 'after', 'topics': {pattern key: {subscription key: payload}}},
+    written as one gzipped JSON object. `after` is the last index delta written
+    before the scan started, deltas after it are applied on top of the snapshot,
+    older ones are deleted once they are delta_retention_seconds old.
+    """
+    WORKERS = 8
+    DELTA_RETENTION_SECONDS = 3600
+
+    def __init__(
+            self, subscriptions_repo: repos.SubscriptionsRepo, workers=WORKERS,
+            delta_retention_seconds=DELTA_RETENTION_SECONDS):
+        self.subscriptions_repo = subscriptions_repo
+        self.workers = workers
+        self.delta_retention_seconds = delta_retention_seconds
+
+    def execute(self):
+        deltas = self.subscriptions_repo.list_index_deltas()
+        after = deltas[-1] if deltas else None
+
+        topics = {}
+        report = {'scanned': 0, 'subscriptions': 0, 'topics': 0, 'deltas_deleted': 0}
+        for key, size, payload in self.subscriptions_repo.iter_subscription_payloads(self.workers):
+            report['scanned'] += 1
+            if payload is None or not repos.Subscription(payload=payload, key=key).is_valid:
+                continue
+            topics.setdefault(key.rsplit('/', 1)[0] + '/', {})[key] = payload
+            report['subscriptions'] += 1
+        report['topics'] = len(topics)
+        self.subscriptions_repo.put_index({
+            'version': str(uuid.uuid4()),
+            'compiled_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+            'after': after,
+            'topics': topics,
+        })
+
+        # processes which loaded an older snapshot still read the deltas for a while
+        retention_start = time.time() - self.delta_retention_seconds
+        stale = [key for key in deltas if self.subscriptions_repo.get_index_delta_time(key) < retention_start]
+        self.subscriptions_repo.delete_index_deltas(stale)
+        report['deltas_deleted'] = len(stale)
+        logger.info("Subscriptions index compiled: %s", report)
+        return report
 
 
 class PostNotificationUseCase:
@@ -118,14 +532,25 @@ class PostNotificationUseCase:
         self.notifications_repo = notification_repo
 
     def publish(self, message: models.Message):
-        topic = self.get_topic(message)
-        job_payload = {
-            'topic': topic,
-            'content': {'id': message.id}
-        }
+        job_payload = self.get_job_payload(message)
         logger.debug('publish notification %r', job_payload)
         self.notifications_repo.post_job(job_payload)
 
+    def publish_many(self, messages):
+        """
+        Send notifications for all given messages using batch requests,
+        notifications repo should support post_jobs
+        """
+        job_payloads = [self.get_job_payload(message) for message in messages]
+        logger.debug('publish %s notifications', len(job_payloads))
+        self.notifications_repo.post_jobs(job_payloads)
+
+    def get_job_payload(self, message: models.Message):
+        return {
+            'topic': self.get_topic(message),
+            'content': {'id': message.id}
+        }
+
     @staticmethod
     def get_topic(message: models.Message):
         raise NotImplementedError
@@ -149,10 +574,91 @@ class PublishNewMessageUseCase(PostNotificationUseCase):
 
     @staticmethod
     def get_topic(message: models.Message):
-        jurisdiction = message.payload['receiver']
+        jurisdiction = message.receiver
         return f"jurisdiction.{jurisdiction}"
 
 
+class RelayNotificationsOutboxUseCase:
+    """
+    Used by the notifications relay worker.
+
+    Moves notification jobs written to the outbox table by the API
+    to the notifications queue, in batches.
+    Rows are locked with FOR UPDATE SKIP LOCKED and deleted
+    in the same transaction, so several relays may run in parallel;
+    if the transaction fails after posting the jobs they are posted again.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self, notifications_repo: repos.NotificationsRepo, batch_size=BATCH_SIZE):
+        self.notifications_repo = notifications_repo
+        self.batch_size = batch_size
+
+    def execute(self):
+        Outbox = models.NotificationOutbox
+        notifications = db.session.query(Outbox.id, Outbox.payload).order_by(
+            Outbox.id.asc()
+        ).limit(self.batch_size).with_for_update(skip_locked=True).all()
+        if not notifications:
+            db.session.commit()
+            return
+
+        self.notifications_repo.post_jobs([notification.payload for notification in notifications])
+        db.session.query(Outbox).filter(
+            Outbox.id.in_([notification.id for notification in notifications])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Relayed %s notifications", len(notifications))
+        return len(notifications)
+
+
+class ReplayDeadLettersUseCase:
+    """
+    Used by the replay_dead_letters command.
+
+    Posts dead-lettered callback jobs matching the filters
+    back to the delivery outbox, a batch per call;
+    replayed jobs get MAX_ATTEMPTS delivery attempts again.
+    Rows are locked with FOR UPDATE SKIP LOCKED and deleted in the same transaction.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(
+            self, delivery_outbox_repo: repos.DeliveryOutboxRepo,
+            callback_url=None, since: datetime = None, until: datetime = None, batch_size=BATCH_SIZE):
+        self.delivery_outbox = delivery_outbox_repo
+        self.callback_url = callback_url
+        self.since = since
+        self.until = until
+        self.batch_size = batch_size
+
+    def execute(self):
+        DeadLetter = models.DeliveryDeadLetter
+        query = db.session.query(DeadLetter.id, DeadLetter.callback_url, DeadLetter.payload)
+        if self.callback_url:
+            query = query.filter(DeadLetter.callback_url == self.callback_url)
+        if self.since:
+            query = query.filter(DeadLetter.created_at >= self.since)
+        if self.until:
+            query = query.filter(DeadLetter.created_at < self.until)
+        dead_letters = query.order_by(
+            DeadLetter.id.asc()
+        ).limit(self.batch_size).with_for_update(skip_locked=True).all()
+        if not dead_letters:
+            db.session.commit()
+            return
+
+        self.delivery_outbox.post_jobs([
+            {'s': dead_letter.callback_url, 'payload': dead_letter.payload} for dead_letter in dead_letters
+        ])
+        db.session.query(DeadLetter).filter(
+            DeadLetter.id.in_([dead_letter.id for dead_letter in dead_letters])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        logger.info("Replayed %s dead-lettered callbacks", len(dead_letters))
+        return len(dead_letters)
+
+
 class DispatchMessageToSubscribersUseCase:
     """
     Used by the callbacks spreader worker.
@@ -170,57 +676,122 @@ class DispatchMessageToSubscribersUseCase:
     it is insulated from this process
     by the delivery outbox message queue.
 
+    With batch_size > 1 up to batch_size notifications are received
+    per call, subscribers are resolved once per topic and
+    the queues are used with batch requests,
+    repos should support get_jobs, post_jobs and delete_jobs.
+
+    With wait_seconds > 0 the notifications queue is long-polled,
+    execute returns None after waiting that long for a notification.
     """
 
     def __init__(
             self, notifications_repo: repos.NotificationsRepo,
             delivery_outbox_repo: repos.DeliveryOutboxRepo,
-            subscriptions_repo: repos.SubscriptionsRepo):
+            subscriptions_repo: repos.SubscriptionsRepo,
+            subscriptions_cache=None,
+            batch_size=1,
+            wait_seconds=0):
         self.notifications = notifications_repo
         self.delivery_outbox = delivery_outbox_repo
         self.subscriptions = subscriptions_repo
+        self.subscriptions_cache = subscriptions_cache
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
 
     def execute(self):
-        job = self.notifications.get_job()
+        if self.batch_size > 1:
+            return self.execute_batch()
+        if self.wait_seconds:
+            jobs = self.notifications.get_jobs(1, self.wait_seconds)
+            job = jobs[0] if jobs else None
+        else:
+            job = self.notifications.get_job()
         if not job:
             return
-        return self.process(*job)
+        self.process(*job)
+        return True
+
+    def execute_batch(self):
+        jobs = self.notifications.get_jobs(self.batch_size, self.wait_seconds)
+        if not jobs:
+            return
+        contents_by_topic = OrderedDict()
+        for msg_id, payload in jobs:
+            contents_by_topic.setdefault(payload['topic'], []).append(payload['content'])
+
+        delivery_jobs = []
+        for topic, contents in contents_by_topic.items():
+            subscriptions = self._get_subscriptions(topic)
+            for content in contents:
+                delivery_jobs.extend(self._get_delivery_jobs(subscriptions, content))
+
+        self.delivery_outbox.post_jobs(delivery_jobs)
+        self.notifications.delete_jobs([msg_id for msg_id, payload in jobs])
+        logger.info("Dispatched %s notifications to %s callbacks", len(jobs), len(delivery_jobs))
+        return True
 
     def process(self, msg_id, payload):
         subscriptions = self._get_subscriptions(payload['topic'])
 
         content = payload['content']
 
+        for job in self._get_delivery_jobs(subscriptions, content):
+            self.delivery_outbox.post_job(job)
+
+        self.notifications.delete(msg_id)
+
+    def _get_delivery_jobs(self, subscriptions, content):
+        jobs = []
         for subscription in subscriptions:
             if not subscription.is_valid:
                 logger.info("Found invalid subscription %s", subscription)
                 continue
-            job = {
-                's': subscription.callback_url,
-                'payload': content,
-            }
             logger.info(
                 "Will be notifying '%s' with '%s'",
                 subscription.callback_url, content
             )
-            self.delivery_outbox.post_job(job)
-
-        self.notifications.delete(msg_id)
+            jobs.append({
+                's': subscription.callback_url,
+                'payload': content,
+            })
+        metrics.DISPATCH_FANOUT.observe(len(jobs))
+        return jobs
 
     def _get_subscriptions(self, topic):
-        pattern = repos.Pattern(topic)
-        subscribers = self.subscriptions.get_subscriptions_by_pattern(pattern)
+        """
+        Subscriptions to the topic and to the wildcard patterns matching it,
+        one per callback url, preferring a valid subscription to the most specific pattern
+        """
+        subscriptions_by_url = {}
+        for pattern in get_matching_patterns(topic):
+            for subscription in self._get_pattern_subscriptions(pattern):
+                found = subscriptions_by_url.get(subscription.callback_url)
+                if found is None or (not found.is_valid and subscription.is_valid):
+                    subscriptions_by_url[subscription.callback_url] = subscription
+        subscribers = set(subscriptions_by_url.values())
         if not subscribers:
             logger.info("Nobody to notify about the topic %s", topic)
         else:
             logger.info("The topic %s has %s subscriber(s)", topic, len(subscribers))
         return subscribers
 
+    def _get_pattern_subscriptions(self, pattern):
+        if self.subscriptions_cache is not None:
+            return self.subscriptions_cache.get(pattern)
+        return self.subscriptions.get_subscriptions_by_pattern(repos.Pattern(pattern))
+
 
 class InvalidCallbackResponse(Exception):
     pass
 
 
+class CallbackHostUnavailable(InvalidCallbackResponse):
+    """
+    Callback host did not respond or failed with a server error
+    """
+
+
 class DeliverCallbackUseCase:
     """
     Is used by a callback deliverer worker
@@ -232,42 +803,108 @@ class DeliverCallbackUseCase:
     or, in case of any error, not to be re-scheduled again
     (up to MAX_ATTEMPTS times)
 
+    With circuit_breaker, jobs for callback hosts with open circuit
+    are parked in the queue until the circuit lets requests through,
+    without making an attempt.
+
+    With wait_seconds > 0 the delivery outbox is long-polled.
     """
 
     MAX_ATTEMPTS = 3
+    # SQS limit for DelaySeconds
+    MAX_PARK_SECONDS = 900
 
-    def __init__(self, delivery_outbox_repo: repos.DeliveryOutboxRepo, hub_url):
+    def __init__(
+            self, delivery_outbox_repo: repos.DeliveryOutboxRepo, hub_url, http_session=None,
+            circuit_breaker: CircuitBreaker = None, dead_letter_repo=None, wait_seconds=0):
         self.delivery_outbox = delivery_outbox_repo
         self.hub_url = hub_url
+        self.http_session = http_session or self._create_http_session()
+        self.circuit_breaker = circuit_breaker
+        self.dead_letter_repo = dead_letter_repo
+        self.wait_seconds = wait_seconds
 
     def execute(self):
-        deliverable = self.delivery_outbox.get_job()
+        if self.wait_seconds:
+            jobs = self.delivery_outbox.get_jobs(1, self.wait_seconds)
+            deliverable = jobs[0] if jobs else None
+        else:
+            deliverable = self.delivery_outbox.get_job()
         if not deliverable:
             return
 
         queue_msg_id, payload = deliverable
-        return self.process(queue_msg_id, payload)
+        self.process(queue_msg_id, payload)
+        return True
 
     def process(self, queue_msg_id, job):
         subscribe_url = job['s']
         payload = job['payload']
         attempt = int(job.get('retry', 1))
 
+        if not self._is_allowed(subscribe_url):
+            self._park(queue_msg_id, job)
+            self.delivery_outbox.delete(queue_msg_id)
+            return
+
+        started = time.monotonic()
+        error = None
         try:
             logger.debug('[%s] deliver notification to %s with payload: %s (attempt %s)',
                          queue_msg_id, subscribe_url, payload, attempt)
             self._deliver_notification(subscribe_url, payload)
         except InvalidCallbackResponse as e:
-            logger.info("[%s] delivery failed", queue_msg_id)
-            logger.exception(e)
-            if attempt < self.MAX_ATTEMPTS:
-                logger.info("[%s] re-schedule delivery", queue_msg_id)
-                self._retry(subscribe_url, payload, attempt)
-
+            error = e
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # every allowed delivery records an outcome, so a half-open circuit gets its probe slot back
+            self._record_delivery(subscribe_url, error, time.monotonic() - started)
+
+        if error is not None:
+            self._on_delivery_failed(queue_msg_id, job, error)
         self.delivery_outbox.delete(queue_msg_id)
 
+    def _create_http_session(self):
+        return HttpSession()
+
+    def _is_allowed(self, url):
+        return self.circuit_breaker is None or self.circuit_breaker.allow(urlparse(url).netloc)
+
+    def _record_delivery(self, url, error, seconds=None):
+        host = urlparse(url).netloc
+        outcome = self._get_delivery_outcome(error)
+        metrics.record_delivery(host, outcome, seconds)
+        if self.circuit_breaker is None:
+            return
+        if outcome in ('delivered', 'rejected'):
+            # the host responded, even if the callback rejected the notification
+            self.circuit_breaker.record_success(host)
+        else:
+            self.circuit_breaker.record_failure(host)
+
+    def _park(self, queue_msg_id, job):
+        host = urlparse(job['s']).netloc
+        metrics.record_delivery(host, 'parked')
+        delay = min(max(math.ceil(self.circuit_breaker.retry_after(host)), 1), self.MAX_PARK_SECONDS)
+        logger.info("[%s] circuit for %s is open, park delivery for %ss", queue_msg_id, host, delay)
+        self.delivery_outbox.post_job(job, delay_seconds=delay)
+
+    def _on_delivery_failed(self, queue_msg_id, job, error):
+        attempt = int(job.get('retry', 1))
+        logger.info("[%s] delivery failed", queue_msg_id)
+        logger.error(error, exc_info=error)
+        if attempt < self.MAX_ATTEMPTS:
+            logger.info("[%s] re-schedule delivery", queue_msg_id)
+            self._retry(job['s'], job['payload'], attempt)
+        elif self.dead_letter_repo is not None:
+            logger.info("[%s] delivery attempts exhausted, save to dead letters", queue_msg_id)
+            self.dead_letter_repo.save(job, attempt, self._get_failure_reason(error))
+
     def _retry(self, subscribe_url, payload, attempt):
         logger.info("Delivery failed, re-schedule it")
+        metrics.DELIVERY_RETRIES.labels(urlparse(subscribe_url).netloc).inc()
         job = {'s': subscribe_url, 'payload': payload, 'retry': attempt + 1}
         self.delivery_outbox.post_job(job, delay_seconds=self._get_retry_time(attempt))
 
@@ -284,15 +921,36 @@ class DeliverCallbackUseCase:
             'Link': f'<{self.hub_url}>; rel="hub"'
         }
         try:
-            resp = requests.post(url, json=payload, headers=header)
+            resp = self.http_session.post(url, json=payload, headers=header)
             if str(resp.status_code).startswith('2'):
                 return
-        except ConnectionError:
-            raise InvalidCallbackResponse("Connection error, url: %s", url)
+        except requests.RequestException:
+            raise CallbackHostUnavailable("Connection error, url: %s", url)
 
+        if resp.status_code >= 500:
+            raise CallbackHostUnavailable("Subscription url %s returns %s", url, resp.status_code)
         raise InvalidCallbackResponse("Subscription url %s seems to be invalid, "
                                       "returns %s", url, resp.status_code)
 
+    @staticmethod
+    def _get_delivery_outcome(error):
+        if error is None:
+            return 'delivered'
+        if isinstance(error, CallbackHostUnavailable):
+            return 'unavailable'
+        if isinstance(error, InvalidCallbackResponse):
+            return 'rejected'
+        return 'error'
+
+    @staticmethod
+    def _get_failure_reason(error):
+        # InvalidCallbackResponse keeps logging style (message, *args) arguments
+        message, *args = error.args or (error.__class__.__name__,)
+        try:
+            return str(message) % tuple(args)
+        except TypeError:
+            return str(error.args)
+
     @staticmethod
     def _get_retry_time(attempt):
         """exponential back off with jitter"""
@@ -301,3 +959,139 @@ class DeliverCallbackUseCase:
         delay = min(base * 2 ** attempt, max_retry)
         jitter = random.uniform(0, delay / 2)
         return int(delay / 2 + jitter)
+
+
+class AsyncDeliverCallbackUseCase(DeliverCallbackUseCase):
+    """
+    Delivers callbacks concurrently on an asyncio event loop
+
+    Every execute call receives more jobs while there are less than
+    max_concurrency deliveries in flight and then runs the loop until
+    any of them completes, so a slow subscriber holds back only
+    its own deliveries. Connections to a single callback host
+    are limited by max_per_host.
+
+    Failed deliveries are re-scheduled the same way as DeliverCallbackUseCase does,
+    so are deliveries which raised an unexpected error or were cancelled,
+    delivery_outbox_repo should support get_jobs and delete_jobs.
+    """
+
+    WAIT_INTERVAL = 1
+
+    def __init__(
+            self, delivery_outbox_repo: repos.DeliveryOutboxRepo, hub_url,
+            max_concurrency=100, max_per_host=10, batch_size=10, wait_seconds=0,
+            connect_timeout=5, read_timeout=30, circuit_breaker: CircuitBreaker = None, dead_letter_repo=None):
+        super().__init__(
+            delivery_outbox_repo, hub_url, circuit_breaker=circuit_breaker, dead_letter_repo=dead_letter_repo,
+            wait_seconds=wait_seconds
+        )
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.batch_size = batch_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.session = None
+        self.in_flight = set()
+        # task: (queue_msg_id, job) of the deliveries in flight
+        self.in_flight_jobs = {}
+
+    def execute(self):
+        free_slots = self.max_concurrency - len(self.in_flight)
+        if free_slots > 0:
+            # don't block on receive while there are deliveries to wait for
+            wait_seconds = 0 if self.in_flight else self.wait_seconds
+            jobs = self.delivery_outbox.get_jobs(min(self.batch_size, free_slots), wait_seconds)
+            parked_ids = []
+            for queue_msg_id, job in jobs:
+                if self._is_allowed(job['s']):
+                    self._start_delivery(queue_msg_id, job)
+                else:
+                    self._park(queue_msg_id, job)
+                    parked_ids.append(queue_msg_id)
+            if parked_ids:
+                self.delivery_outbox.delete_jobs(parked_ids)
+            if jobs and not self.in_flight:
+                return True
+
+        if not self.in_flight:
+            return
+        done, self.in_flight = self.loop.run_until_complete(asyncio.wait(
+            self.in_flight, timeout=self.WAIT_INTERVAL, return_when=asyncio.FIRST_COMPLETED
+        ))
+        self._finish(done)
+        return True
+
+    def close(self):
+        """
+        Wait for deliveries in flight and release the HTTP session
+        """
+        if self.in_flight:
+            done, _ = self.loop.run_until_complete(asyncio.wait(self.in_flight))
+            self.in_flight = set()
+            self._finish(done)
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+    def _create_http_session(self):
+        # deliveries use the aiohttp session created on the event loop
+        return None
+
+    def _start_delivery(self, queue_msg_id, job):
+        task = self.loop.create_task(self._deliver(queue_msg_id, job))
+        self.in_flight.add(task)
+        self.in_flight_jobs[task] = (queue_msg_id, job)
+
+    def _finish(self, tasks):
+        finished_ids = []
+        for task in tasks:
+            queue_msg_id, job = self.in_flight_jobs.pop(task)
+            try:
+                error, seconds = task.result()
+            except (asyncio.CancelledError, Exception) as e:
+                # the circuit gets an outcome and the job is re-scheduled like any failed delivery
+                error, seconds = e, None
+            self._record_delivery(job['s'], error, seconds)
+            if error:
+                self._on_delivery_failed(queue_msg_id, job, error)
+            finished_ids.append(queue_msg_id)
+        if finished_ids:
+            self.delivery_outbox.delete_jobs(finished_ids)
+
+    async def _deliver(self, queue_msg_id, job):
+        logger.debug('[%s] deliver notification to %s with payload: %s (attempt %s)',
+                     queue_msg_id, job['s'], job['payload'], job.get('retry', 1))
+        started = time.monotonic()
+        try:
+            await self._deliver_notification_async(job['s'], job['payload'])
+        except InvalidCallbackResponse as e:
+            return e, time.monotonic() - started
+        return None, time.monotonic() - started
+
+    async def _deliver_notification_async(self, url, payload):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_per_host),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+        logger.info("Sending WebSub payload \n    %s to callback URL \n    %s", payload, url)
+        header = {
+            'Link': f'<{self.hub_url}>; rel="hub"'
+        }
+        try:
+            async with self.session.post(url, json=payload, headers=header) as resp:
+                if str(resp.status).startswith('2'):
+                    return
+        except asyncio.TimeoutError:
+            http_stats.record_timeout()
+            raise CallbackHostUnavailable("Timeout, url: %s", url)
+        except aiohttp.ClientError:
+            raise CallbackHostUnavailable("Connection error, url: %s", url)
+
+        if resp.status >= 500:
+            raise CallbackHostUnavailable("Subscription url %s returns %s", url, resp.status)
+        raise InvalidCallbackResponse("Subscription url %s seems to be invalid, "
+                                      "returns %s", url, resp.status)
@@ -1,27 +1,37 @@
 import json
-import uuid
+from datetime import datetime, timezone
 from http import HTTPStatus
 
 import marshmallow
-import requests
-from flask import Blueprint, Response, request, jsonify
+from marshmallow import validate
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask import current_app
 from flask.views import View
 from libtrustbridge.utils.routing import mimetype
 from libtrustbridge.websub.constants import MODE_ATTR_SUBSCRIBE_VALUE
 from libtrustbridge.websub.exceptions import SubscriptionNotFoundError
-from libtrustbridge.websub.repos import SubscriptionsRepo, NotificationsRepo
 from libtrustbridge.websub.schemas import SubscriptionForm
+from sqlalchemy import any_, bindparam, case, text
+from sqlalchemy.dialects import postgresql
 from webargs import fields
 from webargs.flaskparser import use_kwargs
 from werkzeug.exceptions import HTTPException
 
 from api import use_cases
-from api.models import Message, db
-from api.schemas import MessagePayloadSchema, PostedMessageSchema, MessageSchema, StatusUpdateSchema, dump_only_fields
+from api.models import Message, MessageStatus, db, is_postgresql
+from api.repos import IntentVerificationRepo, NotificationsOutboxRepo, create_subscriptions_repo
+from api.schemas import (
+    MessagePayloadSchema, PostedMessageSchema, MessageSchema, StatusUpdateSchema, BulkStatusUpdateSchema,
+    BulkSubscriptionSchema, dump_only_fields, encode_cursor, decode_cursor
+)
+from api.topics import WILDCARD, is_valid_pattern
 
 blueprint = Blueprint('views', __name__)
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+WILDCARD_ERROR = f'The {WILDCARD} wildcard is only allowed as the last topic segment.'
+
 
 class JsonResponse(Response):
     default_mimetype = 'application/json'
@@ -79,13 +89,13 @@ def post_message():
 
     message = Message(payload=request.json)
     db.session.add(message)
+    db.session.flush()
+    use_case = use_cases.PublishStatusChangeUseCase(NotificationsOutboxRepo())
+    use_case.publish(message)
     db.session.commit()
+    _cache_message(message)
     return_schema = PostedMessageSchema()
 
-    notifications_repo = NotificationsRepo(current_app.config['NOTIFICATIONS_REPO_CONF'])
-    use_case = use_cases.PublishStatusChangeUseCase(notifications_repo)
-    use_case.publish(message)
-
     hub_url = current_app.config['HUB_URL']
     topic = use_cases.PublishStatusChangeUseCase.get_topic(message)
     headers = {
@@ -94,6 +104,244 @@ def post_message():
     return JsonResponse(return_schema.dump(message), status=201, headers=headers)
 
 
+@blueprint.route('/messages/batch', methods=['POST'])
+def post_messages_batch():
+    """
+    ---
+    post:
+        servers:
+            - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
+        description:
+            Post a batch of new messages, invalid items are reported
+            without rejecting the rest of the batch
+        requestBody:
+            content:
+                application/json:
+                    schema:
+                        type: array
+                        items: MessagePayloadSchema
+                    example:
+                        - sender: AU
+                          receiver: CN
+                          subject: AU.abn0000000000.XXXX-XXXXX-XXXXX-XXXXXX
+                          obj: QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n
+                          predicate: UN.CEFACT.Trade.CertificateOfOrigin.created
+                        - sender: AU
+        responses:
+            201:
+                description: All messages are created, returns message ids in the request order
+                content:
+                    application/json:
+                        example:
+                            messages:
+                                - id: 1
+            207:
+                description: Some messages are invalid, returns message ids and errors in the request order
+                content:
+                    application/json:
+                        example:
+                            messages:
+                                - id: 1
+                                - errors:
+                                    obj: ['Missing data for required field.']
+            400:
+                description: Request body is not a list or the batch is too large
+    """
+    items = request.json
+    if not isinstance(items, list):
+        return JsonResponse({'_schema': ['Expected a list of messages.']}, status=400)
+    max_size = current_app.config['MESSAGES_BATCH_MAX_SIZE']
+    if len(items) > max_size:
+        return JsonResponse({'_schema': [f'Batch may contain at most {max_size} messages.']}, status=400)
+
+    schema = MessagePayloadSchema(many=True)
+    try:
+        schema.load(items)
+        errors = {}
+    except marshmallow.ValidationError as e:
+        errors = e.messages
+
+    payloads = [item for index, item in enumerate(items) if index not in errors]
+    messages = _create_messages(payloads) if payloads else []
+    if messages:
+        use_case = use_cases.PublishStatusChangeUseCase(NotificationsOutboxRepo())
+        use_case.publish_many(messages)
+    db.session.commit()
+    for message in messages:
+        _cache_message(message)
+
+    return_schema = PostedMessageSchema()
+    created = iter(messages)
+    results = [
+        {'errors': errors[index]} if index in errors else return_schema.dump(next(created))
+        for index in range(len(items))
+    ]
+    hub_url = current_app.config['HUB_URL']
+    headers = {
+        'Link': f'<{hub_url}>; rel="hub"'
+    }
+    status = HTTPStatus.MULTI_STATUS if errors else HTTPStatus.CREATED
+    return JsonResponse({'messages': results}, status=status, headers=headers)
+
+
+def _create_messages(payloads):
+    """
+    Insert messages using one multi-row INSERT statement,
+    returns messages with ids in the payloads order
+    """
+    now = datetime.utcnow()
+    rows = [
+        {'payload': payload, 'status': MessageStatus.CONFIRMED, 'created_at': now, 'updated_at': now}
+        for payload in payloads
+    ]
+    if is_postgresql():
+        # ids are allocated up front, RETURNING rows are not guaranteed to follow the VALUES order
+        ids = sorted(row.id for row in db.session.execute(
+            text("SELECT nextval(pg_get_serial_sequence('message', 'id')) AS id FROM generate_series(1, :count)"),
+            {'count': len(rows)}
+        ))
+        rows = [dict(values, id=id) for id, values in zip(ids, rows)]
+        db.session.execute(Message.__table__.insert().values(rows))
+        return [Message(**values) for values in rows]
+
+    messages = [Message(**values) for values in rows]
+    db.session.add_all(messages)
+    db.session.flush()
+    return messages
+
+
+@blueprint.route('/messages', methods=['GET'])
+@use_kwargs({
+    'receiver': fields.Str(),
+    'sender': fields.Str(),
+    'status': fields.Str(validate=validate.OneOf([status.value for status in MessageStatus])),
+    'updated_since': fields.DateTime(),
+    'cursor': fields.Str(),
+    'limit': fields.Int(validate=validate.Range(min=1)),
+    'fields': fields.DelimitedList(fields.Str()),
+}, location="querystring")
+def list_messages(
+        receiver=None, sender=None, status=None, updated_since=None, cursor=None, limit=None, fields=None):
+    """
+    ---
+    get:
+        servers:
+            - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
+        description:
+            List messages in (updated_at, id) order, page by page.
+            Pass next_cursor from the response to get the next page,
+            or request application/x-ndjson to stream all messages one per line
+        parameters:
+            - in: query
+              name: receiver
+              schema:
+                type: string
+              example: AU
+            - in: query
+              name: sender
+              schema:
+                type: string
+              example: CN
+            - in: query
+              name: status
+              schema:
+                type: string
+                enum: [received, confirmed, revoked, undeliverable]
+            - in: query
+              name: updated_since
+              schema:
+                type: string
+                format: date-time
+              example: '2020-06-17T12:04:01.111111'
+            - in: query
+              name: cursor
+              schema:
+                type: string
+            - in: query
+              name: limit
+              schema:
+                type: integer
+                minimum: 1
+              example: 100
+            - in: query
+              name: fields
+              schema:
+                type: array
+                items:
+                  type: string
+              style: form
+              explode: false
+              example: id,status
+        responses:
+            200:
+                description: Returns page of messages and cursor of the next page
+                content:
+                    application/json:
+                        schema:
+                            type: object
+                            properties:
+                                messages:
+                                    type: array
+                                    items: MessageSchema
+                                next_cursor:
+                                    type: string
+                                    nullable: true
+                        example:
+                            messages:
+                                - id: 123
+                                  message:
+                                    sender: AU
+                                    receiver: CN
+                                    subject: AU.abn0000000000.XXXX-XXXXX-XXXXX-XXXXXX
+                                    obj: QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n
+                                    predicate: UN.CEFACT.Trade.CertificateOfOrigin.created
+                                  status: received
+                            next_cursor: WyIyMDIwLTA2LTE3VDEyOjA0OjAxLjExMTExMSIsIDEyM10=
+                    application/x-ndjson:
+                        schema:
+                            type: string
+            400:
+                description: Invalid cursor
+    """
+    query = db.session.query(Message)
+    if receiver:
+        query = query.filter(Message.receiver == receiver)
+    if sender:
+        query = query.filter(Message.sender == sender)
+    if status:
+        query = query.filter(Message.status == MessageStatus(status))
+    if updated_since:
+        if updated_since.tzinfo:
+            updated_since = updated_since.astimezone(timezone.utc).replace(tzinfo=None)
+        query = query.filter(Message.updated_at >= updated_since)
+    if cursor:
+        try:
+            query = query.filter(Message.after_cursor(*decode_cursor(cursor)))
+        except ValueError:
+            return JsonResponse({'cursor': ['Invalid cursor.']}, status=400)
+    query = query.order_by(*Message.cursor_order())
+    return_schema = MessageSchema()
+
+    if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        if limit:
+            query = query.limit(limit)
+        # yield_per enables stream_results, ie. server-side cursor
+        messages = query.yield_per(current_app.config['MESSAGES_STREAM_CHUNK_SIZE'])
+        lines = (json.dumps(dump_only_fields(return_schema.dump(message), fields)) + '\n' for message in messages)
+        return Response(stream_with_context(lines), mimetype=NDJSON_MIMETYPE)
+
+    limit = min(limit or current_app.config['MESSAGES_PAGE_SIZE'], current_app.config['MESSAGES_PAGE_MAX_SIZE'])
+    messages = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor(messages[-1].updated_at, messages[-1].id)
+    return JsonResponse({
+        'messages': [dump_only_fields(return_schema.dump(message), fields) for message in messages],
+        'next_cursor': next_cursor,
+    })
+
+
 @blueprint.route('/messages/<id>')
 @use_kwargs({'fields': fields.DelimitedList(fields.Str())}, location="querystring")
 def get_message(id, fields=None):
@@ -136,14 +384,41 @@ def get_message(id, fields=None):
                                 obj: QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n
                                 predicate: UN.CEFACT.Trade.CertificateOfOrigin.created
                             status: received
+            304:
+                description: Message is not modified since the version matching If-None-Match header
     """
-    message = db.session.query(Message).get(id)
-    if not message:
+    # the current version is read on every request, the cached body is only served if it is still current
+    updated_at = db.session.query(Message.updated_at).filter(Message.id == id).scalar()
+    if updated_at is None:
         return Response(status=404)
-    return_schema = MessageSchema()
+    etag = _message_etag(id, updated_at)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=HTTPStatus.NOT_MODIFIED)
+    else:
+        cached = current_app.extensions['message_cache'].get(str(id))
+        if cached is None or cached[1] != etag:
+            message = db.session.query(Message).get(id)
+            if not message:
+                return Response(status=404)
+            cached = _cache_message(message)
+        data, etag = cached
+        response = JsonResponse(dump_only_fields(data, fields))
+    response.set_etag(etag, weak=True)
+    return response
 
-    data = return_schema.dump(message)
-    return JsonResponse(dump_only_fields(data, fields))
+
+def _message_etag(id, updated_at):
+    return f"{id}-{updated_at.strftime('%Y%m%d%H%M%S%f')}"
+
+
+def _cache_message(message):
+    """
+    Put serialized message and its ETag into the message cache
+    """
+    data = MessageSchema().dump(message)
+    cached = (data, _message_etag(message.id, message.updated_at))
+    current_app.extensions['message_cache'].set(str(message.id), cached)
+    return cached
 
 
 @blueprint.route('/messages/<id>/status', methods=['PUT'])
@@ -160,19 +435,124 @@ def update_message_status(id):
     except marshmallow.ValidationError as e:
         return JsonResponse(e.messages, status=400)
 
-    notifications_repo = NotificationsRepo(current_app.config['NOTIFICATIONS_REPO_CONF'])
-    use_case = use_cases.PublishStatusChangeUseCase(notifications_repo)
+    use_case = use_cases.PublishStatusChangeUseCase(NotificationsOutboxRepo())
     use_case.publish(message)
 
     db.session.commit()
+    current_app.extensions['message_cache'].delete(str(message.id))
     return JsonResponse(MessageSchema().dump(message))
 
 
-class IntentVerificationFailure(Exception):
-    pass
+@blueprint.route('/messages/status', methods=['PUT'])
+def update_messages_status():
+    """
+    ---
+    put:
+        servers:
+            - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
+        description:
+            Update status of many messages at once,
+            invalid or missing items are reported without rejecting the rest
+        requestBody:
+            content:
+                application/json:
+                    schema:
+                        type: array
+                        items: BulkStatusUpdateSchema
+                    example:
+                        - id: 123
+                          status: revoked
+                        - id: 124
+                          status: confirmed
+        responses:
+            200:
+                description: All statuses are updated
+                content:
+                    application/json:
+                        example:
+                            messages:
+                                - id: 123
+                                  status: revoked
+            207:
+                description: Some items are invalid or missing, returns results in the request order
+                content:
+                    application/json:
+                        example:
+                            messages:
+                                - id: 123
+                                  status: revoked
+                                - errors:
+                                    id: ['Message not found.']
+            400:
+                description: Request body is not a list or the batch is too large
+    """
+    items = request.json
+    if not isinstance(items, list):
+        return JsonResponse({'_schema': ['Expected a list of status updates.']}, status=400)
+    max_size = current_app.config['MESSAGES_BATCH_MAX_SIZE']
+    if len(items) > max_size:
+        return JsonResponse({'_schema': [f'Batch may contain at most {max_size} status updates.']}, status=400)
+
+    # every item is loaded once, later items win when the same message is listed twice
+    schema = BulkStatusUpdateSchema()
+    updates, errors = {}, {}
+    for index, item in enumerate(items):
+        try:
+            updates[index] = schema.load(item)
+        except marshmallow.ValidationError as e:
+            errors[index] = e.messages
+    statuses = {update['id']: update['status'] for update in updates.values()}
+    updated = _update_statuses(statuses) if statuses else {}
+    if updated:
+        use_case = use_cases.PublishStatusChangeUseCase(NotificationsOutboxRepo())
+        use_case.publish_many([Message(id=id) for id in sorted(updated)])
+    db.session.commit()
+    message_cache = current_app.extensions['message_cache']
+    for id in updated:
+        message_cache.delete(str(id))
+
+    for index, update in updates.items():
+        if update['id'] not in updated:
+            errors[index] = {'id': ['Message not found.']}
+    results = [
+        {'errors': errors[index]} if index in errors else {
+            'id': updates[index]['id'],
+            'status': updated[updates[index]['id']],
+        }
+        for index in range(len(items))
+    ]
+    status = HTTPStatus.MULTI_STATUS if errors else HTTPStatus.OK
+    return JsonResponse({'messages': results}, status=status)
+
+
+def _update_statuses(statuses):
+    """
+    Apply {id: status} changes using one UPDATE statement,
+    returns {id: status value} of the updated messages
+    """
+    table = Message.__table__
+    ids = list(statuses)
+    values = {
+        'status': case({id: status.value for id, status in statuses.items()}, value=table.c.id),
+        'updated_at': datetime.utcnow(),
+    }
+    if is_postgresql():
+        ids_param = bindparam('ids', ids, type_=postgresql.ARRAY(db.Integer))
+        statement = table.update().where(table.c.id == any_(ids_param)).values(values)
+        rows = db.session.execute(statement.returning(table.c.id, table.c.status))
+        return {row.id: row.status.value for row in rows}
+
+    updated_ids = [row.id for row in db.session.query(Message.id).filter(Message.id.in_(ids))]
+    db.session.execute(table.update().where(table.c.id.in_(updated_ids)).values(values))
+    return {id: statuses[id].value for id in updated_ids}
 
 
 class BaseSubscriptionsView(View):
+    """
+    With INTENT_VERIFICATION_ASYNC the request is queued and accepted right away,
+    the intent verification worker verifies it and subscribes or unsubscribes,
+    otherwise the intent is verified before answering
+    """
     methods = ['POST']
 
     @mimetype(include=['application/x-www-form-urlencoded'])
@@ -185,12 +565,17 @@ class BaseSubscriptionsView(View):
         current_app.logger.info("Subscription request received: %s", form_data)
 
         topic = self.get_topic(form_data)
+        if not is_valid_pattern(topic):
+            return JsonResponse({'topic': [WILDCARD_ERROR]}, status=HTTPStatus.BAD_REQUEST)
         callback = form_data['callback']
         mode = form_data['mode']
         lease_seconds = form_data['lease_seconds']
+        if current_app.config['INTENT_VERIFICATION_ASYNC']:
+            return self._queue_verification(callback, mode, topic, lease_seconds)
+
         try:
             self.verify(callback, mode, topic, lease_seconds)
-        except IntentVerificationFailure:
+        except use_cases.IntentVerificationFailure:
             current_app.logger.error(
                 "Intent verification failed for the %s", form_data.get("callback")
             )
@@ -212,6 +597,16 @@ class BaseSubscriptionsView(View):
     def get_topic(self, form_data):
         return form_data['topic']
 
+    def _queue_verification(self, callback, mode, topic, lease_seconds):
+        if mode != MODE_ATTR_SUBSCRIBE_VALUE:
+            use_case = use_cases.SubscriptionDeregisterUseCase(self._get_repo())
+            if not use_case.is_subscribed(callback, topic):
+                raise SubscriptionNotFoundError()
+        repo = IntentVerificationRepo(current_app.config['INTENT_VERIFICATION_REPO_CONF'])
+        repo.post_job({'callback': callback, 'mode': mode, 'topic': topic, 'lease_seconds': lease_seconds})
+        current_app.logger.info("Intent verification of %s to %s for %s queued", mode, topic, callback)
+        return JsonResponse(status=HTTPStatus.ACCEPTED)
+
     def _subscribe(self, callback, topic, lease_seconds):
         repo = self._get_repo()
         use_case = use_cases.SubscriptionRegisterUseCase(repo)
@@ -226,21 +621,10 @@ class BaseSubscriptionsView(View):
             raise SubscriptionNotFoundError() from e
 
     def _get_repo(self):
-        return SubscriptionsRepo(current_app.config.get('SUBSCRIPTIONS_REPO_CONF'))
+        return create_subscriptions_repo(current_app.config)
 
     def verify(self, callback_url, mode, topic, lease_seconds):
-        challenge = str(uuid.uuid4())
-        params = {
-            'hub.mode': mode,
-            'hub.topic': topic,
-            'hub.challenge': challenge,
-            'hub.lease_seconds': lease_seconds
-        }
-        response = requests.get(callback_url, params)
-        if response.status_code == 200 and response.text == challenge:
-            return
-
-        raise IntentVerificationFailure()
+        use_cases.verify_intent(current_app.extensions['http_session'], callback_url, mode, topic, lease_seconds)
 
 
 class SubscriptionById(BaseSubscriptionsView):
@@ -250,7 +634,8 @@ class SubscriptionById(BaseSubscriptionsView):
         servers:
             - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
         description:
-            Subscribe to updates about a message (ie. status updates)
+            Subscribe to updates about a message (ie. status updates),
+            the `*` topic subscribes to all messages and jurisdictions
         requestBody:
             content:
                 application/x-www-form-urlencoded:
@@ -261,7 +646,8 @@ class SubscriptionById(BaseSubscriptionsView):
                         hub.callback: 'https://callback.url/1'
         responses:
             202:
-                description: Client successfully subscribed/unsubscribed
+                description: Client successfully subscribed/unsubscribed,
+                    or the request is accepted and the intent will be verified asynchronously
             400:
                 description: Wrong params or intent verification failure
     """
@@ -274,7 +660,8 @@ class SubscriptionByJurisdiction(BaseSubscriptionsView):
         servers:
             - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
         description:
-            Subscribe to updates about new messages sent to jurisdiction (AU, SG, etc.)
+            Subscribe to updates about new messages sent to jurisdiction (AU, SG, etc.),
+            the `*` topic subscribes to messages sent to any jurisdiction
         requestBody:
             content:
                 application/x-www-form-urlencoded:
@@ -285,7 +672,8 @@ class SubscriptionByJurisdiction(BaseSubscriptionsView):
                         hub.callback: 'https://callback.url/1'
         responses:
             202:
-                description: Client successfully subscribed/unsubscribed
+                description: Client successfully subscribed/unsubscribed,
+                    or the request is accepted and the intent will be verified asynchronously
             400:
                 description: Wrong params or intent verification failure
     """
@@ -303,6 +691,72 @@ blueprint.add_url_rule(
 )
 
 
+@blueprint.route('/messages/subscriptions/bulk', methods=['POST'])
+def subscriptions_bulk():
+    """
+    ---
+    post:
+        servers:
+            - url: https://sharedchannel-c1.services.devnet.trustbridge.io/
+        description:
+            Subscribe a callback to (or unsubscribe it from) updates about many messages
+            and jurisdictions at once, the intent is verified for each topic.
+        requestBody:
+            content:
+                application/json:
+                    schema: BulkSubscriptionSchema
+                    example:
+                        callback: 'https://callback.url/1'
+                        mode: subscribe
+                        topics: ['123', '124']
+                        jurisdictions: ['AU']
+        responses:
+            200:
+                description: All topics are verified and subscribed/unsubscribed
+                content:
+                    application/json:
+                        example:
+                            topics:
+                                - topic: '123'
+                                  verified: true
+                                - topic: jurisdiction.AU
+                                  verified: true
+            202:
+                description: Request is accepted, the intent will be verified asynchronously
+            207:
+                description: Intent verification failed for some topics, the rest are subscribed/unsubscribed
+            400:
+                description: Wrong params or too many topics
+    """
+    try:
+        data = BulkSubscriptionSchema().load(request.json or {})
+    except marshmallow.ValidationError as e:
+        return JsonResponse(e.messages, status=HTTPStatus.BAD_REQUEST)
+    topics = data['topics'] + ["jurisdiction.%s" % jurisdiction for jurisdiction in data['jurisdictions']]
+    max_size = current_app.config['SUBSCRIPTIONS_BATCH_MAX_SIZE']
+    if len(topics) > max_size:
+        return JsonResponse({'topics': [f'At most {max_size} topics are allowed.']}, status=HTTPStatus.BAD_REQUEST)
+    if not all(is_valid_pattern(topic) for topic in topics):
+        return JsonResponse({'topics': [WILDCARD_ERROR]}, status=HTTPStatus.BAD_REQUEST)
+    callback, mode, lease_seconds = data['callback'], data['mode'], data['lease_seconds']
+
+    if current_app.config['INTENT_VERIFICATION_ASYNC']:
+        repo = IntentVerificationRepo(current_app.config['INTENT_VERIFICATION_REPO_CONF'])
+        repo.post_job({'callback': callback, 'mode': mode, 'topics': topics, 'lease_seconds': lease_seconds})
+        current_app.logger.info("Intent verification of %s to %s topics for %s queued", mode, len(topics), callback)
+        return JsonResponse(status=HTTPStatus.ACCEPTED)
+
+    use_case = use_cases.BulkSubscriptionUseCase(
+        create_subscriptions_repo(current_app.config),
+        current_app.extensions['http_session'],
+        max_concurrency=current_app.config['INTENT_VERIFICATION_MAX_CONCURRENCY'],
+    )
+    verified = use_case.execute(callback, mode, topics, lease_seconds)
+    results = [{'topic': topic, 'verified': is_verified} for topic, is_verified in verified.items()]
+    status = HTTPStatus.OK if all(verified.values()) else HTTPStatus.MULTI_STATUS
+    return JsonResponse({'topics': results}, status=status)
+
+
 @blueprint.app_errorhandler(HTTPException)
 def handle_exception(e):
     """Return JSON instead of HTML for HTTP errors."""
@@ -16,6 +16,11 @@ manager = Manager(app)
 manager.add_command('run_callback_spreader', commands.RunCallbackSpreaderProcessorCommand)
 manager.add_command('run_callback_delivery', commands.RunCallbackDeliveryProcessorCommand)
 manager.add_command('run_message_observer', commands.RunNewMessagesObserverCommand)
+manager.add_command('run_notifications_relay', commands.RunNotificationsRelayCommand)
+manager.add_command('run_intent_verification', commands.RunIntentVerificationCommand)
+manager.add_command('replay_dead_letters', commands.ReplayDeadLettersCommand)
+manager.add_command('sweep_subscriptions', commands.SweepSubscriptionsCommand)
+manager.add_command('compile_subscriptions_index', commands.CompileSubscriptionsIndexCommand)
 
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,37 @@
+"""Add trigger notifying message receiver on insert or update
+
+Revision ID: 2b7e9f4c1a6d
+Revises: 8d3c51a7f0e2
+Create Date: 2026-10-18 10:02:17.228904
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7e9f4c1a6d'
+down_revision = '8d3c51a7f0e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_message_receiver() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('message_receiver', NEW.receiver);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER message_notify_receiver
+        AFTER INSERT OR UPDATE ON message
+        FOR EACH ROW WHEN (NEW.receiver IS NOT NULL)
+        EXECUTE PROCEDURE notify_message_receiver()
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS message_notify_receiver ON message")
+    op.execute("DROP FUNCTION IF EXISTS notify_message_receiver()")
@@ -0,0 +1,67 @@
+"""Add message receiver and sender columns with observer index
+
+Revision ID: 8d3c51a7f0e2
+Revises: c4bb473b0441
+Create Date: 2026-10-18 09:12:41.503215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3c51a7f0e2'
+down_revision = 'c4bb473b0441'
+branch_labels = None
+depends_on = None
+
+
+# rows updated per backfill transaction, the message table is shared by all channel endpoints
+BACKFILL_BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.add_column('message', sa.Column('receiver', sa.String(), nullable=True))
+    op.add_column('message', sa.Column('sender', sa.String(), nullable=True))
+    # filled by the database, so raw inserts and other writers of the shared table get them too
+    op.execute("""
+        CREATE OR REPLACE FUNCTION message_copy_participants() RETURNS trigger AS $$
+        BEGIN
+            NEW.receiver := NEW.payload ->> 'receiver';
+            NEW.sender := NEW.payload ->> 'sender';
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER message_copy_participants
+        BEFORE INSERT OR UPDATE ON message
+        FOR EACH ROW EXECUTE PROCEDURE message_copy_participants()
+    """)
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        last_id = connection.execute(sa.text("SELECT coalesce(max(id), 0) FROM message")).scalar()
+        for start in range(0, last_id, BACKFILL_BATCH_SIZE):
+            # every batch is committed on its own, new rows are filled by the trigger
+            connection.execute(
+                sa.text(
+                    "UPDATE message SET receiver = payload ->> 'receiver', sender = payload ->> 'sender' "
+                    "WHERE id > :start AND id <= :end"
+                ),
+                start=start, end=start + BACKFILL_BATCH_SIZE
+            )
+        op.create_index(op.f('ix_message_sender'), 'message', ['sender'], unique=False, postgresql_concurrently=True)
+        op.create_index(
+            'ix_message_receiver_updated_at_id', 'message', ['receiver', 'updated_at', 'id'], unique=False,
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.drop_index('ix_message_receiver_updated_at_id', table_name='message')
+    op.drop_index(op.f('ix_message_sender'), table_name='message')
+    op.execute("DROP TRIGGER IF EXISTS message_copy_participants ON message")
+    op.execute("DROP FUNCTION IF EXISTS message_copy_participants()")
+    op.drop_column('message', 'sender')
+    op.drop_column('message', 'receiver')